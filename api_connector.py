@@ -1,13 +1,52 @@
+import re
 import requests
 import datetime
-from typing import Dict, List, Any
+import unicodedata
+from typing import Dict, List, Any, Tuple
+from requests.adapters import HTTPAdapter
 from bs4 import BeautifulSoup
 import json
+from file_cache import FileCache
+from retry import RetryPolicy
+from metrics import METRICS, record_response, timed
+from service_record import Service, parse_routes
 
 
 class ApiConnectorException(Exception): ...
 
 
+# trailing state, either as the api writes it ("... - SP") or as the
+# website does ("... (SP)")
+_STATE_SUFFIX = re.compile(r"\s*(-\s*[a-z]{2}|\([a-z]{2}\))\s*$")
+
+# words that only one of the sources uses to describe the same terminal
+_LOCALE_FILLER_WORDS = {"rod", "rodoviaria"}
+
+
+def fold_locale_name(name: str) -> str:
+    """
+    returns:
+        The name without accents, case folded and with collapsed whitespace.
+    """
+    decomposed = unicodedata.normalize("NFKD", name)
+    stripped = "".join(char for char in decomposed if not unicodedata.combining(char))
+
+    return " ".join(stripped.casefold().split())
+
+
+def canonical_locale_key(name: str) -> str:
+    """
+    returns:
+        A key shared by the different spellings of the same locale, e.g.
+        "São Paulo (Rod. Tietê)" and "SAO PAULO (TIETE) - SP" both become
+        "sao paulo tiete".
+    """
+    folded = _STATE_SUFFIX.sub("", fold_locale_name(name))
+    words = re.sub(r"[^a-z0-9]+", " ", folded).split()
+
+    return " ".join(word for word in words if word not in _LOCALE_FILLER_WORDS)
+
+
 class ApiConnector:
     """
     Provides a simple interface to interact with the jcatlm web api.
@@ -20,26 +59,158 @@ class ApiConnector:
     it will always log out while authentication. ALERT: If you don't want the logs,
     you can set the features argument in the BeatifulSoup initialization, but that could
     cause incompatibility problems.
+
+    If a credential_cache is given, the client_id and access_token are reused from it
+    (across process runs) until they expire or the api rejects them, in which case
+    refresh_credentials() logs in again and updates the cache.
+
+    The searchOrigin result can be kept in a locales_cache the same way, for
+    locales_ttl seconds.
+
+    getRoutes calls retry transient failures through the retry_policy, when one is
+    given.
+
+    Every call (auth, locales and routes) goes through the same keep-alive session,
+    whose connection pool holds up to pool_size connections per host, and is bound
+    by timeout (connect, read) seconds. Call close() once done with the connector.
+
+    api_url and site_url only need to be changed to point the connector to a
+    stand-in server (see mock_api.py).
+
+    credentials ({"client_id": ..., "access_token": ...}) skips the authentication
+    altogether, for connectors sharing the login of another one (see
+    get_credentials).
     """
 
-    def __init__(self) -> None:
-        self.api_url = "https://api.jcatlm.com.br/"
-        self._set_client_id()
-        self._set_access_token()
+    credentials_cache_key = "jcatlm_credentials"
+    locales_cache_key = "jcatlm_locales"
+
+    def __init__(
+        self,
+        credential_cache: FileCache | None = None,
+        credentials_ttl: float = 30 * 60,
+        locales_cache: FileCache | None = None,
+        locales_ttl: float = 24 * 60 * 60,
+        retry_policy: RetryPolicy | None = None,
+        pool_size: int = 10,
+        timeout: float | Tuple[float, float] = (5, 30),
+        api_url: str = "https://api.jcatlm.com.br/",
+        site_url: str = "https://www.viacaocometa.com.br/",
+        credentials: Dict[str, str] | None = None,
+    ) -> None:
+        self.api_url = api_url
+        self.site_url = site_url
+        self.timeout = timeout
+        self.session = self._build_session(pool_size)
+        self.credential_cache = credential_cache
+        self.credentials_ttl = credentials_ttl
+        self.locales_cache = locales_cache
+        self.locales_ttl = locales_ttl
+        self.retry_policy = retry_policy
+        self.locales_info = None
+        self._locales_index: Dict[str, Dict[str, int | None]] = {}
+        self._indexed_locales = None
+
+        if credentials != None:
+            # already authenticated elsewhere (e.g. by the parent of a worker
+            # process), no login chain is run.
+            self.client_id = credentials["client_id"]
+            self.access_token = credentials["access_token"]
+        elif not self._load_cached_credentials():
+            self._set_client_id()
+            self._set_access_token()
+            self._store_credentials()
+
+    @staticmethod
+    def _build_session(pool_size: int) -> requests.Session:
+        session = requests.Session()
+        session.headers.update({"Connection": "keep-alive"})
+
+        # two hosts are used: the website (auth) and the api
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+
+        return session
+
+    def close(self) -> None:
+        self.session.close()
+
+    def _load_cached_credentials(self) -> bool:
+        """
+        returns:
+            True if both client_id and access_token were set from the credential
+            cache, False otherwise.
+        """
+        if self.credential_cache == None:
+            return False
+
+        credentials = self.credential_cache.get(self.credentials_cache_key)
+
+        if not isinstance(credentials, dict):
+            return False
+
+        client_id = credentials.get("client_id")
+        access_token = credentials.get("access_token")
+
+        if not client_id or not access_token:
+            return False
+
+        self.client_id = client_id
+        self.access_token = access_token
+
+        return True
+
+    def _store_credentials(self) -> None:
+        if self.credential_cache == None:
+            return
+
+        self.credential_cache.set(
+            self.credentials_cache_key,
+            self.get_credentials(),
+            ttl=self.credentials_ttl,
+        )
+
+    def get_credentials(self) -> Dict[str, str]:
+        """
+        returns:
+            The current client_id and access_token, as accepted by the credentials
+            argument of another ApiConnector.
+        """
+        return {"client_id": self.client_id, "access_token": self.access_token}
+
+    def refresh_credentials(self) -> None:
+        """
+        Should be called when the api rejects the current access_token (401).
+
+        Logs in again with the current client_id and, if that fails, fetches a new
+        client_id as well. The credential cache is updated with the new values.
+        """
+        if self.credential_cache != None:
+            self.credential_cache.delete(self.credentials_cache_key)
+
+        try:
+            self._set_access_token()
+        except ApiConnectorException:
+            self._set_client_id()
+            self._set_access_token()
+
+        self._store_credentials()
 
     def _set_client_id(self) -> None:
         """
         sets the client id for this ApiConnector session
         """
-        self.client_id = self._fetch_client_id()
+        with METRICS.time("fetch_client_id"):
+            self.client_id = self._fetch_client_id()
 
     def _fetch_client_id(self) -> str:
         """
         Fetches (from the base_url html) the client_id and sets it
         in the current ApiConnector Session.
         """
-        base_url = "https://www.viacaocometa.com.br/"
-        response = requests.get(base_url)
+        base_url = self.site_url
+        response = self.session.get(base_url, timeout=self.timeout)
         soup = BeautifulSoup(markup=response.text)
 
         id = soup.find(id="clientId")
@@ -60,7 +231,8 @@ class ApiConnector:
         """
         sets the client id for this ApiConnector session
         """
-        self.access_token = self._fetch_access_token()
+        with METRICS.time("fetch_access_token"):
+            self.access_token = self._fetch_access_token()
 
     def _fetch_access_token(self) -> str:
         """
@@ -72,9 +244,9 @@ class ApiConnector:
         viacaocometa.com.br website.
         """
 
-        base_url = "https://www.viacaocometa.com.br/content/jca/cometa/pt-br/jcr:content.authorization.json?clear=1"
+        base_url = f"{self.site_url}content/jca/cometa/pt-br/jcr:content.authorization.json?clear=1"
 
-        response = requests.get(base_url, timeout=15)
+        response = self.session.get(base_url, timeout=self.timeout)
 
         if response.status_code != 200:
             raise ApiConnectorException(
@@ -103,7 +275,7 @@ class ApiConnector:
 
             api_login_url = f"{self.api_url}oauth/v3/login"
 
-            response = requests.post(
+            response = self.session.post(
                 api_login_url,
                 headers={
                     "Authorization": authId,
@@ -111,6 +283,7 @@ class ApiConnector:
                     "Content-Type": "application/json",
                 },
                 data=json.dumps({"grant_type": "client_credentials"}),
+                timeout=self.timeout,
             )
 
             json_body_login = json.loads(response.text)
@@ -128,19 +301,28 @@ class ApiConnector:
         except Exception as e:
             raise ApiConnectorException(f"Could not fetch access token -> {repr(e)}")
 
+    @timed("set_locales_info")
     def set_locales_info(self) -> None:
         """
         SHOULD BE CALLED BEFORE get_locale_id();
 
-        Sets the map of locations based on the api response.
+        Sets the map of locations based on the api response (or on the locales cache,
+        when one is set and still fresh) and indexes it for get_locale_id.
         """
-        response = requests.get(
-            f"{self.api_url}place/v1/searchOrigin",
-            headers={
-                "Client_id": self.client_id,
-                "Access_token": self.access_token,
-            },
-        )
+        if self.locales_cache != None:
+            cached_locales = self.locales_cache.get(self.locales_cache_key)
+
+            if isinstance(cached_locales, list):
+                self.locales_info = cached_locales
+                self._index_locales()
+                return
+
+        response = self._fetch_locales()
+
+        if response.status_code == 401:
+            # cached credentials may have been revoked before their expiry
+            self.refresh_credentials()
+            response = self._fetch_locales()
 
         if response.status_code != 200:
             raise ApiConnectorException(
@@ -159,23 +341,42 @@ class ApiConnector:
                 "The API response is not propertly formatted. The code needs refactoring."
             )
 
-    def get_locale_id(self, locale: str) -> int:
-        """
-        returns:
-            The integer id of the locale:str passed.
+        self._index_locales()
 
-        args:
-            locale: str -> Should be a string with the name exactly mathing those on the
-            api locales_info.
+        if self.locales_cache != None:
+            self.locales_cache.set(
+                self.locales_cache_key, self.locales_info, ttl=self.locales_ttl
+            )
 
-        ALERT: before calling it, the set_locales_info should be called at least once.
+    def _fetch_locales(self) -> requests.Response:
+        return self.session.get(
+            f"{self.api_url}place/v1/searchOrigin",
+            headers={
+                "Client_id": self.client_id,
+                "Access_token": self.access_token,
+            },
+            timeout=self.timeout,
+        )
+
+    def _index_locales(self) -> None:
         """
-        if self.locales_info == None:
+        Validates the locales_info once and builds the lookup tables used by
+        get_locale_id: the exact city name, its accent/case folded form and its
+        canonical key (see canonical_locale_key).
+
+        Canonical keys shared by more than one locale id are left out, since they
+        cannot be resolved without guessing.
+        """
+        if not isinstance(self.locales_info, list):
             raise ApiConnectorException(
-                "Set_locales_info should be called before this function."
-                "No locale id could be found"
+                "The current list of locales/info is invalid -> "
+                f"{self.locales_info} <- \n please, set a proper one."
             )
 
+        exact: Dict[str, int] = {}
+        folded: Dict[str, int] = {}
+        canonical: Dict[str, int | None] = {}
+
         for locale_info in self.locales_info:
             locale_id = locale_info.get("id")
             city = locale_info.get("city")
@@ -186,8 +387,56 @@ class ApiConnector:
                     f"{self.locales_info} <- \n please, set a proper one."
                 )
 
-            if locale_info.get("city") == locale:
-                return locale_id
+            # the first match wins, as in the former linear scan
+            exact.setdefault(city, locale_id)
+            folded.setdefault(fold_locale_name(city), locale_id)
+
+            key = canonical_locale_key(city)
+            if key in canonical and canonical[key] != locale_id:
+                canonical[key] = None
+            else:
+                canonical[key] = locale_id
+
+        self._locales_index = {
+            "exact": exact,
+            "folded": folded,
+            "canonical": canonical,
+        }
+        self._indexed_locales = self.locales_info
+
+    def get_locale_id(self, locale: str) -> int | None:
+        """
+        returns:
+            The integer id of the locale:str passed, or None if no locale matches.
+
+        args:
+            locale: str -> The name of the locale. Names exactly matching those on the
+            api locales_info are preferred; otherwise the accent/case folded name and,
+            at last, the canonical key are tried, so "São Paulo (Rod. Tietê)",
+            "SAO PAULO (TIETE) - SP" and "São Paulo (Rod. Tietê) (SP)" all resolve to
+            the same id.
+
+        ALERT: before calling it, the set_locales_info should be called at least once.
+        """
+        if self.locales_info == None:
+            raise ApiConnectorException(
+                "Set_locales_info should be called before this function."
+                "No locale id could be found"
+            )
+
+        # locales_info may have been replaced directly, without set_locales_info
+        if self._indexed_locales is not self.locales_info:
+            self._index_locales()
+
+        locale_id = self._locales_index["exact"].get(locale)
+        if locale_id != None:
+            return locale_id
+
+        locale_id = self._locales_index["folded"].get(fold_locale_name(locale))
+        if locale_id != None:
+            return locale_id
+
+        return self._locales_index["canonical"].get(canonical_locale_key(locale))
 
     def _prepare_base_api_request(self) -> requests.PreparedRequest:
         """
@@ -255,6 +504,54 @@ class ApiConnector:
         except Exception as e:
             raise ApiConnectorException(f"Could not prepare request -> {repr(e)} <-")
 
+    def _send_route_request(
+        self, origin_id: int, destination_id: int, departure_date: str | datetime.date
+    ) -> requests.Response:
+        prepared_req = self.prepare_route_request(
+            origin_id=origin_id,
+            destination_id=destination_id,
+            departure_date=departure_date,
+        )
+
+        route = f"{origin_id}-{destination_id}"
+        # the same environment (proxies, CA bundle) as the session.get/post calls
+        settings = self.session.merge_environment_settings(
+            prepared_req.url, {}, None, None, None
+        )
+
+        with METRICS.time("get_routes", route=route) as extra:
+            if self.retry_policy != None:
+                response = self.retry_policy.send(
+                    self.session, prepared_req, timeout=self.timeout, **settings
+                )
+            else:
+                response = self.session.send(
+                    prepared_req, timeout=self.timeout, **settings
+                )
+
+            extra["status"] = response.status_code
+            extra["bytes"] = len(response.content)
+
+        record_response(route, response.status_code, len(response.content))
+
+        return response
+
+    def _get_routes_response(
+        self, origin_id: int, destination_id: int, departure_date: str | datetime.date
+    ) -> requests.Response:
+        response = self._send_route_request(origin_id, destination_id, departure_date)
+
+        if response.status_code == 401:
+            self.refresh_credentials()
+            response = self._send_route_request(
+                origin_id, destination_id, departure_date
+            )
+
+        if response.status_code != 200:
+            raise ApiConnectorException(f"Could not fetch routes -> {response.text} <-")
+
+        return response
+
     def get_routes(
         self, origin_id: int, destination_id: int, departure_date: str | datetime.date
     ) -> List[Dict[str, Any]]:
@@ -272,23 +569,10 @@ class ApiConnector:
 
             departure_date: str -> a string-date formatted as YYYY-MM-DD
         """
-        prepared_req = self.prepare_route_request(
-            origin_id=origin_id,
-            destination_id=destination_id,
-            departure_date=departure_date,
-        )
-
-        session = requests.Session()
-
-        response = session.send(prepared_req)
-
-        session.close()
-
-        if response.status_code != 200:
-            raise ApiConnectorException(f"Could not fetch routes -> {response.text} <-")
+        response = self._get_routes_response(origin_id, destination_id, departure_date)
 
         try:
-            json_body = json.loads(response.text)
+            json_body = json.loads(response.content)
             assert json_body.get("success")
 
             result: Dict[str, Any] = json_body.get("result")
@@ -305,3 +589,24 @@ class ApiConnector:
             )
 
         return services
+
+    def get_services(
+        self, origin_id: int, destination_id: int, departure_date: str | datetime.date
+    ) -> List[Service]:
+        """
+        Same as get_routes, but validating and parsing the body in a single pass
+        into compact service_record.Service records (see service_record.py), which
+        take a fraction of the memory of the api dicts.
+        """
+        response = self._get_routes_response(origin_id, destination_id, departure_date)
+        record = parse_routes(response.content)
+
+        try:
+            services = record["result"]["servicesList"]
+            assert isinstance(services, list)
+        except (KeyError, TypeError, AssertionError):
+            raise ApiConnectorException(
+                "The response is not propertly formatted. The code needs refatorization"
+            )
+
+        return services
@@ -0,0 +1,206 @@
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import tempfile
+import subprocess
+from typing import Any, Dict, List
+from mock_api import MockJcatlmApi
+
+
+# every day of the plan adds one request per challenge trip
+ROUTES_PER_DAY = 10
+
+
+def percentile(values: List[float], percent: float) -> float:
+    """
+    returns:
+        The nearest-rank percentile of values (0 if there are none).
+    """
+    if not values:
+        return 0.0
+
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, round(percent / 100 * len(ordered)) - 1))
+
+    return ordered[rank]
+
+
+def run_worker(argv: List[str], result_file: str) -> None:
+    """
+    Runs crawl_from_api.main in this process, recording the latency of every
+    getRoutes response, and writes the measures to result_file.
+    """
+    import crawl_from_api
+
+    latencies: List[float] = []
+    results: List[int] = []
+    write_response = crawl_from_api.write_response
+    write_result = crawl_from_api.write_result
+
+    def timed_write_response(trip, response, *args, **kwargs) -> bool:
+        # elapsed: from sending the request until its headers were parsed
+        latencies.append(response.elapsed.total_seconds())
+        return write_response(trip, response, *args, **kwargs)
+
+    def counted_write_result(trip, status_code, *args, **kwargs) -> None:
+        # every response (of any process) is written through write_result
+        results.append(status_code)
+        return write_result(trip, status_code, *args, **kwargs)
+
+    crawl_from_api.write_response = timed_write_response
+    crawl_from_api.write_result = counted_write_result
+
+    # the crawler prints a line per request, which would only measure the terminal
+    with open(os.devnull, "w") as devnull:
+        stdout = sys.stdout
+        sys.stdout = devnull
+        started = time.perf_counter()
+        try:
+            crawl_from_api.main(argv)
+        finally:
+            sys.stdout = stdout
+        wall_time = time.perf_counter() - started
+
+    with open(result_file, "w") as file:
+        file.write(
+            json.dumps(
+                {
+                    "requests": len(results),
+                    "wall_time": wall_time,
+                    "latencies": latencies,
+                    # kilobytes on linux; the largest of this process and its
+                    # crawl workers, if any
+                    "peak_rss_kb": max(
+                        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+                    ),
+                }
+            )
+        )
+
+
+def benchmark(
+    mock: MockJcatlmApi,
+    routes: int,
+    concurrency: int,
+    workdir: str,
+    processes: int = 1,
+) -> Dict[str, Any]:
+    """
+    returns:
+        The throughput, latency percentiles and peak rss of a crawl_from_api run of
+        (about) routes requests against the mock api, run in a fresh process.
+    """
+    days = max(1, routes // ROUTES_PER_DAY)
+    result_file = os.path.join(workdir, f"bench-{routes}.json")
+
+    crawl_argv = [
+        "--days",
+        str(days),
+        "--concurrency",
+        str(concurrency),
+        "--processes",
+        str(processes),
+        "--api-url",
+        mock.url,
+        "--site-url",
+        mock.url,
+        "--no-credentials-cache",
+        "--no-locales-cache",
+        "--output-format",
+        "ndjson",
+        "--output",
+        os.path.join(workdir, f"result-{routes}.ndjson"),
+        "--invalid-output",
+        os.path.join(workdir, f"invalid-{routes}.ndjson"),
+        "--journal",
+        os.path.join(workdir, f"journal-{routes}.ndjson"),
+    ]
+
+    subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--worker", result_file, "--"]
+        + crawl_argv,
+        check=True,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+
+    with open(result_file, "r") as file:
+        measures = json.loads(file.read())
+
+    latencies = measures["latencies"]
+
+    return {
+        "routes": measures["requests"],
+        "wall_time_s": round(measures["wall_time"], 3),
+        "requests_per_s": round(measures["requests"] / measures["wall_time"], 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "peak_rss_mb": round(measures["peak_rss_kb"] / 1024, 1),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Benchmarks crawl_from_api.main against a local mock jcatlm api."
+    )
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[10, 1000, 10000],
+        help="number of routes of each run (default: 10 1000 10000)",
+    )
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=1,
+        help="crawl_from_api worker processes (latencies are only measured with 1)",
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.02, help="mock latency in seconds"
+    )
+    parser.add_argument(
+        "--jitter", type=float, default=0.01, help="mock extra random latency"
+    )
+    parser.add_argument(
+        "--error-rate", type=float, default=0.0, help="fraction of mock 503s"
+    )
+    parser.add_argument(
+        "--json", default=None, help="also writes the report to this file"
+    )
+    parser.add_argument("--worker", default=None, help=argparse.SUPPRESS)
+    args, crawl_argv = parser.parse_known_args()
+
+    if args.worker != None:
+        run_worker([arg for arg in crawl_argv if arg != "--"], args.worker)
+        return
+
+    report = []
+
+    with MockJcatlmApi(
+        latency=args.latency, jitter=args.jitter, error_rate=args.error_rate
+    ) as mock, tempfile.TemporaryDirectory() as workdir:
+        for routes in args.sizes:
+            result = benchmark(
+                mock, routes, args.concurrency, workdir, processes=args.processes
+            )
+            report += [result]
+            print(
+                f"{result['routes']:>6} routes | {result['wall_time_s']:>8} s | "
+                f"{result['requests_per_s']:>8} req/s | p50 {result['p50_ms']} ms | "
+                f"p95 {result['p95_ms']} ms | p99 {result['p99_ms']} ms | "
+                f"peak rss {result['peak_rss_mb']} MB"
+            )
+
+    if args.json != None:
+        with open(args.json, "w") as file:
+            file.write(json.dumps(report))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+import queue
+import logging
+import threading
+from datetime import datetime
+from typing import Any, Callable, Iterable, List, Tuple
+from selenium_crawler import Crawler
+
+
+class BrowserPoolException(Exception): ...
+
+
+# (departure, arrival, departure_date)
+Job = Tuple[str, str, datetime]
+
+
+class BrowserPool:
+    """
+    Crawls (departure, arrival, date) jobs with workers headless browsers at once.
+
+    Every worker is a thread owning its own driver, pulling jobs from a shared
+    queue and crawling each of them with a Crawler of its own, whose results are
+    then merged into crawler.results. Drivers are quit and replaced after
+    pages_per_driver jobs (and after any failed one) so the browsers memory does
+    not keep growing through the crawl.
+
+    args:
+        crawler: the Crawler whose results receive every job crawled
+        on_done: called (under the pool lock) after the results of a job are
+        merged, with the job and the results of that job
+        driver_factory: returns a new driver (default: crawler.get_driver(headless))
+
+    ALERT: every worker runs a whole browser, so workers should not go much
+    beyond the number of cores available.
+    """
+
+    def __init__(
+        self,
+        crawler: Crawler,
+        workers: int = 2,
+        pages_per_driver: int = 25,
+        headless: bool = True,
+        on_done: Callable[[Job, List[Any]], None] | None = None,
+        driver_factory: Callable[[], Any] | None = None,
+    ) -> None:
+        if workers < 1 or pages_per_driver < 1:
+            raise BrowserPoolException(
+                "Both workers and pages_per_driver should be at least 1."
+            )
+
+        self.crawler = crawler
+        self.workers = workers
+        self.pages_per_driver = pages_per_driver
+        self.on_done = on_done
+        self.driver_factory = driver_factory or (
+            lambda: crawler.get_driver(headless=headless)
+        )
+
+        self.lock = threading.Lock()
+        self.failed: List[Tuple[Job, str]] = []
+        self.drivers_started = 0
+
+    def run(self, jobs: Iterable[Job]) -> List[Tuple[Job, str]]:
+        """
+        Crawls every job, returning once all of them are done.
+
+        returns:
+            The jobs that failed, along with their error.
+        """
+        jobs_queue: queue.Queue = queue.Queue()
+
+        for job in jobs:
+            jobs_queue.put(job)
+
+        for _ in range(self.workers):
+            jobs_queue.put(None)  # one stop sign per worker
+
+        threads = [
+            threading.Thread(target=self._work, args=(jobs_queue,), daemon=True)
+            for _ in range(self.workers)
+        ]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        return self.failed
+
+    def _new_driver(self) -> Any:
+        driver = self.driver_factory()
+
+        with self.lock:
+            self.drivers_started += 1
+
+        return driver
+
+    def _work(self, jobs_queue: queue.Queue) -> None:
+        driver = None
+        pages = 0
+
+        try:
+            while True:
+                job = jobs_queue.get()
+
+                if job == None:
+                    return
+
+                if driver != None and pages >= self.pages_per_driver:
+                    _quit(driver)
+                    driver = None
+
+                if driver == None:
+                    try:
+                        driver = self._new_driver()
+                    except Exception as e:
+                        self._fail(job, e)
+                        continue
+                    pages = 0
+
+                departure, arrival, departure_date = job
+                worker_crawler = Crawler(
+                    self.crawler.base_url,
+                    wait_timeout=self.crawler.wait_timeout,
+                    mode=self.crawler.mode,
+                    pages_dir=self.crawler.pages_dir,
+                )
+                pages += 1
+
+                try:
+                    worker_crawler.crawl_trip(
+                        driver=driver,
+                        departure=departure,
+                        arrival=arrival,
+                        departure_date=departure_date,
+                    )
+                except Exception as e:
+                    with self.lock:
+                        self.crawler.wait_timings += worker_crawler.wait_timings
+                    self._fail(job, e)
+                    # the page may be in any state, start over with a fresh browser
+                    _quit(driver)
+                    driver = None
+                    continue
+
+                with self.lock:
+                    self.crawler.results += worker_crawler.results
+                    self.crawler.wait_timings += worker_crawler.wait_timings
+                    if self.on_done != None:
+                        self.on_done(job, worker_crawler.results)
+        finally:
+            if driver != None:
+                _quit(driver)
+
+    def _fail(self, job: Job, error: Exception) -> None:
+        logging.warning(f"Could not crawl {job} -> {error!r}")
+
+        with self.lock:
+            self.failed += [(job, repr(error))]
+
+
+def _quit(driver: Any) -> None:
+    try:
+        driver.quit()
+    except Exception as e:
+        logging.warning(f"Could not quit the driver -> {e!r}")
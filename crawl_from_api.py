@@ -1,9 +1,26 @@
+import argparse
 import datetime
+from collections import deque
 import requests
 import logging
 import json
-from typing import Dict, List
+from typing import Any, Callable, Deque, Dict, List, Set, Tuple
 from request_generator import ApiRoutesRequestGenerator
+from route_fetcher import FetchResult, RouteFetcher
+from response_cache import ResponseCache
+from file_cache import FileCache
+from retry import RetryBudget, RetryPolicy
+from crawl_journal import CrawlJournal
+from snapshot_diff import SnapshotDiffer
+from service_store import ServiceStore
+from fare_timeseries import FareTimeSeries
+from crawl_planner import CrawlPlanner, all_routes
+from service_record import parse_routes, to_json
+from metrics import METRICS, log_to_file, timed
+from crawl_output import JsonArrayWriter, NdjsonWriter, collect_at, open_writer
+
+# whatever takes the valid records of the crawl through observe_record
+Observer = SnapshotDiffer | ServiceStore | CrawlPlanner | FareTimeSeries
 
 challenge_list_of_trips = [
     {"São Paulo (Rod. Tietê)": "Belo Horizonte"},
@@ -19,60 +36,570 @@ challenge_list_of_trips = [
 ]
 
 
-def validate_api_response(response: requests.Response) -> Dict[str, bool | str]:
+@timed("validate_api_response")
+def parse_api_response(
+    response: requests.Response,
+) -> Tuple[Dict[str, bool | str], Dict[str, Any] | None]:
     """
-    params:
-        response: a request.Response object from a api call defined in the
-        ApiConnector. More spefically, it validates if a getRoutes called
-        was succesfull.
+    Validates a getRoutes response and parses its body, in a single json pass
+    (see service_record.parse_routes).
 
     returns:
-        {
-        "success": (True|False),
-        "msg": (string with message),
-        }
+        The validation, as validate_api_response, and the parsed body (with its
+        services as service_record.Service) if the call was succesfull.
     """
 
     if response.status_code == 401:
-        return {"success": False, "msg": "Could not authenticate to the endpoint"}
+        return {
+            "success": False,
+            "msg": "Could not authenticate to the endpoint",
+        }, None
 
     if response.status_code == 200:
-        try:
-            json_body = json.loads(response.text)
-            assert json_body.get("success") == True
-            return {"success": True, "msg": ""}
+        record = parse_routes(response.content)
 
-        except:
+        if record == None:
             return {
                 "success": False,
                 "msg": "Response's body could not be json converted or "
                 "it did not got the expected params",
-            }
+            }, None
+
+        return {"success": True, "msg": ""}, record
 
     else:
         return {
             "success": False,
             "msg": f"Could not reach end point.\n STATUS: {response.status_code}\n"
             f"BODY: {response.text}",
+        }, None
+
+
+def validate_api_response(response: requests.Response) -> Dict[str, bool | str]:
+    """
+    params:
+        response: a request.Response object from a api call defined in the
+        ApiConnector. More spefically, it validates if a getRoutes called
+        was succesfull.
+
+    returns:
+        {
+        "success": (True|False),
+        "msg": (string with message),
         }
+    """
+    return parse_api_response(response)[0]
+
+
+def write_response(
+    trip: Dict[str, Any],
+    response: requests.Response,
+    valid_writer: NdjsonWriter | JsonArrayWriter,
+    invalid_writer: NdjsonWriter | JsonArrayWriter,
+    journal: CrawlJournal | None = None,
+    observers: List[Observer] = [],
+) -> bool:
+    """
+    Validates a getRoutes response and writes it right away to the proper writer,
+    so the response can be released as soon as it completes.
+
+    returns:
+        True if the response was valid.
+    """
+    _, record = parse_api_response(response)
+
+    if record != None:
+        record["collect_at"] = collect_at()
+
+    write_result(
+        trip,
+        response.status_code,
+        record,
+        response.text if record == None else None,
+        valid_writer,
+        invalid_writer,
+        journal,
+        observers,
+    )
+    response.close()
+
+    return record != None
+
+
+def write_error(
+    trip: Dict[str, Any],
+    error: requests.RequestException,
+    valid_writer: NdjsonWriter | JsonArrayWriter,
+    invalid_writer: NdjsonWriter | JsonArrayWriter,
+    journal: CrawlJournal | None = None,
+    observers: List[Observer] = [],
+) -> bool:
+    """
+    Writes a getRoutes call that failed without a response (timeout, connection
+    reset...) as an invalid result, with no status code.
+
+    returns:
+        False, as write_response does for invalid responses.
+    """
+    write_result(
+        trip,
+        None,
+        None,
+        f"{type(error).__name__}: {error}",
+        valid_writer,
+        invalid_writer,
+        journal,
+        observers,
+    )
+
+    return False
+
+
+def write_result(
+    trip: Dict[str, Any],
+    status_code: int | None,
+    record: Dict[str, Any] | None,
+    body: str | None,
+    valid_writer: NdjsonWriter | JsonArrayWriter,
+    invalid_writer: NdjsonWriter | JsonArrayWriter,
+    journal: CrawlJournal | None = None,
+    observers: List[Observer] = [],
+) -> None:
+    """
+    Writes an already validated getRoutes result: the parsed record (with its
+    collect_at) when the call was valid, or else the status code (None when no
+    response came back) and raw body (or error).
+
+    Valid records are handed to every observer (snapshot differ, sqlite store,
+    planner, fare time series) and then marked as done in the journal (when
+    given). Invalid ones are reported to the planner, through observe_failure.
+    """
+    if record != None:
+        with METRICS.time("write_output"):
+            valid_writer.write(record)
+
+        for observer in observers:
+            observer.observe_record(record)
+
+        if journal != None:
+            journal.mark_done(trip.get("from"), trip.get("to"), trip.get("departureDate"))
+
+        return
+
+    # gives a friendly warning to all the requests
+    # that did not completed normally
+    logging.warning(f"Invalid call: STATUS: \n{status_code} \n" f"BODY: {body}")
+
+    # so the planner backs the unit off instead of planning it first again
+    for observer in observers:
+        if isinstance(observer, CrawlPlanner):
+            observer.observe_failure(trip)
+
+    with METRICS.time("write_output"):
+        invalid_writer.write(
+            {
+                "trip": trip,
+                "response.body": body,
+                "response.code": status_code,
+                "collect_at": collect_at(),
+            }
+        )
+
+
+def challenge_routes(req_gen: ApiRoutesRequestGenerator) -> List[Tuple[int, int]]:
+    """
+    returns:
+        The (origin id, destination id) of every trip of challenge_list_of_trips.
+    """
+    return [
+        (req_gen.api.get_locale_id(departure), req_gen.api.get_locale_id(arrival))
+        for trip in challenge_list_of_trips
+        for departure, arrival in trip.items()
+    ]
+
+
+def fetch_trips(
+    req_gen: ApiRoutesRequestGenerator,
+    fetcher: RouteFetcher,
+    trips: List[Dict[str, Any]],
+    handle_response: Callable[[Dict[str, Any], requests.Response], Any],
+    handle_error: Callable[[Dict[str, Any], requests.RequestException], Any],
+) -> None:
+    """
+    Fetches the getRoutes of every trip, handing each (trip, response) to
+    handle_response as it completes, and each (trip, error) of the calls that
+    failed without a response to handle_error.
+
+    Requests are prepared lazily, right before being sent, so they always carry
+    the current credentials and only a handful exist at once. A trip rejected
+    with a 401 is sent once more, after logging in again.
+    """
+    # trips rejected with a 401, to be sent once more with fresh credentials
+    retry_queue: Deque[Dict[str, Any]] = deque()
+    retried: Set[Tuple[str, str, str]] = set()
+
+    def handle(trip: Dict[str, Any], response: FetchResult) -> None:
+        if isinstance(response, requests.RequestException):
+            handle_error(trip, response)
+            return
+
+        key = CrawlJournal.key(
+            trip.get("from"), trip.get("to"), trip.get("departureDate")
+        )
 
+        if response.status_code == 401 and key not in retried:
+            # the (possibly cached) access token was rejected: log in again, unless
+            # the request went out before a refresh that already happened.
+            sent_token = response.request.headers.get("Access_token")
+
+            if sent_token == req_gen.api.access_token:
+                print("Access token rejected. Refreshing credentials.")
+                req_gen.api.refresh_credentials()
+
+            retried.add(key)
+            retry_queue.append(trip)
+            response.close()
+            return
+
+        handle_response(trip, response)
+
+    jobs = req_gen.iter_requests(trips=trips, retry_queue=retry_queue)
+
+    for trip, response in fetcher.fetch_all(jobs):
+        handle(trip, response)
+
+    # 401s of the last requests in flight arrive once the plan is exhausted
+    while retry_queue:
+        jobs = req_gen.iter_requests(trips=[], retry_queue=retry_queue)
+
+        for trip, response in fetcher.fetch_all(jobs):
+            handle(trip, response)
+
+
+def parse_args(argv: List[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Crawls the challenge routes from the jcatlm api."
+    )
+    parser.add_argument(
+        "--days",
+        type=int,
+        default=8,
+        help="number of departure dates crawled, starting today (default: 8)",
+    )
+    parser.add_argument(
+        "--routes",
+        choices=["challenge", "all"],
+        default="challenge",
+        help="challenge crawls challenge_list_of_trips; all crawls every pair of "
+        "searchOrigin locales (default: challenge)",
+    )
+    parser.add_argument(
+        "--plan",
+        choices=["fixed", "priority"],
+        default="fixed",
+        help="fixed crawls every route on every day; priority crawls only the due "
+        "(route, day) units, most overdue first, as scheduled by the planner "
+        "(default: fixed)",
+    )
+    parser.add_argument(
+        "--budget",
+        type=int,
+        default=None,
+        help="maximum number of (route, day) units planned by priority",
+    )
+    parser.add_argument(
+        "--planner-state",
+        default="./.crawl_planner_state.json",
+        help="when each unit was last crawled and how volatile each route is, for "
+        "the priority plan (default: ./.crawl_planner_state.json)",
+    )
+    parser.add_argument(
+        "--min-refresh",
+        type=float,
+        default=3600,
+        help="seconds a crawl of today's departures stays fresh, in the priority "
+        "plan (default: 3600)",
+    )
+    parser.add_argument(
+        "--max-refresh",
+        type=float,
+        default=86400,
+        help="seconds after which any unit is due again, in the priority plan "
+        "(default: 86400)",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=8,
+        help="maximum number of getRoutes requests in flight at once (default: 8)",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=1,
+        help="worker processes sharing the plan (and the login); each one keeps "
+        "--concurrency requests in flight and parses its own responses (default: 1)",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=50,
+        help="trips handed to a worker process at a time (default: 50)",
+    )
+    parser.add_argument(
+        "--pool-size",
+        type=int,
+        default=None,
+        help="keep-alive connections kept per host (default: --concurrency)",
+    )
+    parser.add_argument(
+        "--connect-timeout",
+        type=float,
+        default=5,
+        help="seconds to wait for a connection to the api (default: 5)",
+    )
+    parser.add_argument(
+        "--read-timeout",
+        type=float,
+        default=30,
+        help="seconds to wait for an api response (default: 30)",
+    )
+    parser.add_argument(
+        "--api-url",
+        default="https://api.jcatlm.com.br/",
+        help="base url of the jcatlm api (default: https://api.jcatlm.com.br/)",
+    )
+    parser.add_argument(
+        "--site-url",
+        default="https://www.viacaocometa.com.br/",
+        help="base url of the website used to authenticate "
+        "(default: https://www.viacaocometa.com.br/)",
+    )
+    parser.add_argument(
+        "--credentials-cache",
+        default="./.api_credentials.json",
+        help="file where the api credentials are kept between runs "
+        "(default: ./.api_credentials.json)",
+    )
+    parser.add_argument(
+        "--no-credentials-cache",
+        action="store_true",
+        help="always authenticate from scratch",
+    )
+    parser.add_argument(
+        "--locales-cache",
+        default="./.api_locales.json",
+        help="file where the searchOrigin locales are kept between runs "
+        "(default: ./.api_locales.json)",
+    )
+    parser.add_argument(
+        "--no-locales-cache",
+        action="store_true",
+        help="always fetch the locales from the api",
+    )
+    parser.add_argument(
+        "--output-format",
+        choices=["json", "ndjson"],
+        default="json",
+        help="json writes a single array (as result_api.json always was); ndjson "
+        "writes one record per line and survives interrupted runs (default: json)",
+    )
+    parser.add_argument(
+        "--compression",
+        choices=["gzip", "zstd"],
+        default=None,
+        help="compresses the output files (zstd needs the zstandard package)",
+    )
+    parser.add_argument(
+        "--output",
+        default=None,
+        help="file for the valid responses (default: ./result_api.<format>)",
+    )
+    parser.add_argument(
+        "--invalid-output",
+        default=None,
+        help="file for the failed calls (default: ./result_api_invalid.<format>)",
+    )
+    parser.add_argument(
+        "--max-attempts",
+        type=int,
+        default=4,
+        help="attempts per request on transient failures (429, 5xx, connection "
+        "errors), 1 disables retries (default: 4)",
+    )
+    parser.add_argument(
+        "--retry-budget",
+        type=int,
+        default=200,
+        help="maximum number of retries for the whole run (default: 200)",
+    )
+    parser.add_argument(
+        "--response-cache-ttl",
+        type=float,
+        default=0,
+        help="seconds a getRoutes response is reused for identical requests, which "
+        "are also sent only once when in flight together (default: 0, disabled)",
+    )
+    parser.add_argument(
+        "--response-cache-size",
+        type=int,
+        default=1024,
+        help="responses kept in memory by the response cache (default: 1024)",
+    )
+    parser.add_argument(
+        "--response-cache-disk-size",
+        type=int,
+        default=16384,
+        help="responses kept in --response-cache-dir, the oldest being removed "
+        "first (default: 16384)",
+    )
+    parser.add_argument(
+        "--response-cache-dir",
+        default=None,
+        help="also keeps the cached responses in this directory, so they survive "
+        "between runs",
+    )
+    parser.add_argument(
+        "--journal",
+        default="./.crawl_api_journal.ndjson",
+        help="file recording the (origin, destination, date) already crawled "
+        "(default: ./.crawl_api_journal.ndjson)",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="skips what the journal records as done and appends to the outputs "
+        "instead of overwriting them",
+    )
+    parser.add_argument(
+        "--diff-state",
+        default=None,
+        help="enables the snapshot-diff mode: fingerprints of the previous crawl "
+        "are read from (and the current ones saved to) this file",
+    )
+    parser.add_argument(
+        "--diff-output",
+        default="./result_api_delta.json",
+        help="where the inserted/changed/removed services are written in the "
+        "snapshot-diff mode (default: ./result_api_delta.json)",
+    )
+    parser.add_argument(
+        "--sqlite",
+        default=None,
+        help="also ingests the valid responses into this SQLite database",
+    )
+    parser.add_argument(
+        "--timeseries",
+        default=None,
+        help="also appends the fares of the valid responses to the fare history "
+        "kept in this directory (see fare_timeseries.py)",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        default=None,
+        help="writes the stage metrics in the Prometheus text format to this file "
+        "once the crawl ends",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=None,
+        help="serves the metrics at http://0.0.0.0:<port>/metrics during the crawl",
+    )
+    parser.add_argument(
+        "--metrics-log",
+        default=None,
+        help="writes a json line per timed stage (auth, locales, each getRoutes "
+        "call, validation, output) to this file",
+    )
+
+    return parser.parse_args(argv)
+
+
+def main(argv: List[str] | None = None) -> None:
+    args = parse_args(argv)
+
+    metrics_server = None
+    if args.metrics_port != None:
+        metrics_server = METRICS.serve(args.metrics_port)
+
+    if args.metrics_log != None:
+        log_to_file(args.metrics_log)
+
+    credential_cache = None
+    if not args.no_credentials_cache:
+        credential_cache = FileCache(args.credentials_cache)
+
+    locales_cache = None
+    if not args.no_locales_cache:
+        locales_cache = FileCache(args.locales_cache)
+
+    # shared by the api connector and the fetcher, so both spend the same budget
+    retry_policy = RetryPolicy(
+        max_attempts=args.max_attempts, budget=RetryBudget(args.retry_budget)
+    )
 
-def main() -> None:
     # ApiConnector interface initialization/auth
-    req_gen = ApiRoutesRequestGenerator()
+    req_gen = ApiRoutesRequestGenerator(
+        credential_cache=credential_cache,
+        locales_cache=locales_cache,
+        retry_policy=retry_policy,
+        pool_size=args.pool_size or args.concurrency,
+        timeout=(args.connect_timeout, args.read_timeout),
+        api_url=args.api_url,
+        site_url=args.site_url,
+    )
 
     date = datetime.datetime.now()
 
     print("Started crawling.")
 
-    # 7 days range.
-    for _ in range(0, 8):
-        req_gen.add_trips(
-            challenge_list_of_trips, departure_date=date.strftime("%Y-%m-%d")
+    if args.routes == "all":
+        routes = all_routes(req_gen.api.locales_info)
+    else:
+        routes = challenge_routes(req_gen)
+
+    planner = None
+
+    if args.plan == "priority":
+        planner = CrawlPlanner(
+            routes,
+            horizon_days=args.days,
+            min_interval=args.min_refresh,
+            max_interval=args.max_refresh,
+            state_path=args.planner_state,
         )
-        date = datetime.timedelta(days=1) + date
+        req_gen.trips = planner.plan(budget=args.budget)
 
-    print("Added all routes to the queue.")
+        print(f"Planned {len(req_gen.trips)} due routes by priority.")
+
+    else:
+        # 7 days range by default.
+        for _ in range(0, args.days):
+            req_gen.trips += [
+                {
+                    "from": origin,
+                    "to": destination,
+                    "departureDate": date.strftime("%Y-%m-%d"),
+                }
+                for origin, destination in routes
+            ]
+            date = datetime.timedelta(days=1) + date
+
+        print("Added all routes to the queue.")
+
+    journal = CrawlJournal(args.journal, resume=args.resume)
+
+    if args.resume:
+        planned = len(req_gen.trips)
+        req_gen.trips = [
+            trip
+            for trip in req_gen.trips
+            if not journal.is_done(
+                trip.get("from"), trip.get("to"), trip.get("departureDate")
+            )
+        ]
+        print(f"Resuming: {planned - len(req_gen.trips)} routes were already crawled.")
 
     # with open("./trips.json", "w") as file:
     #     try:
@@ -80,91 +607,148 @@ def main() -> None:
     #     except Exception as e:
     #         logging.warning(f"could not parse\n{req_gen.trips}")
 
-    # generates all of the requests
-    req_gen.generate_requests()
-
-    # start requests session to make all of the
-    # api calls.
-    session = requests.Session()
+    response_cache_args = None
+    if args.response_cache_ttl > 0:
+        response_cache_args = {
+            "ttl": args.response_cache_ttl,
+            "max_entries": args.response_cache_size,
+            "directory": args.response_cache_dir,
+            "max_disk_entries": args.response_cache_disk_size,
+        }
 
-    responses: List[requests.Response] = []
+    # the connector session is reused, so the connections warmed up by the
+    # authentication also serve the getRoutes calls.
+    fetcher = RouteFetcher(
+        max_in_flight=args.concurrency,
+        session=req_gen.api.session,
+        retry_policy=retry_policy,
+        timeout=req_gen.api.timeout,
+        response_cache=(
+            ResponseCache(**response_cache_args)
+            if response_cache_args != None
+            else None
+        ),
+    )
+
+    filepath_valid = args.output or f"./result_api.{args.output_format}"
+    filepath_invalid = (
+        args.invalid_output or f"./result_api_invalid.{args.output_format}"
+    )
+
+    valid_writer = open_writer(
+        filepath_valid,
+        args.output_format,
+        compression=args.compression,
+        append=args.resume,
+    )
+    invalid_writer = open_writer(
+        filepath_invalid,
+        args.output_format,
+        compression=args.compression,
+        append=args.resume,
+    )
+
+    observers: List[Observer] = []
+
+    if planner != None:
+        observers += [planner]
+
+    differ = None
+    if args.diff_state != None:
+        differ = SnapshotDiffer(args.diff_state)
+        observers += [differ]
+
+    store = None
+    if args.sqlite != None:
+        store = ServiceStore(args.sqlite)
+        observers += [store]
+
+    timeseries = None
+    if args.timeseries != None:
+        timeseries = FareTimeSeries(args.timeseries)
+        observers += [timeseries]
 
     print("Starting requests.")
 
-    for request in req_gen.requests:
-        responses += [session.send(request)]
+    def handle_response(trip: Dict[str, Any], response: requests.Response) -> None:
+        write_response(trip, response, valid_writer, invalid_writer, journal, observers)
         print("Completed another request.")
 
-    print("Finished requests")
-
-    session.close()
-
-    valid_responses: List[requests.Response] = []
-    invalid_responses: List[requests.Response] = []
-
-    print("Filtering responses")
-    for resp in responses:
-        is_valid_dict = validate_api_response(resp)
-
-        if is_valid_dict.get("success"):
-            valid_responses += [resp]
-            continue
+    def handle_error(trip: Dict[str, Any], error: requests.RequestException) -> None:
+        write_error(trip, error, valid_writer, invalid_writer, journal, observers)
+        print("Completed another request.")
 
-        # gives a friendly warning to all the requests
-        # that did not completed normally
-        invalid_responses += [resp]
-        logging.warning(
-            f"Invalid call: STATUS: \n{resp.status_code} \n" f"BODY: {resp.text}"
+    try:
+        if args.processes > 1:
+            # imported here, since the workers import this module themselves
+            from sharded_crawl import crawl_sharded
+
+            results = crawl_sharded(
+                req_gen.api,
+                req_gen.trips,
+                processes=args.processes,
+                concurrency=args.concurrency,
+                chunk_size=args.chunk_size,
+                max_attempts=args.max_attempts,
+                retry_budget=args.retry_budget,
+                response_cache=response_cache_args,
+            )
+
+            for trip, status_code, record, body in results:
+                write_result(
+                    trip,
+                    status_code,
+                    record,
+                    body,
+                    valid_writer,
+                    invalid_writer,
+                    journal,
+                    observers,
+                )
+                print("Completed another request.")
+
+        else:
+            fetch_trips(req_gen, fetcher, req_gen.trips, handle_response, handle_error)
+
+        print("Finished requests")
+
+    finally:
+        fetcher.close()
+        valid_writer.close()
+        invalid_writer.close()
+        journal.close()
+
+        if store != None:
+            store.close()
+
+        if timeseries != None:
+            timeseries.close()
+
+        if planner != None:
+            planner.save()
+
+        if args.metrics_file != None:
+            METRICS.write_prometheus(args.metrics_file)
+            print(f"The metrics have been written to {args.metrics_file}")
+
+        if metrics_server != None:
+            metrics_server.shutdown()
+
+    print(f"The output has been written to {valid_writer.path}")
+    print(f"The failed calls have been written to {invalid_writer.path}")
+
+    if differ != None:
+        delta = differ.finish()
+
+        with open(args.diff_output, "w") as file:
+            file.write(json.dumps(delta, default=to_json))
+
+        print(
+            f"Snapshot diff: {len(delta['inserted'])} inserted, "
+            f"{len(delta['changed'])} changed, {len(delta['removed'])} removed -> "
+            f"{args.diff_output}"
         )
 
-    output_valid = []
-    output_invalid = []
-
-    # stores the good and bad responses separately
-    for invalid_res in valid_responses:
-        trip = json.loads(invalid_res.text)
-        trip["collect_at"] = {
-            "timezone": "UTC",
-            "datetime": datetime.datetime.now(tz=datetime.timezone.utc).strftime(
-                "%Y-%m-%d %H:%M:%s"
-            ),
-        }
-        output_valid += [trip]
-
-    for invalid_res in invalid_responses:
-        trip = {
-            "response.body": invalid_res.text,
-            "response.code": invalid_res.status_code,
-        }
-        trip["collect_at"] = {
-            "timezone": "UTC",
-            "datetime": datetime.datetime.now(tz=datetime.timezone.utc).strftime(
-                "%Y-%m-%d %H:%M:%s"
-            ),
-        }
-        output_invalid += [trip]
-
-    filepath_valid = "./result_api.json"
-    filepath_invalid = "./result_api_invalid.json"
-
-    print("writing to response.json")
-    with open(filepath_valid, "w") as file:
-        try:
-            file.write(json.dumps(output_valid))
-        except Exception as e:
-            logging.warning(f"could not parse\n{repr(e)}")
-            file.write(str(output_valid))
-
-    print(f"The output has been written to {filepath_valid}")
-
-    print("writing to response_invalid.json")
-    with open(filepath_invalid, "w") as file:
-        try:
-            file.write(json.dumps(output_invalid))
-        except Exception as e:
-            logging.warning(f"could not parse\n{repr(e)}")
-            file.write(str(output_valid))
-
     print("Done.")
 
 
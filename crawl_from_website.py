@@ -1,7 +1,11 @@
+import os
+import argparse
 from datetime import datetime, timedelta
 import json
-from time import sleep
-from selenium_crawler import Crawler
+from typing import List
+from selenium_crawler import EXTRACTION_MODES, Crawler
+from crawl_journal import CrawlJournal
+from browser_pool import BrowserPool
 from selenium import webdriver
 
 base_url = "https://www.viacaocometa.com.br/"
@@ -20,13 +24,110 @@ challenge_list_of_trips = [
 ]
 
 
-def main() -> None:
+partial_results_path = "./results_webcrawl_partial.json"
+
+
+def parse_args(argv: List[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Crawls the challenge routes from the viacaocometa website."
+    )
+    parser.add_argument(
+        "--journal",
+        default="./.crawl_website_journal.ndjson",
+        help="file recording the (departure, arrival, date) already crawled "
+        "(default: ./.crawl_website_journal.ndjson)",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help=f"skips what the journal records as done, starting from the results "
+        f"saved in {partial_results_path}",
+    )
+    parser.add_argument(
+        "--wait-timeout",
+        type=float,
+        default=30,
+        help="seconds to wait for each element or result list to load (default: 30)",
+    )
+    parser.add_argument(
+        "--mode",
+        choices=EXTRACTION_MODES,
+        default="script",
+        help="how the services page is read: a WebDriver command per element (dom), "
+        "a single script round trip (script, the default) or the getRoutes json "
+        "captured from chrome's network log (network, same schema as the api)",
+    )
+    parser.add_argument(
+        "--save-pages",
+        default=None,
+        help="directory where the source of every results page is saved, to be "
+        "parsed offline with html_parser.py",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="headless browsers crawling at once (default: 1, a single visible "
+        "browser)",
+    )
+    parser.add_argument(
+        "--pages-per-driver",
+        type=int,
+        default=25,
+        help="searches after which a pool browser is replaced by a fresh one "
+        "(default: 25)",
+    )
+
+    return parser.parse_args(argv)
+
+
+def save_partial_results(results: list) -> None:
+    """
+    Saves the results collected so far, replacing the previous partial file
+    only once the new one is completely written.
+    """
+    tmp_path = f"{partial_results_path}.tmp"
+
+    with open(tmp_path, "w") as file:
+        file.write(json.dumps(results))
+
+    os.replace(tmp_path, partial_results_path)
+
+
+def print_wait_summary(crawler: Crawler) -> None:
+    """
+    Prints how long the page took to be ready, per kind of wait.
+    """
+    timings = {}
+
+    for name, seconds in crawler.wait_timings:
+        timings.setdefault(name, []).append(seconds)
+
+    for name, seconds in sorted(timings.items()):
+        print(
+            f"waited for {name}: {len(seconds)} times, mean "
+            f"{sum(seconds) / len(seconds):.2f}s, max {max(seconds):.2f}s"
+        )
+
+
+def main(argv: List[str] | None = None) -> None:
     """
     Crawls the data according to the challenge.
     """
-    crawler = Crawler(base_url)
+    args = parse_args(argv)
 
-    driver = crawler.get_driver()
+    crawler = Crawler(
+        base_url,
+        wait_timeout=args.wait_timeout,
+        mode=args.mode,
+        pages_dir=args.save_pages,
+    )
+
+    journal = CrawlJournal(args.journal, resume=args.resume)
+
+    if args.resume and os.path.exists(partial_results_path):
+        with open(partial_results_path, "r") as file:
+            crawler.results = json.loads(file.read())
 
     initial_date = datetime.now() + timedelta(days=1)
 
@@ -38,45 +139,118 @@ def main() -> None:
     for i in range(1, 7):
         dates += [initial_date + timedelta(days=i)]
 
+    if args.workers > 1:
+        try:
+            crawl_with_pool(crawler, journal, dates, args.workers, args.pages_per_driver)
+        finally:
+            journal.close()
+        return
+
+    driver = crawler.get_driver()
+
     try:
         for curr_date in dates:
             print(f"currently at date: {curr_date.strftime('%Y-%m-%d')}")
             _curr_date = curr_date
             for trip in challenge_list_of_trips:
                 print(f"currently at trip: {trip}")
-                driver.get(
-                    base_url
-                )  # ensure we are at the beggining of the page when start
-                sleep(2)  # waiting loading
+
+                if all(
+                    journal.is_done(departure, arrival, curr_date.strftime("%Y-%m-%d"))
+                    for departure, arrival in trip.items()
+                ):
+                    print(f"already crawled -> {trip}")
+                    continue
+
                 for departure, arrival in trip.items():
                     _curr_trip = {"dep": departure, "arr": arrival}
-                    crawler.search_for_trip(
+
+                    if journal.is_done(
+                        departure, arrival, curr_date.strftime("%Y-%m-%d")
+                    ):
+                        continue
+
+                    crawler.crawl_trip(
                         driver=driver,
                         departure=departure,
                         arrival=arrival,
-                        departure_date=_curr_date,
+                        departure_date=curr_date,
                     )
-                    sleep(5)  # waiting loading
-
-                    crawler.crawl_trips(driver=driver, departure_date=curr_date)
                     print(f"crawled -> {crawler.results}")
 
-                    sleep(5)  # waiting loading
+                    # results first, so a unit is never journaled without them
+                    save_partial_results(crawler.results)
+                    journal.mark_done(
+                        departure, arrival, curr_date.strftime("%Y-%m-%d")
+                    )
 
         with open("./results_webcrawl.json", "w") as file:
             file.write(json.dumps(crawler.results))
+        print_wait_summary(crawler)
         print("done")
 
     except Exception as e:
-        with open("./results_webcrawl_partial.json", "w") as file:
-            file.write(json.dumps(crawler.results))
+        save_partial_results(crawler.results)
 
         print(f"Could not complete -> {e}")
         print(
             f"Was at {_curr_date.strftime('%Y-%m-%d')} and at trip {_curr_trip}\n"
-            " Please, take over from there."
+            " Please, run again with --resume to take over from there."
         )
 
+    finally:
+        driver.quit()
+        journal.close()
+
+
+def crawl_with_pool(
+    crawler: Crawler,
+    journal: CrawlJournal,
+    dates: List[datetime],
+    workers: int,
+    pages_per_driver: int,
+) -> None:
+    """
+    Crawls every trip of every date not yet journaled with a BrowserPool of
+    workers headless browsers, saving the partial results after each of them.
+    """
+    jobs = []
+
+    for curr_date in dates:
+        for trip in challenge_list_of_trips:
+            for departure, arrival in trip.items():
+                if journal.is_done(departure, arrival, curr_date.strftime("%Y-%m-%d")):
+                    print(f"already crawled -> {trip} at {curr_date:%Y-%m-%d}")
+                    continue
+                jobs += [(departure, arrival, curr_date)]
+
+    def on_done(job, results) -> None:
+        departure, arrival, curr_date = job
+        print(f"crawled -> {departure} to {arrival} at {curr_date:%Y-%m-%d}")
+
+        # results first, so a unit is never journaled without them
+        save_partial_results(crawler.results)
+        journal.mark_done(departure, arrival, curr_date.strftime("%Y-%m-%d"))
+
+    pool = BrowserPool(
+        crawler, workers=workers, pages_per_driver=pages_per_driver, on_done=on_done
+    )
+    failed = pool.run(jobs)
+
+    if failed:
+        for (departure, arrival, curr_date), error in failed:
+            print(
+                f"Could not crawl {departure} to {arrival} at "
+                f"{curr_date:%Y-%m-%d} -> {error}"
+            )
+        print("Please, run again with --resume to crawl the missing trips.")
+        return
+
+    with open("./results_webcrawl.json", "w") as file:
+        file.write(json.dumps(crawler.results))
+    print_wait_summary(crawler)
+    print("done")
+
 
 if __name__ == "__main__":
     main()
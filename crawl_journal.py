@@ -0,0 +1,93 @@
+import os
+import json
+import threading
+from typing import Any, Set, Tuple
+
+
+class CrawlJournal:
+    """
+    Append-only journal of the units of work (origin, destination, departureDate)
+    that a crawl has already completed, so an interrupted crawl can be resumed
+    without fetching them again.
+
+    Units should be marked done only after their results were written, so a crash
+    in between costs a single unit being crawled twice, never a lost one.
+
+    Every entry is flushed and synced to disk when it is marked. A half written
+    last line (crash while marking) is ignored on load.
+    """
+
+    def __init__(self, path: str, resume: bool = False) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._done: Set[Tuple[str, str, str]] = set()
+
+        if resume:
+            self._load()
+
+        self._file = open(path, "a" if resume else "w", encoding="utf-8")
+
+        if resume and not self._ends_with_newline():
+            # keeps a torn last line from swallowing the next entry
+            self._file.write("\n")
+            self._file.flush()
+
+    @staticmethod
+    def key(origin: Any, destination: Any, departure_date: Any) -> Tuple[str, str, str]:
+        """
+        returns:
+            The unit of work key. Ids (api) and names (website) are both accepted,
+            they are compared as strings.
+        """
+        return (str(origin), str(destination), str(departure_date))
+
+    def _ends_with_newline(self) -> bool:
+        with open(self.path, "rb") as file:
+            if file.seek(0, os.SEEK_END) == 0:
+                return True
+            file.seek(-1, os.SEEK_END)
+            return file.read(1) == b"\n"
+
+    def _load(self) -> None:
+        if not os.path.exists(self.path):
+            return
+
+        with open(self.path, "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                    self._done.add(
+                        self.key(
+                            entry["origin"], entry["destination"], entry["departureDate"]
+                        )
+                    )
+                except (ValueError, KeyError, TypeError):
+                    continue
+
+    def is_done(self, origin: Any, destination: Any, departure_date: Any) -> bool:
+        with self._lock:
+            return self.key(origin, destination, departure_date) in self._done
+
+    def mark_done(self, origin: Any, destination: Any, departure_date: Any) -> None:
+        key = self.key(origin, destination, departure_date)
+
+        with self._lock:
+            if key in self._done:
+                return
+
+            self._file.write(
+                json.dumps(
+                    {"origin": key[0], "destination": key[1], "departureDate": key[2]}
+                )
+                + "\n"
+            )
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._done.add(key)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._done)
+
+    def close(self) -> None:
+        self._file.close()
@@ -0,0 +1,244 @@
+import io
+import os
+import gzip
+import json
+import itertools
+import datetime
+import threading
+from typing import Any, Dict, IO, Iterator
+from service_record import to_json
+
+try:
+    import zstandard
+except ImportError:  # optional, only needed for --compression zstd
+    zstandard = None
+
+
+class CrawlOutputException(Exception): ...
+
+
+COMPRESSION_SUFFIXES = {"gzip": ".gz", "zstd": ".zst"}
+
+
+def collect_at() -> Dict[str, str]:
+    """
+    returns:
+        The collect_at field added to every crawled record.
+    """
+    return {
+        "timezone": "UTC",
+        "datetime": datetime.datetime.now(tz=datetime.timezone.utc).strftime(
+            "%Y-%m-%d %H:%M:%S"
+        ),
+    }
+
+
+def parse_collect_at(value: Dict[str, str] | str) -> datetime.datetime:
+    """
+    returns:
+        The (UTC) datetime of a collect_at field.
+
+    Older outputs were written with "%Y-%m-%d %H:%M:%s", which puts the epoch
+    seconds where the seconds should be, so that form is accepted as well.
+    """
+    if isinstance(value, dict):
+        value = value.get("datetime", "")
+
+    try:
+        _, seconds = value.rsplit(":", 1)
+        if len(seconds) > 2:
+            return datetime.datetime.fromtimestamp(int(seconds), tz=datetime.timezone.utc)
+
+        return datetime.datetime.strptime(value, "%Y-%m-%d %H:%M:%S").replace(
+            tzinfo=datetime.timezone.utc
+        )
+    except (AttributeError, ValueError) as e:
+        raise CrawlOutputException(f"Cannot parse collect_at -> {value} <- {repr(e)}")
+
+
+def _compression_of(path: str) -> str | None:
+    for compression, suffix in COMPRESSION_SUFFIXES.items():
+        if path.endswith(suffix):
+            return compression
+
+    return None
+
+
+def _open_text(path: str, mode: str, compression: str | None) -> IO[str]:
+    """
+    Opens path as text for reading ("r"), writing ("w") or appending ("a"),
+    optionally through gzip or zstd.
+    """
+    if compression == None:
+        return open(path, mode, encoding="utf-8")
+
+    if compression == "gzip":
+        return gzip.open(path, f"{mode}t", encoding="utf-8")
+
+    if compression == "zstd":
+        if zstandard == None:
+            raise CrawlOutputException(
+                "zstd compression needs the zstandard package -> pip install zstandard"
+            )
+
+        if mode == "r":
+            raw = zstandard.ZstdDecompressor().stream_reader(open(path, "rb"))
+        else:
+            # zstd frames can be concatenated, so appending starts a new one
+            raw = zstandard.ZstdCompressor().stream_writer(open(path, f"{mode}b"))
+
+        return io.TextIOWrapper(raw, encoding="utf-8")
+
+    raise CrawlOutputException(f"Unknown compression -> {compression} <-")
+
+
+class NdjsonWriter:
+    """
+    Writes one json record per line, flushing after every record so that a crash
+    only loses the record being written.
+    """
+
+    def __init__(
+        self, path: str, compression: str | None = None, append: bool = False
+    ) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = _open_text(path, "a" if append else "w", compression)
+
+    def write(self, record: Dict[str, Any]) -> None:
+        line = json.dumps(record, default=to_json)
+
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def close(self) -> None:
+        self._file.close()
+
+    def __enter__(self) -> "NdjsonWriter":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+
+class JsonArrayWriter:
+    """
+    Writes the records as a single json array (the historical result_api.json
+    format) without keeping them in memory. The array is only closed by close(),
+    so prefer the NdjsonWriter when runs may be interrupted.
+    """
+
+    def __init__(
+        self, path: str, compression: str | None = None, append: bool = False
+    ) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._is_empty = True
+
+        if append:
+            if compression != None:
+                raise CrawlOutputException(
+                    "Compressed json arrays cannot be appended to. Use ndjson instead."
+                )
+            self._file = self._reopen_array(path)
+        else:
+            self._file = _open_text(path, "w", compression)
+            self._file.write("[")
+
+    def _reopen_array(self, path: str) -> IO[str]:
+        """
+        Reopens an array written by a previous (finished or interrupted) run,
+        dropping its closing bracket so new records can be added.
+        """
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            file = open(path, "w", encoding="utf-8")
+            file.write("[")
+            return file
+
+        with open(path, "rb") as file:
+            content = file.read().rstrip()
+
+        if content.endswith(b"]"):
+            content = content[:-1].rstrip()
+
+        if not content.startswith(b"["):
+            raise CrawlOutputException(f"{path} does not hold a json array.")
+
+        self._is_empty = content == b"["
+
+        with open(path, "wb") as file:
+            file.write(content)
+
+        return open(path, "a", encoding="utf-8")
+
+    def write(self, record: Dict[str, Any]) -> None:
+        line = json.dumps(record, default=to_json)
+
+        with self._lock:
+            if not self._is_empty:
+                self._file.write(",")
+            self._file.write(line)
+            self._file.flush()
+            self._is_empty = False
+
+    def close(self) -> None:
+        self._file.write("]")
+        self._file.close()
+
+    def __enter__(self) -> "JsonArrayWriter":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+
+def open_writer(
+    path: str,
+    output_format: str = "json",
+    compression: str | None = None,
+    append: bool = False,
+) -> NdjsonWriter | JsonArrayWriter:
+    """
+    returns:
+        A streaming writer for output_format ("json" or "ndjson"). The compression
+        suffix (".gz" or ".zst") is added to path when it is missing.
+    """
+    if compression != None:
+        suffix = COMPRESSION_SUFFIXES.get(compression)
+        if suffix == None:
+            raise CrawlOutputException(f"Unknown compression -> {compression} <-")
+        if not path.endswith(suffix):
+            path += suffix
+
+    if output_format == "ndjson":
+        return NdjsonWriter(path, compression=compression, append=append)
+
+    if output_format == "json":
+        return JsonArrayWriter(path, compression=compression, append=append)
+
+    raise CrawlOutputException(f"Unknown output format -> {output_format} <-")
+
+
+def iter_records(path: str) -> Iterator[Dict[str, Any]]:
+    """
+    returns:
+        An iterator over the records of a crawl output, whether it is a json array or
+        ndjson, plain, gzip or zstd compressed (detected by the file suffix).
+
+    json arrays are loaded at once; ndjson is read record by record.
+    """
+    with _open_text(path, "r", _compression_of(path)) as file:
+        first = file.read(1)
+        while first.isspace():
+            first = file.read(1)
+
+        if first == "[":
+            for record in json.loads(first + file.read()):
+                yield record
+            return
+
+        for line in itertools.chain([first + file.readline()], file):
+            line = line.strip()
+            if line:
+                yield json.loads(line)
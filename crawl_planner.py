@@ -0,0 +1,362 @@
+import os
+import json
+import time
+import heapq
+import hashlib
+import datetime
+import tempfile
+from typing import Any, Callable, Dict, List, Tuple
+from snapshot_diff import service_fingerprint, unit_key
+
+
+class CrawlPlannerException(Exception): ...
+
+
+# (origin id, destination id)
+Route = Tuple[int, int]
+
+
+def all_routes(locales: List[Dict[str, Any]]) -> List[Route]:
+    """
+    returns:
+        Every (origin, destination) pair among the searchOrigin locales (as in
+        ApiConnector.locales_info), since the api does not tell the destinations
+        served from each origin.
+
+    ALERT: that is the square of the number of locales; CrawlPlanner learns which
+    of them have no services and polls those at its max_interval only.
+    """
+    ids = [locale["id"] for locale in locales]
+
+    return [
+        (origin, destination)
+        for origin in ids
+        for destination in ids
+        if origin != destination
+    ]
+
+
+class CrawlPlanner:
+    """
+    Schedules the (route, departure date) units of a crawl over a horizon of days,
+    so a limited request budget goes to what matters most.
+
+    Every unit has a refresh interval: min_interval for today's departures,
+    growing by min_interval a day ahead up to max_interval, and shortened for
+    volatile routes (those whose services changed on recent crawls, tracked as
+    an exponential moving average). Routes that had no services on their last
+    crawl are polled at max_interval. Units whose crawl failed (reported through
+    observe_failure) are retried after failure_backoff seconds, doubling on every
+    failure in a row up to max_interval, so dead units do not take the budget of
+    every plan.
+
+    plan() returns the due units, most overdue first (units never crawled come
+    first, nearest departures first), as trips of ApiRoutesRequestGenerator.
+    The crawl then reports its valid records through observe_record, and save()
+    keeps what the next plan needs in state_path.
+
+    The crawled units are indexed by when they are due (a heap, kept up to date
+    by observe_record and observe_failure and rebuilt once a day), so plan() and
+    next_due_in() only look at the units due, not at every (route, day).
+    """
+
+    def __init__(
+        self,
+        routes: List[Route],
+        horizon_days: int = 8,
+        min_interval: float = 3600,
+        max_interval: float = 86400,
+        volatility_weight: float = 3,
+        failure_backoff: float = 300,
+        state_path: str | None = None,
+        clock: Callable[[], float] = time.time,
+    ) -> None:
+        if horizon_days < 1:
+            raise CrawlPlannerException(
+                f"horizon_days should be at least 1 -> {horizon_days} <-"
+            )
+
+        self.routes = routes
+        self.horizon_days = horizon_days
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.volatility_weight = volatility_weight
+        self.failure_backoff = failure_backoff
+        self.state_path = state_path
+        self.clock = clock
+
+        # "origin|destination|date" -> {crawled_at, fingerprint, empty, failures}
+        self.units: Dict[str, Dict[str, Any]] = {}
+        # "origin|destination" -> moving average of the crawls that changed it
+        self.volatility: Dict[str, float] = {}
+
+        # "origin|destination" -> route, in the order never crawled units go
+        self._routes = {
+            f"{route[0]}|{route[1]}": route for route in sorted(set(routes))
+        }
+
+        # the due index, for the horizon starting on _today (see _index)
+        self._today: datetime.date | None = None
+        self._days: Dict[str, int] = {}
+        self._due: List[Tuple[float, str]] = []
+        self._due_at: Dict[str, float] = {}
+        # date -> crawled units of the routes, to tell days with new units apart
+        self._crawled: Dict[str, int] = {}
+
+        if state_path != None and os.path.exists(state_path):
+            self._load()
+
+    def _load(self) -> None:
+        try:
+            with open(self.state_path, "r") as file:
+                state = json.loads(file.read())
+        except ValueError:
+            raise CrawlPlannerException(
+                f"The planner state is corrupted -> {self.state_path} <-"
+            )
+
+        self.units = state.get("units", {})
+        self.volatility = state.get("volatility", {})
+
+    def refresh_interval(
+        self, route: Route, departure_day: datetime.date, today: datetime.date
+    ) -> float:
+        """
+        returns:
+            How many seconds a crawl of the route on departure_day stays fresh.
+        """
+        unit = self.units.get(_unit(route, departure_day))
+
+        if unit != None and unit.get("failures"):
+            return min(
+                self.max_interval,
+                self.failure_backoff * 2 ** (unit["failures"] - 1),
+            )
+
+        if unit != None and unit.get("empty"):
+            return self.max_interval
+
+        days_ahead = max(0, (departure_day - today).days)
+        volatility = self.volatility.get(f"{route[0]}|{route[1]}", 0.0)
+
+        interval = (
+            self.min_interval
+            * (1 + days_ahead)
+            / (1 + self.volatility_weight * volatility)
+        )
+
+        return min(self.max_interval, max(self.min_interval, interval))
+
+    def _index(self, now: float) -> None:
+        """
+        (Re)builds the due index when the horizon moved (or on first use): the
+        intervals depend on how many days ahead each departure is.
+        """
+        today = datetime.date.fromtimestamp(now)
+
+        if today == self._today:
+            return
+
+        self._today = today
+        self._days = {
+            (today + datetime.timedelta(days=i)).strftime("%Y-%m-%d"): i
+            for i in range(self.horizon_days)
+        }
+        self._due = []
+        self._due_at = {}
+        self._crawled = {day: 0 for day in self._days}
+
+        for key in self.units:
+            self._schedule(key)
+
+    def _schedule(self, key: str) -> None:
+        # indexes (again) when the unit is due, if it is one of the horizon
+        if self._today == None:
+            return
+
+        route_key, day = key.rsplit("|", 1)
+        route = self._routes.get(route_key)
+        days_ahead = self._days.get(day)
+
+        if route == None or days_ahead == None:
+            return
+
+        departure_day = self._today + datetime.timedelta(days=days_ahead)
+        due_at = self.units[key]["crawled_at"] + self.refresh_interval(
+            route, departure_day, self._today
+        )
+        previous = self._due_at.get(key)
+
+        if previous == None:
+            self._crawled[day] += 1
+        elif previous == due_at:
+            return
+
+        # the previous entry stays in the heap, told stale by _due_at
+        self._due_at[key] = due_at
+        heapq.heappush(self._due, (due_at, key))
+
+        if len(self._due) > 4 * len(self._due_at) + 64:
+            self._due = [(due_at, key) for key, due_at in self._due_at.items()]
+            heapq.heapify(self._due)
+
+    def _schedule_route(self, route_key: str) -> None:
+        # the volatility of the route moved: every unit of it may be due sooner
+        for day in self._days:
+            key = f"{route_key}|{day}"
+            if key in self.units:
+                self._schedule(key)
+
+    def plan(
+        self, budget: int | None = None, now: float | None = None
+    ) -> List[Dict[str, Any]]:
+        """
+        returns:
+            The due units as {"from", "to", "departureDate"} trips, by priority,
+            at most budget of them.
+        """
+        now = self.clock() if now == None else now
+        self._index(now)
+
+        planned: List[Tuple[Route, str]] = []
+
+        # never crawled: before anything else, nearest departures first
+        for day in self._days:
+            if self._crawled[day] == len(self._routes):
+                continue
+
+            for route_key, route in self._routes.items():
+                if budget != None and len(planned) >= budget:
+                    break
+                if f"{route_key}|{day}" not in self.units:
+                    planned += [(route, day)]
+
+        if budget == None or len(planned) < budget:
+            # the crawled units due, most overdue first
+            due: Dict[str, float] = {}
+
+            while self._due and self._due[0][0] <= now:
+                due_at, key = heapq.heappop(self._due)
+                if self._due_at.get(key) == due_at:
+                    due[key] = due_at
+
+            # they stay indexed until the crawl reports them
+            for key, due_at in due.items():
+                heapq.heappush(self._due, (due_at, key))
+
+            def priority(key: str) -> Tuple[float, int, Route, str]:
+                route_key, day = key.rsplit("|", 1)
+                crawled_at = self.units[key]["crawled_at"]
+                overdue = (now - crawled_at) / (due[key] - crawled_at)
+                return (-overdue, self._days[day], self._routes[route_key], day)
+
+            if budget == None:
+                ordered = sorted(map(priority, due))
+            else:
+                ordered = heapq.nsmallest(budget - len(planned), map(priority, due))
+
+            planned += [(route, day) for _, _, route, day in ordered]
+
+        return [
+            {"from": route[0], "to": route[1], "departureDate": day}
+            for route, day in planned
+        ]
+
+    def next_due_in(self, now: float | None = None) -> float:
+        """
+        returns:
+            How many seconds until the next unit is due (0 if one already is).
+        """
+        now = self.clock() if now == None else now
+        self._index(now)
+
+        if any(count < len(self._routes) for count in self._crawled.values()):
+            # a unit was never crawled
+            return 0.0
+
+        while self._due and self._due_at.get(self._due[0][1]) != self._due[0][0]:
+            heapq.heappop(self._due)
+
+        if not self._due:
+            return float("inf")
+
+        return max(0.0, self._due[0][0] - now)
+
+    def observe_record(self, record: Dict[str, Any]) -> None:
+        """
+        Takes a valid getRoutes record of the crawl into account: the unit is
+        fresh again, and its route volatility moves towards 1 if its services
+        changed since the previous crawl (towards 0 otherwise).
+        """
+        key = unit_key(record)
+
+        if key == None:
+            return
+
+        services = record["result"].get("servicesList") or []
+        fingerprints = sorted(service_fingerprint(service) for service in services)
+        fingerprint = hashlib.blake2b(
+            "".join(fingerprints).encode(), digest_size=8
+        ).hexdigest()
+
+        previous = self.units.get(key)
+        route = key.rsplit("|", 1)[0]
+
+        self.units[key] = {
+            "crawled_at": self.clock(),
+            "fingerprint": fingerprint,
+            "empty": not services,
+        }
+
+        if previous != None and previous.get("fingerprint") != None:
+            changed = 1.0 if previous["fingerprint"] != fingerprint else 0.0
+            self.volatility[route] = (
+                0.5 * self.volatility.get(route, 0.0) + 0.5 * changed
+            )
+            self._schedule_route(route)
+        else:
+            self._schedule(key)
+
+    def observe_failure(self, trip: Dict[str, Any]) -> None:
+        """
+        Takes a failed crawl of the trip ({"from", "to", "departureDate"}) into
+        account: the unit is due again after its failure backoff, which doubles
+        with every failure in a row. Its last valid crawl (if any) is kept.
+        """
+        key = f"{trip.get('from')}|{trip.get('to')}|{trip.get('departureDate')}"
+        previous = self.units.get(key) or {}
+
+        self.units[key] = {
+            "crawled_at": self.clock(),
+            "fingerprint": previous.get("fingerprint"),
+            "empty": previous.get("empty", False),
+            "failures": previous.get("failures", 0) + 1,
+        }
+        self._schedule(key)
+
+    def save(self) -> None:
+        """
+        Writes the state to state_path, leaving out the departures already gone.
+        """
+        if self.state_path == None:
+            return
+
+        today = datetime.date.fromtimestamp(self.clock()).strftime("%Y-%m-%d")
+        units = {
+            key: unit
+            for key, unit in self.units.items()
+            if key.rsplit("|", 1)[1] >= today
+        }
+
+        directory = os.path.dirname(os.path.abspath(self.state_path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".planner-")
+
+        with os.fdopen(fd, "w") as file:
+            file.write(json.dumps({"units": units, "volatility": self.volatility}))
+
+        os.replace(tmp_path, self.state_path)
+
+
+def _unit(route: Route, day: datetime.date) -> str:
+    # the same origin|destination|date as snapshot_diff.unit_key
+    return f"{route[0]}|{route[1]}|{day.strftime('%Y-%m-%d')}"
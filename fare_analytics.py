@@ -0,0 +1,412 @@
+import json
+import time
+import argparse
+from typing import Any, Dict, Iterable, List, Tuple
+import numpy as np
+from crawl_output import CrawlOutputException, iter_records, parse_collect_at
+
+
+class FareAnalyticsException(Exception): ...
+
+
+# a route is kept as a single int64: origin id * ROUTE_SPLIT + destination id
+ROUTE_SPLIT = 1 << 32
+
+PERCENTILES = (5, 25, 50, 75, 95)
+
+GROUP_KEYS = ("route", "day", "route_day")
+
+
+class FareColumns:
+    """
+    The services of one or more crawl outputs as NumPy columns, one entry per
+    service: price, freeSeats, totalSeats and km (float64, nan when missing),
+    departure, arrival and collected_at (datetime64[s], NaT when missing),
+    origin_id, destination_id and class_code (int64).
+
+    Everything derived from them (occupancy, price per km, duration) is computed
+    on the whole columns at once, instead of looping over the nested records.
+    """
+
+    def __init__(
+        self,
+        price: np.ndarray,
+        free_seats: np.ndarray,
+        total_seats: np.ndarray,
+        km: np.ndarray,
+        departure: np.ndarray,
+        arrival: np.ndarray,
+        collected_at: np.ndarray,
+        origin_id: np.ndarray,
+        destination_id: np.ndarray,
+        class_code: np.ndarray,
+        classes: List[str] = [],
+        stations: Dict[int, str] = {},
+    ) -> None:
+        self.price = price
+        self.free_seats = free_seats
+        self.total_seats = total_seats
+        self.km = km
+        self.departure = departure
+        self.arrival = arrival
+        self.collected_at = collected_at
+        self.origin_id = origin_id
+        self.destination_id = destination_id
+        self.class_code = class_code
+        # class_code -> class name, and locale id -> name
+        self.classes = classes
+        self.stations = stations
+
+    def __len__(self) -> int:
+        return len(self.price)
+
+    @property
+    def occupancy(self) -> np.ndarray:
+        """
+        returns:
+            The share of sold seats of every service (nan without totalSeats).
+        """
+        with np.errstate(divide="ignore", invalid="ignore"):
+            occupancy = 1 - self.free_seats / self.total_seats
+
+        occupancy[~(self.total_seats > 0)] = np.nan
+        return occupancy
+
+    @property
+    def price_per_km(self) -> np.ndarray:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            price_per_km = self.price / self.km
+
+        price_per_km[~(self.km > 0)] = np.nan
+        return price_per_km
+
+    @property
+    def duration_hours(self) -> np.ndarray:
+        seconds = (self.arrival - self.departure).astype("timedelta64[s]")
+        duration = seconds.astype(np.float64) / 3600
+        duration[np.isnat(seconds)] = np.nan
+        return duration
+
+    @property
+    def route(self) -> np.ndarray:
+        return self.origin_id * ROUTE_SPLIT + self.destination_id
+
+    @property
+    def day(self) -> np.ndarray:
+        """
+        returns:
+            The departure day of every service (datetime64[D]).
+        """
+        return self.departure.astype("datetime64[D]")
+
+    def select(self, mask: np.ndarray) -> "FareColumns":
+        """
+        returns:
+            The services where mask (a boolean array or indexes) holds.
+        """
+        return FareColumns(
+            self.price[mask],
+            self.free_seats[mask],
+            self.total_seats[mask],
+            self.km[mask],
+            self.departure[mask],
+            self.arrival[mask],
+            self.collected_at[mask],
+            self.origin_id[mask],
+            self.destination_id[mask],
+            self.class_code[mask],
+            classes=self.classes,
+            stations=self.stations,
+        )
+
+
+def load_columns(paths: Iterable[str]) -> FareColumns:
+    """
+    returns:
+        The services of the valid getRoutes records in the crawl outputs (json or
+        ndjson, as read by crawl_output.iter_records) as FareColumns.
+
+    ALERT: the records are still parsed one by one; only a list per column is
+    kept meanwhile, turned into an array once everything is read.
+    """
+    price: List[Any] = []
+    free_seats: List[Any] = []
+    total_seats: List[Any] = []
+    km: List[Any] = []
+    departure: List[Any] = []
+    arrival: List[Any] = []
+    collected_at: List[Any] = []
+    origin_id: List[Any] = []
+    destination_id: List[Any] = []
+    class_code: List[int] = []
+
+    classes: Dict[str, int] = {}
+    stations: Dict[int, str] = {}
+
+    for path in paths:
+        for record in iter_records(path):
+            result = record.get("result") if isinstance(record, dict) else None
+            services = (result or {}).get("servicesList") or []
+
+            if not services:
+                continue
+
+            try:
+                collected = (
+                    parse_collect_at(record["collect_at"])
+                    .replace(tzinfo=None)
+                    .isoformat()
+                )
+            except (KeyError, CrawlOutputException):
+                collected = None
+
+            price += [service.get("price") for service in services]
+            free_seats += [service.get("freeSeats") for service in services]
+            total_seats += [service.get("totalSeats") for service in services]
+            km += [service.get("km") for service in services]
+            departure += [service.get("departureDate") for service in services]
+            arrival += [service.get("arrivalDate") for service in services]
+            collected_at += [collected] * len(services)
+            origin_id += [service.get("originId") or -1 for service in services]
+            destination_id += [
+                service.get("destinationId") or -1 for service in services
+            ]
+            class_code += [
+                classes.setdefault(service.get("class") or "", len(classes))
+                for service in services
+            ]
+
+            first = services[0]
+            stations.setdefault(first.get("originId"), first.get("originDesc"))
+            stations.setdefault(
+                first.get("destinationId"), first.get("destinationDesc")
+            )
+
+    return FareColumns(
+        np.array(price, dtype=np.float64),
+        np.array(free_seats, dtype=np.float64),
+        np.array(total_seats, dtype=np.float64),
+        np.array(km, dtype=np.float64),
+        np.array(departure, dtype="datetime64[s]"),
+        np.array(arrival, dtype="datetime64[s]"),
+        np.array(collected_at, dtype="datetime64[s]"),
+        np.array(origin_id, dtype=np.int64),
+        np.array(destination_id, dtype=np.int64),
+        np.array(class_code, dtype=np.int64),
+        classes=list(classes),
+        stations=stations,
+    )
+
+
+def percentiles(
+    values: np.ndarray, q: Tuple[int, ...] = PERCENTILES
+) -> Dict[str, float | None]:
+    """
+    returns:
+        {"p5": ..., "p50": ..., ...} of the values, leaving the nan out.
+    """
+    values = values[~np.isnan(values)]
+
+    if len(values) == 0:
+        return {f"p{p}": None for p in q}
+
+    return {f"p{p}": float(value) for p, value in zip(q, np.percentile(values, q))}
+
+
+def group_codes(*keys: np.ndarray) -> Tuple[np.ndarray, List[np.ndarray]]:
+    """
+    returns:
+        The group of every entry (0 to number of groups - 1) for the combination
+        of keys, and the value of every key for each group.
+    """
+    if not keys:
+        raise FareAnalyticsException("At least one key is needed to group by.")
+
+    combined = np.zeros(len(keys[0]), dtype=np.int64)
+    uniques = []
+
+    for key in keys:
+        unique, inverse = np.unique(key, return_inverse=True)
+        combined = combined * len(unique) + inverse
+        uniques += [unique]
+
+    groups, codes = np.unique(combined, return_inverse=True)
+
+    # undoes the mixed radix of combined, for the key values of every group
+    key_values = []
+    for unique in reversed(uniques):
+        key_values += [unique[groups % len(unique)]]
+        groups = groups // len(unique)
+
+    return codes, key_values[::-1]
+
+
+def group_stats(
+    codes: np.ndarray, values: np.ndarray, groups: int, median: bool = False
+) -> Dict[str, np.ndarray]:
+    """
+    returns:
+        The count, min, mean and max (and the p50, with median) of the values of
+        each group, nan for the groups without values, leaving nan values out.
+
+    The values are sorted by group once (by value as well, for the median), so
+    every statistic is a reduction over the slices of the same array.
+    """
+    valid = ~np.isnan(values)
+    codes, values = codes[valid], values[valid]
+
+    if median:
+        # by value, then (stably) by group: sorted by value within each group
+        order = np.argsort(values)
+        order = order[np.argsort(codes[order], kind="stable")]
+    else:
+        order = np.argsort(codes, kind="stable")
+
+    codes, values = codes[order], values[order]
+
+    count = np.bincount(codes, minlength=groups)
+    present = count > 0
+    first = (np.cumsum(count) - count)[present]
+    last = first + count[present] - 1
+
+    stats = {"count": count}
+
+    for name in ("min", "mean", "max") + (("p50",) if median else ()):
+        stats[name] = np.full(groups, np.nan)
+
+    if len(values) == 0:
+        return stats
+
+    stats["min"][present] = np.minimum.reduceat(values, first)
+    stats["max"][present] = np.maximum.reduceat(values, first)
+    stats["mean"][present] = np.add.reduceat(values, first) / count[present]
+
+    if median:
+        stats["p50"][present] = (
+            values[(first + last) // 2] + values[(first + last + 1) // 2]
+        ) / 2
+
+    return stats
+
+
+def report(columns: FareColumns, by: str = "route") -> List[Dict[str, Any]]:
+    """
+    returns:
+        A row per route, departure day or both (by), with the number of services
+        and the fare, occupancy, price per km and duration statistics.
+    """
+    if by not in GROUP_KEYS:
+        raise FareAnalyticsException(
+            f"Unknown group -> {by} <- expected one of {GROUP_KEYS}"
+        )
+
+    if len(columns) == 0:
+        return []
+
+    keys = {"route": [columns.route], "day": [columns.day]}
+    keys["route_day"] = keys["route"] + keys["day"]
+
+    codes, key_values = group_codes(*keys[by])
+    groups = len(key_values[0])
+
+    # sorted by group once: the sorts of every group_stats are then nearly free
+    order = np.argsort(codes, kind="stable")
+    codes, columns = codes[order], columns.select(order)
+
+    fare = group_stats(codes, columns.price, groups, median=True)
+    occupancy = group_stats(codes, columns.occupancy, groups)
+
+    report_columns: Dict[str, Any] = {}
+
+    for name, values in zip(by.split("_"), key_values):
+        if name == "route":
+            origin, destination = np.divmod(values, ROUTE_SPLIT)
+            report_columns["origin_id"] = origin.tolist()
+            report_columns["origin"] = [
+                columns.stations.get(locale) for locale in report_columns["origin_id"]
+            ]
+            report_columns["destination_id"] = destination.tolist()
+            report_columns["destination"] = [
+                columns.stations.get(locale)
+                for locale in report_columns["destination_id"]
+            ]
+        else:
+            report_columns["day"] = values.astype(str).tolist()
+
+    report_columns["services"] = np.bincount(codes, minlength=groups).tolist()
+
+    statistics = {
+        "fare_min": fare["min"],
+        "fare_p50": fare["p50"],
+        "fare_mean": fare["mean"],
+        "fare_max": fare["max"],
+        "occupancy_mean": occupancy["mean"],
+        "occupancy_max": occupancy["max"],
+        "price_per_km_mean": group_stats(codes, columns.price_per_km, groups)["mean"],
+        "duration_hours_mean": group_stats(codes, columns.duration_hours, groups)[
+            "mean"
+        ],
+    }
+
+    for name, values in statistics.items():
+        # nan (a group without values) becomes None, as json has no nan
+        report_columns[name] = [
+            None if value != value else value for value in np.round(values, 4).tolist()
+        ]
+
+    names = list(report_columns)
+
+    return [dict(zip(names, row)) for row in zip(*report_columns.values())]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Fare and occupancy statistics over crawl outputs."
+    )
+    parser.add_argument(
+        "paths",
+        nargs="+",
+        help="crawl outputs (json or ndjson, see crawl_output.py), e.g. months of "
+        "result_api snapshots",
+    )
+    parser.add_argument(
+        "--by",
+        choices=GROUP_KEYS,
+        default="route",
+        help="groups the report by route, departure day or both (default: route)",
+    )
+    parser.add_argument(
+        "--output",
+        default=None,
+        help="writes the report rows as json to this file instead of printing them",
+    )
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    columns = load_columns(args.paths)
+    loaded = time.perf_counter()
+
+    rows = report(columns, by=args.by)
+    fares = percentiles(columns.price)
+    occupancies = percentiles(columns.occupancy)
+    done = time.perf_counter()
+
+    print(
+        f"{len(columns)} services loaded in {loaded - started:.2f}s, "
+        f"analysed in {done - loaded:.2f}s."
+    )
+    print(f"fare percentiles: {fares}")
+    print(f"occupancy percentiles: {occupancies}")
+
+    if args.output != None:
+        with open(args.output, "w") as file:
+            file.write(json.dumps(rows, ensure_ascii=False))
+        print(f"The report has been written to {args.output}")
+        return
+
+    for row in rows:
+        print(json.dumps(row, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,441 @@
+import os
+import json
+import argparse
+import datetime
+import tempfile
+from typing import Any, Dict, Iterator, List
+from api_connector import canonical_locale_key
+from crawl_output import iter_records, parse_collect_at
+
+
+class FareTimeSeriesException(Exception): ...
+
+
+# the columns of every observation line of a chunk
+OBSERVATION_FIELDS = (
+    "serviceId",
+    "departureDate",
+    "class",
+    "collect_at",
+    "price",
+    "freeSeats",
+    "totalSeats",
+)
+
+
+def _empty_rollup() -> Dict[str, float | None]:
+    return {
+        "fare_min": None,
+        "fare_max": None,
+        "fare_sum": 0.0,
+        "fare_count": 0,
+        "occupancy_min": None,
+        "occupancy_max": None,
+        "occupancy_sum": 0.0,
+        "occupancy_count": 0,
+    }
+
+
+def _add_to_rollup(
+    rollup: Dict[str, Any], price: float | None, occupancy: float | None
+) -> None:
+    for name, value in (("fare", price), ("occupancy", occupancy)):
+        if value == None:
+            continue
+
+        low, high = rollup[f"{name}_min"], rollup[f"{name}_max"]
+        rollup[f"{name}_min"] = value if low == None else min(low, value)
+        rollup[f"{name}_max"] = value if high == None else max(high, value)
+        rollup[f"{name}_sum"] += value
+        rollup[f"{name}_count"] += 1
+
+
+def _occupancy(free_seats: int | None, total_seats: int | None) -> float | None:
+    if free_seats == None or not total_seats:
+        return None
+
+    return 1 - free_seats / total_seats
+
+
+class _Chunk:
+    """
+    The observations of a route collected in a month: an append-only ndjson of
+    OBSERVATION_FIELDS rows, and its rollups (keyed by "YYYY-MM-DD|HH" of
+    collection) along with the size of the ndjson they cover.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.rollup_path = path.replace(".ndjson", ".rollup.json")
+        self.pending: List[List[Any]] = []
+        self.rollups = self._load_rollups()
+
+    def _size(self) -> int:
+        return os.path.getsize(self.path) if os.path.exists(self.path) else 0
+
+    def _load_rollups(self) -> Dict[str, Dict[str, Any]]:
+        try:
+            with open(self.rollup_path, "r") as file:
+                stored = json.loads(file.read())
+            if stored["size"] == self._size():
+                return stored["rollups"]
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+        # missing, corrupted or behind the chunk (an interrupted flush): rebuild
+        rollups: Dict[str, Dict[str, Any]] = {}
+        for row in _read_rows(self.path):
+            _add_row(rollups, row)
+
+        return rollups
+
+    def append(self, row: List[Any]) -> None:
+        self.pending += [row]
+        _add_row(self.rollups, row)
+
+    def flush(self) -> None:
+        if not self.pending:
+            return
+
+        lines = "".join(json.dumps(row) + "\n" for row in self.pending)
+
+        with open(self.path, "ab+") as file:
+            # a torn last line (of an interrupted append) must not swallow ours
+            if file.tell() > 0:
+                file.seek(-1, os.SEEK_END)
+                if file.read(1) != b"\n":
+                    lines = "\n" + lines
+            file.write(lines.encode())
+
+        self.pending = []
+
+        _write_atomically(
+            self.rollup_path, {"size": self._size(), "rollups": self.rollups}
+        )
+
+
+def _add_row(rollups: Dict[str, Dict[str, Any]], row: List[Any]) -> None:
+    _, _, _, collected_at, price, free_seats, total_seats = row
+    # "YYYY-MM-DDTHH:MM:SS" -> "YYYY-MM-DD|HH"
+    key = f"{collected_at[:10]}|{collected_at[11:13]}"
+
+    _add_to_rollup(
+        rollups.setdefault(key, _empty_rollup()),
+        price,
+        _occupancy(free_seats, total_seats),
+    )
+
+
+def _read_rows(path: str) -> Iterator[List[Any]]:
+    if not os.path.exists(path):
+        return
+
+    with open(path, "r") as file:
+        for line in file:
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # a torn last line of an interrupted append
+                continue
+
+
+def _write_atomically(path: str, value: Any) -> None:
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".rollup-")
+
+    with os.fdopen(fd, "w") as file:
+        file.write(json.dumps(value))
+
+    os.replace(tmp_path, path)
+
+
+class FareTimeSeries:
+    """
+    Keeps the history of every crawl: for each service (serviceId, departureDate,
+    class), its price and seats at every collect_at.
+
+    Observations are only ever appended, chunked on disk by route and month of
+    collection (<root>/<origin id>-<destination id>/<YYYY-MM>.ndjson), and every
+    chunk keeps rollups next to it: min/avg/max fare and occupancy per day and
+    hour of collection. fare_history then only reads the rollups of the months
+    asked for, never the observations themselves.
+
+    Every observe_record is on disk once it returns, so the history of a crawl
+    survives it being interrupted; ingest writes in batches instead.
+
+    Usage:
+        series = FareTimeSeries("./fares")
+        series.observe_record(record)  # or ingest(records)
+        series.close()
+        series.fare_history("São Paulo (Rod. Tietê)", "Curitiba", days=30)
+    """
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+        self.index_path = os.path.join(root, "routes.json")
+        self.routes: Dict[str, Dict[str, Any]] = self._load_index()
+        self._index_changed = False
+        self._chunks: Dict[str, _Chunk] = {}
+
+    def _load_index(self) -> Dict[str, Dict[str, Any]]:
+        try:
+            with open(self.index_path, "r") as file:
+                return json.loads(file.read())
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            raise FareTimeSeriesException(
+                f"The routes index is corrupted -> {self.index_path} <-"
+            )
+
+    def _chunk(self, route: str, month: str) -> _Chunk:
+        path = os.path.join(self.root, route, f"{month}.ndjson")
+        chunk = self._chunks.get(path)
+
+        if chunk == None:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            chunk = self._chunks[path] = _Chunk(path)
+
+        return chunk
+
+    def observe_record(self, record: Dict[str, Any], flush: bool = True) -> None:
+        """
+        Appends the services of a valid getRoutes record (with its collect_at),
+        writing them to disk right away unless flush is False.
+        """
+        result = record.get("result")
+
+        if not isinstance(result, dict) or not result.get("servicesList"):
+            return
+
+        collected_at = parse_collect_at(record.get("collect_at", {})).strftime(
+            "%Y-%m-%dT%H:%M:%S"
+        )
+        month = collected_at[:7]
+
+        for service in result["servicesList"]:
+            route = f"{service.get('originId')}-{service.get('destinationId')}"
+
+            if route not in self.routes:
+                self.routes[route] = {
+                    "origin_id": service.get("originId"),
+                    "destination_id": service.get("destinationId"),
+                    "origin_key": canonical_locale_key(service.get("originDesc") or ""),
+                    "destination_key": canonical_locale_key(
+                        service.get("destinationDesc") or ""
+                    ),
+                }
+                self._index_changed = True
+
+            self._chunk(route, month).append(
+                [
+                    str(service.get("serviceId")),
+                    service.get("departureDate"),
+                    service.get("class"),
+                    collected_at,
+                    service.get("price"),
+                    service.get("freeSeats"),
+                    service.get("totalSeats"),
+                ]
+            )
+
+        if flush:
+            # a crash then loses at most the record being written
+            self.flush()
+
+    def ingest(self, records: Iterator[Dict[str, Any]], batch: int = 1000) -> None:
+        """
+        Appends the records, writing them to disk every batch records.
+        """
+        for count, record in enumerate(records, start=1):
+            self.observe_record(record, flush=count % batch == 0)
+
+        self.flush()
+
+    def flush(self) -> None:
+        for chunk in self._chunks.values():
+            chunk.flush()
+
+        if self._index_changed:
+            _write_atomically(self.index_path, self.routes)
+            self._index_changed = False
+
+    def close(self) -> None:
+        self.flush()
+        self._chunks = {}
+
+    def _route(self, origin: int | str, destination: int | str) -> str:
+        if isinstance(origin, int) and isinstance(destination, int):
+            return f"{origin}-{destination}"
+
+        origin_key = canonical_locale_key(str(origin))
+        destination_key = canonical_locale_key(str(destination))
+
+        for route, info in self.routes.items():
+            if (info["origin_key"], info["destination_key"]) == (
+                origin_key,
+                destination_key,
+            ):
+                return route
+
+        raise FareTimeSeriesException(
+            f"No fares recorded from -> {origin} <- to -> {destination} <-"
+        )
+
+    @staticmethod
+    def _months(since: datetime.date, until: datetime.date) -> List[str]:
+        months = []
+        month = since.replace(day=1)
+
+        while month <= until:
+            months += [month.strftime("%Y-%m")]
+            month = (month + datetime.timedelta(days=32)).replace(day=1)
+
+        return months
+
+    def fare_history(
+        self,
+        origin: int | str,
+        destination: int | str,
+        days: int = 30,
+        until: datetime.date | None = None,
+        by_hour: bool = False,
+    ) -> List[Dict[str, Any]]:
+        """
+        returns:
+            The min/avg/max fare and occupancy of the route per day of collection
+            (or per day and hour, with by_hour) over the last days until until
+            (default: today, in utc), oldest first.
+
+        args:
+            origin/destination: either the locale ids or their names (in any of the
+            spellings accepted by ApiConnector.get_locale_id)
+        """
+        self.flush()
+
+        until = until or datetime.datetime.now(tz=datetime.timezone.utc).date()
+        since = until - datetime.timedelta(days=days - 1)
+        route = self._route(origin, destination)
+
+        merged: Dict[str, Dict[str, Any]] = {}
+
+        for month in self._months(since, until):
+            chunk_path = os.path.join(self.root, route, f"{month}.ndjson")
+            if not os.path.exists(chunk_path):
+                continue
+
+            for key, rollup in self._chunk(route, month).rollups.items():
+                day = key[:10]
+                if not (since.isoformat() <= day <= until.isoformat()):
+                    continue
+
+                group = merged.setdefault(key if by_hour else day, _empty_rollup())
+                for name in ("fare", "occupancy"):
+                    if rollup[f"{name}_count"] == 0:
+                        continue
+                    for bound, pick in (("min", min), ("max", max)):
+                        current = group[f"{name}_{bound}"]
+                        value = rollup[f"{name}_{bound}"]
+                        group[f"{name}_{bound}"] = (
+                            value if current == None else pick(current, value)
+                        )
+                    group[f"{name}_sum"] += rollup[f"{name}_sum"]
+                    group[f"{name}_count"] += rollup[f"{name}_count"]
+
+        history = []
+
+        for key, group in sorted(merged.items()):
+            day, _, hour = key.partition("|")
+            history += [
+                {
+                    "day": day,
+                    **({"hour": int(hour)} if by_hour else {}),
+                    "fare_min": group["fare_min"],
+                    "fare_avg": (
+                        group["fare_sum"] / group["fare_count"]
+                        if group["fare_count"]
+                        else None
+                    ),
+                    "fare_max": group["fare_max"],
+                    "occupancy_min": group["occupancy_min"],
+                    "occupancy_avg": (
+                        group["occupancy_sum"] / group["occupancy_count"]
+                        if group["occupancy_count"]
+                        else None
+                    ),
+                    "occupancy_max": group["occupancy_max"],
+                    "observations": group["fare_count"],
+                }
+            ]
+
+        return history
+
+    def observations(
+        self,
+        origin: int | str,
+        destination: int | str,
+        days: int = 30,
+        until: datetime.date | None = None,
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        returns:
+            Every observation of the route collected over the last days, as dicts
+            of OBSERVATION_FIELDS, reading only the chunks of those months.
+        """
+        self.flush()
+
+        until = until or datetime.datetime.now(tz=datetime.timezone.utc).date()
+        since = until - datetime.timedelta(days=days - 1)
+        route = self._route(origin, destination)
+
+        for month in self._months(since, until):
+            for row in _read_rows(os.path.join(self.root, route, f"{month}.ndjson")):
+                if since.isoformat() <= row[3][:10] <= until.isoformat():
+                    yield dict(zip(OBSERVATION_FIELDS, row))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Fare history of the crawled routes.")
+    parser.add_argument("--root", default="./fare_timeseries")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    ingest_parser = subparsers.add_parser("ingest", help="ingests crawl outputs")
+    ingest_parser.add_argument("outputs", nargs="+", help="json or ndjson outputs")
+
+    history_parser = subparsers.add_parser(
+        "history", help="daily min/avg/max fare and occupancy of a route"
+    )
+    history_parser.add_argument("origin")
+    history_parser.add_argument("destination")
+    history_parser.add_argument("--days", type=int, default=30)
+    history_parser.add_argument(
+        "--by-hour", action="store_true", help="per hour of collection"
+    )
+
+    args = parser.parse_args()
+
+    series = FareTimeSeries(args.root)
+
+    try:
+        if args.command == "ingest":
+            for output in args.outputs:
+                series.ingest(iter_records(output))
+                print(f"ingested {output}")
+        else:
+            origin = int(args.origin) if args.origin.isdigit() else args.origin
+            destination = (
+                int(args.destination) if args.destination.isdigit() else args.destination
+            )
+            for row in series.fare_history(
+                origin, destination, days=args.days, by_hour=args.by_hour
+            ):
+                print(row)
+    finally:
+        series.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+import os
+import json
+import time
+import tempfile
+import threading
+from typing import Any, Dict
+
+
+class FileCacheException(Exception): ...
+
+
+class FileCache:
+    """
+    A tiny json-backed key/value store where every entry has its own expiry.
+
+    It is meant to keep small pieces of state (such as the api credentials) between
+    runs of the crawlers. The whole file is rewritten atomically on every change,
+    so it should not be used for large payloads.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _load(self) -> Dict[str, Dict[str, Any]]:
+        try:
+            with open(self.path, "r") as file:
+                entries = json.loads(file.read())
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError):
+            # a corrupted cache is just a cold cache
+            return {}
+
+        if not isinstance(entries, dict):
+            return {}
+
+        return entries
+
+    def _dump(self, entries: Dict[str, Dict[str, Any]]) -> None:
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".cache-")
+        try:
+            # the cache may hold credentials, keep it private to the user.
+            os.chmod(tmp_path, 0o600)
+            with os.fdopen(fd, "w") as file:
+                file.write(json.dumps(entries))
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise FileCacheException(
+                f"Could not write cache file -> {self.path} <- {repr(e)}"
+            )
+
+    def get(self, key: str) -> Any | None:
+        """
+        returns:
+            The value stored under key or None if it is missing or expired.
+        """
+        with self._lock:
+            entry = self._load().get(key)
+
+        if not isinstance(entry, dict):
+            return None
+
+        expires_at = entry.get("expires_at")
+
+        if not isinstance(expires_at, (int, float)) or expires_at <= time.time():
+            return None
+
+        return entry.get("value")
+
+    def set(self, key: str, value: Any, ttl: float) -> None:
+        """
+        Stores a json serializable value under key for ttl seconds.
+        """
+        with self._lock:
+            entries = self._load()
+            entries[key] = {"value": value, "expires_at": time.time() + ttl}
+            self._dump(entries)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            entries = self._load()
+            if entries.pop(key, None) != None:
+                self._dump(entries)
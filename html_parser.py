@@ -0,0 +1,123 @@
+import os
+import glob
+import json
+import argparse
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List
+from lxml import html
+from selenium_crawler import PAGE_XPATHS, build_results
+
+
+class HtmlParserException(Exception): ...
+
+
+def _text(root: Any, xpath: str) -> str | None:
+    elements = root.xpath(xpath)
+
+    if not elements:
+        return None
+
+    # as the rendered text (selenium's .text), without the markup whitespace
+    return " ".join(elements[0].text_content().split())
+
+
+def parse_page(page_source: str) -> Dict[str, Any]:
+    """
+    returns:
+        The services page in the structure of selenium_crawler.extract_page, read
+        from its html source with lxml (no browser needed).
+    """
+    document = html.fromstring(page_source)
+
+    return {
+        "origin": _text(document, PAGE_XPATHS["origin"]),
+        "destination": _text(document, PAGE_XPATHS["destination"]),
+        "services": [
+            {
+                "departureTime": _text(service, PAGE_XPATHS["departureTime"]),
+                "travelTime": _text(service, PAGE_XPATHS["travelTime"]),
+                "offers": [
+                    {
+                        "category": _text(offer, PAGE_XPATHS["category"]),
+                        "priceTruncated": _text(offer, PAGE_XPATHS["priceTruncated"]),
+                        "priceDecimals": _text(offer, PAGE_XPATHS["priceDecimals"]),
+                    }
+                    for offer in service.xpath(PAGE_XPATHS["offer"])
+                ],
+            }
+            for service in document.xpath(PAGE_XPATHS["service"])
+        ],
+    }
+
+
+def parse_saved_page(path: str) -> List[Dict]:
+    """
+    returns:
+        The records Crawler.crawl_trips would have got from a page saved by
+        Crawler.save_page (path is its .html, next to its .json metadata).
+    """
+    metadata_path = f"{os.path.splitext(path)[0]}.json"
+
+    try:
+        with open(metadata_path, "r") as file:
+            metadata = json.loads(file.read())
+    except (OSError, ValueError):
+        raise HtmlParserException(
+            f"Could not read the metadata of the page -> {metadata_path} <-"
+        )
+
+    with open(path, "r") as file:
+        page = parse_page(file.read())
+
+    return build_results(
+        page,
+        datetime.strptime(metadata["departure_date"], "%Y-%m-%d"),
+        collected_at=metadata["collected_at"],
+    )
+
+
+def parse_pages(paths: List[str], processes: int | None = None) -> List[List[Dict]]:
+    """
+    Parses the saved pages across a pool of processes (default: one per core).
+
+    returns:
+        The records of every page (an empty list for the pages without
+        services), in the order of paths: the sorted paths of a crawl reproduce
+        its Crawler.results.
+    """
+    if processes == 1 or len(paths) <= 1:
+        return [parse_saved_page(path) for path in paths]
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        chunksize = max(1, len(paths) // ((processes or os.cpu_count() or 1) * 4))
+        return list(executor.map(parse_saved_page, paths, chunksize=chunksize))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Parses the results pages saved by crawl_from_website --save-pages."
+    )
+    parser.add_argument("pages_dir", help="directory of the saved pages")
+    parser.add_argument(
+        "--output",
+        default="./results_webcrawl.json",
+        help="where the results are written (default: ./results_webcrawl.json)",
+    )
+    parser.add_argument(
+        "--processes", type=int, default=None, help="default: one per core"
+    )
+    args = parser.parse_args()
+
+    # the names start with the crawl sequence number (see Crawler.save_page)
+    paths = sorted(glob.glob(os.path.join(args.pages_dir, "*.html")))
+    results = parse_pages(paths, processes=args.processes)
+
+    with open(args.output, "w") as file:
+        file.write(json.dumps(results))
+
+    print(f"parsed {len(paths)} pages -> {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,447 @@
+import re
+import argparse
+import datetime
+from typing import Any, Callable, Dict, List
+import requests
+from request_generator import ApiRoutesRequestGenerator
+from route_fetcher import RouteFetcher
+from file_cache import FileCache
+from retry import RetryBudget, RetryPolicy
+from selenium_crawler import EXTRACTION_MODES, Crawler
+from browser_pool import BrowserPool
+from crawl_output import JsonArrayWriter, NdjsonWriter, open_writer
+from crawl_from_api import fetch_trips, parse_api_response
+import crawl_from_website
+
+
+class HybridCrawlException(Exception): ...
+
+
+# the datetime formats found in the api and website outputs
+DATETIME_FORMATS = (
+    "%Y-%m-%dT%H:%M:%S",
+    "%Y-%m-%dT%H:%M",
+    "%Y-%m-%dT%H%M",
+    "%Y-%m-%d %H:%M:%S",
+)
+
+
+def parse_price(price: float | int | str | None) -> float | None:
+    """
+    returns:
+        The price as a float ("R$ 1.189,90" becomes 1189.9), or None if there
+        is no price (an offer sold out on the website).
+    """
+    if price == None or isinstance(price, (int, float)):
+        return None if price == None else float(price)
+
+    digits = re.sub(r"[^0-9,.]", "", price)
+
+    if digits == "":
+        return None
+
+    if "," in digits:
+        # brazilian format: dots group the thousands, a comma the decimals
+        digits = digits.replace(".", "").replace(",", ".")
+
+    try:
+        return float(digits)
+    except ValueError:
+        raise HybridCrawlException(f"Cannot parse the price -> {price} <-")
+
+
+def iso_datetime(value: str | None) -> str | None:
+    """
+    returns:
+        The datetime as YYYY-MM-DDTHH:MM:SS, whichever of DATETIME_FORMATS it
+        was written in.
+    """
+    if value == None:
+        return None
+
+    for datetime_format in DATETIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, datetime_format).isoformat()
+        except ValueError:
+            continue
+
+    raise HybridCrawlException(f"Cannot parse the datetime -> {value} <-")
+
+
+def _utc_now() -> str:
+    return datetime.datetime.now(tz=datetime.timezone.utc).isoformat(timespec="seconds")
+
+
+def normalize_service(
+    service: Dict[str, Any],
+    unit: Dict[str, Any],
+    stations: Dict[int, str],
+    source: str,
+    collected_at: str,
+) -> Dict[str, Any]:
+    """
+    returns:
+        A getRoutes service (from the api or the website network mode) in the
+        normalized schema (see normalize_website_row).
+    """
+    origin_id = service.get("originId") or unit["from"]
+    destination_id = service.get("destinationId") or unit["to"]
+    free_seats = service.get("freeSeats")
+
+    return {
+        "source": source,
+        "serviceId": service.get("serviceId"),
+        "originId": origin_id,
+        "originDesc": stations.get(origin_id, service.get("originDesc")),
+        "destinationId": destination_id,
+        "destinationDesc": stations.get(destination_id, service.get("destinationDesc")),
+        "departureDate": iso_datetime(service.get("departureDate")),
+        "arrivalDate": iso_datetime(service.get("arrivalDate")),
+        "price": parse_price(service.get("price")),
+        "class": service.get("class"),
+        "company": service.get("company"),
+        "freeSeats": free_seats,
+        "totalSeats": service.get("totalSeats"),
+        # unknown (None) without a seat count, rather than available
+        "isAvailable": free_seats > 0 if isinstance(free_seats, int) else None,
+        "collected_at": collected_at,
+    }
+
+
+def normalize_website_row(
+    row: Dict[str, Any], unit: Dict[str, Any], stations: Dict[int, str]
+) -> Dict[str, Any]:
+    """
+    returns:
+        An offer of selenium_crawler.build_results in the normalized schema:
+        the api keys, with the price as a float (None when sold out), the
+        datetimes as ISO strings and the stations named as in the api locales.
+        What the website does not show (serviceId, company and seats) is None.
+    """
+    collected_at = row.get("collected_at")
+    if collected_at != None:
+        collected_at = (
+            datetime.datetime.strptime(collected_at, "%Y-%m-%d %H:%M:%S")
+            .replace(tzinfo=datetime.timezone.utc)
+            .isoformat()
+        )
+
+    price = parse_price(row.get("price"))
+
+    return {
+        "source": "website",
+        "serviceId": None,
+        "originId": unit["from"],
+        "originDesc": stations.get(unit["from"], row.get("originDesc")),
+        "destinationId": unit["to"],
+        "destinationDesc": stations.get(unit["to"], row.get("destinationDesc")),
+        "departureDate": iso_datetime(row.get("departureDate")),
+        "arrivalDate": iso_datetime(row.get("arrivalDate")),
+        "price": price,
+        "class": row.get("category"),
+        "company": None,
+        "freeSeats": None,
+        "totalSeats": None,
+        "isAvailable": price != None,
+        "collected_at": collected_at,
+    }
+
+
+def normalize_website_results(
+    pages: List[List[Dict[str, Any]]],
+    unit: Dict[str, Any],
+    stations: Dict[int, str],
+) -> List[Dict[str, Any]]:
+    """
+    returns:
+        The normalized records of the pages a Crawler got for unit, whichever
+        its mode (the network mode already gives getRoutes services).
+    """
+    records = []
+
+    for page in pages:
+        for row in page:
+            if "serviceId" in row:
+                records += [normalize_service(row, unit, stations, "website", _utc_now())]
+            else:
+                records += [normalize_website_row(row, unit, stations)]
+
+    return records
+
+
+def build_units(
+    req_gen: ApiRoutesRequestGenerator,
+    days: int,
+    today: datetime.date | None = None,
+) -> List[Dict[str, Any]]:
+    """
+    returns:
+        A unit per trip of crawl_from_website.challenge_list_of_trips and
+        departure day: the getRoutes trip ({"from", "to", "departureDate"}, with
+        the locale ids) along with the website names of the stations
+        ("departure", "arrival"), so the same unit can be crawled either way.
+    """
+    today = datetime.date.today() if today == None else today
+    units = []
+
+    for day in range(days):
+        departure_date = (today + datetime.timedelta(days=day)).strftime("%Y-%m-%d")
+
+        for trip in crawl_from_website.challenge_list_of_trips:
+            for departure, arrival in trip.items():
+                origin_id = req_gen.api.get_locale_id(departure)
+                destination_id = req_gen.api.get_locale_id(arrival)
+
+                if origin_id == None or destination_id == None:
+                    raise HybridCrawlException(
+                        f"No api locale matches the trip -> {departure} to {arrival} <-"
+                    )
+
+                units += [
+                    {
+                        "from": origin_id,
+                        "to": destination_id,
+                        "departureDate": departure_date,
+                        "departure": departure,
+                        "arrival": arrival,
+                    }
+                ]
+
+    return units
+
+
+def crawl_hybrid(
+    req_gen: ApiRoutesRequestGenerator,
+    fetcher: RouteFetcher,
+    crawler: Crawler,
+    units: List[Dict[str, Any]],
+    writer: NdjsonWriter | JsonArrayWriter,
+    workers: int = 1,
+    pages_per_driver: int = 25,
+    driver_factory: Callable[[], Any] | None = None,
+) -> Dict[str, int]:
+    """
+    Crawls every unit through getRoutes, and only the units whose call failed
+    (an invalid response, or none at all: a timeout, a connection reset...) or
+    came back without services through the website (with a BrowserPool of
+    workers browsers). Both are written to writer in the same normalized schema.
+
+    returns:
+        How many units were crawled by the "api", by the "website" and how many
+        "failed" both ways.
+    """
+    stations = {locale["id"]: locale["city"] for locale in req_gen.api.locales_info}
+    fallback: List[Dict[str, Any]] = []
+
+    def handle_response(unit: Dict[str, Any], response: requests.Response) -> None:
+        _, record = parse_api_response(response)
+        response.close()
+
+        services = [] if record == None else record["result"].get("servicesList") or []
+
+        if not services:
+            fallback.append(unit)
+            return
+
+        collected_at = _utc_now()
+        for service in services:
+            writer.write(normalize_service(service, unit, stations, "api", collected_at))
+
+    def handle_error(unit: Dict[str, Any], error: requests.RequestException) -> None:
+        # no response at all (timeout, connection reset...), left to the browser
+        print(
+            f"getRoutes failed for {unit['departure']} to {unit['arrival']} -> {error}"
+        )
+        fallback.append(unit)
+
+    fetch_trips(req_gen, fetcher, units, handle_response, handle_error)
+
+    summary = {"api": len(units) - len(fallback), "website": 0, "failed": 0}
+
+    if not fallback:
+        return summary
+
+    print(f"{len(fallback)} of {len(units)} units left to the browser.")
+
+    units_by_job = {
+        (
+            unit["departure"],
+            unit["arrival"],
+            datetime.datetime.strptime(unit["departureDate"], "%Y-%m-%d"),
+        ): unit
+        for unit in fallback
+    }
+
+    def on_done(job, pages) -> None:
+        for record in normalize_website_results(pages, units_by_job[job], stations):
+            writer.write(record)
+
+    pool = BrowserPool(
+        crawler,
+        workers=workers,
+        pages_per_driver=pages_per_driver,
+        on_done=on_done,
+        driver_factory=driver_factory,
+    )
+    failed = pool.run(units_by_job.keys())
+
+    for (departure, arrival, departure_date), error in failed:
+        print(
+            f"Could not crawl {departure} to {arrival} at "
+            f"{departure_date:%Y-%m-%d} either way -> {error}"
+        )
+
+    summary["website"] = len(fallback) - len(failed)
+    summary["failed"] = len(failed)
+
+    return summary
+
+
+def parse_args(argv: List[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Crawls the challenge routes through the jcatlm api, falling "
+        "back to the website only for the routes the api failed or had no services."
+    )
+    parser.add_argument(
+        "--days",
+        type=int,
+        default=8,
+        help="number of departure dates crawled, starting today (default: 8)",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=8,
+        help="maximum number of getRoutes requests in flight at once (default: 8)",
+    )
+    parser.add_argument(
+        "--max-attempts",
+        type=int,
+        default=4,
+        help="attempts per request on transient failures (default: 4)",
+    )
+    parser.add_argument(
+        "--retry-budget",
+        type=int,
+        default=200,
+        help="maximum number of retries for the whole run (default: 200)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="headless browsers crawling the fallback units at once (default: 1)",
+    )
+    parser.add_argument(
+        "--pages-per-driver",
+        type=int,
+        default=25,
+        help="searches after which a browser is replaced by a fresh one "
+        "(default: 25)",
+    )
+    parser.add_argument(
+        "--mode",
+        choices=EXTRACTION_MODES,
+        default="script",
+        help="how the browser reads the services page (see crawl_from_website.py, "
+        "default: script)",
+    )
+    parser.add_argument(
+        "--wait-timeout",
+        type=float,
+        default=30,
+        help="seconds the browser waits for each element to load (default: 30)",
+    )
+    parser.add_argument(
+        "--api-url",
+        default="https://api.jcatlm.com.br/",
+        help="base url of the jcatlm api (default: https://api.jcatlm.com.br/)",
+    )
+    parser.add_argument(
+        "--site-url",
+        default="https://www.viacaocometa.com.br/",
+        help="base url of the website, used to authenticate and as the browser "
+        "fallback (default: https://www.viacaocometa.com.br/)",
+    )
+    parser.add_argument(
+        "--credentials-cache",
+        default="./.api_credentials.json",
+        help="file where the api credentials are kept between runs "
+        "(default: ./.api_credentials.json)",
+    )
+    parser.add_argument(
+        "--locales-cache",
+        default="./.api_locales.json",
+        help="file where the searchOrigin locales are kept between runs "
+        "(default: ./.api_locales.json)",
+    )
+    parser.add_argument(
+        "--output-format",
+        choices=["json", "ndjson"],
+        default="json",
+        help="json writes a single array, ndjson one record per line (default: json)",
+    )
+    parser.add_argument(
+        "--output",
+        default=None,
+        help="file for the normalized records (default: ./result_hybrid.<format>)",
+    )
+
+    return parser.parse_args(argv)
+
+
+def main(argv: List[str] | None = None) -> None:
+    args = parse_args(argv)
+
+    retry_policy = RetryPolicy(
+        max_attempts=args.max_attempts, budget=RetryBudget(args.retry_budget)
+    )
+
+    req_gen = ApiRoutesRequestGenerator(
+        credential_cache=FileCache(args.credentials_cache),
+        locales_cache=FileCache(args.locales_cache),
+        retry_policy=retry_policy,
+        pool_size=args.concurrency,
+        api_url=args.api_url,
+        site_url=args.site_url,
+    )
+
+    fetcher = RouteFetcher(
+        max_in_flight=args.concurrency,
+        session=req_gen.api.session,
+        retry_policy=retry_policy,
+        timeout=req_gen.api.timeout,
+    )
+
+    crawler = Crawler(args.site_url, wait_timeout=args.wait_timeout, mode=args.mode)
+
+    units = build_units(req_gen, args.days)
+    writer = open_writer(
+        args.output or f"./result_hybrid.{args.output_format}", args.output_format
+    )
+
+    print(f"Crawling {len(units)} units, api first.")
+
+    try:
+        summary = crawl_hybrid(
+            req_gen,
+            fetcher,
+            crawler,
+            units,
+            writer,
+            workers=args.workers,
+            pages_per_driver=args.pages_per_driver,
+        )
+    finally:
+        fetcher.close()
+        writer.close()
+
+    print(
+        f"{summary['api']} units from the api, {summary['website']} from the website, "
+        f"{summary['failed']} failed."
+    )
+    print(f"The output has been written to {writer.path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+import json
+import time
+import logging
+import functools
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Iterator, List, Sequence, Tuple
+
+
+# seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# bytes
+SIZE_BUCKETS = (1_000, 10_000, 50_000, 100_000, 250_000, 500_000, 1_000_000, 5_000_000)
+
+# structured (one json object per line) log of every timed stage. Silent unless
+# a handler is attached, see log_to_file.
+logger = logging.getLogger("crawl_metrics")
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: Dict[str, Any]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _render_labels(labels: Labels, extra: Tuple[str, str] | None = None) -> str:
+    pairs = list(labels) + ([extra] if extra != None else [])
+
+    if not pairs:
+        return ""
+
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in pairs) + "}"
+
+
+class Metrics:
+    """
+    A thread-safe registry of counters and histograms, rendered in the Prometheus
+    text format (render_prometheus, write_prometheus or serve).
+
+    Stages of the crawl are measured with time() (or the timed decorator), which
+    records crawler_stage_duration_seconds and crawler_stage_total{outcome} and
+    writes a json line to the crawl_metrics logger.
+    """
+
+    def __init__(self, prefix: str = "crawler_") -> None:
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._counters: Dict[str, Dict[Labels, float]] = {}
+        self._histograms: Dict[str, Dict[Labels, List[Any]]] = {}
+        self._buckets: Dict[str, Sequence[float]] = {}
+        self._help: Dict[str, str] = {}
+
+    def inc(self, name: str, value: float = 1, help: str = "", **labels: Any) -> None:
+        key = _labels(labels)
+
+        with self._lock:
+            series = self._counters.setdefault(self.prefix + name, {})
+            series[key] = series.get(key, 0) + value
+            if help:
+                self._help[self.prefix + name] = help
+
+    def observe(
+        self,
+        name: str,
+        value: float,
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+        help: str = "",
+        **labels: Any,
+    ) -> None:
+        key = _labels(labels)
+        name = self.prefix + name
+
+        with self._lock:
+            bounds = self._buckets.setdefault(name, tuple(buckets))
+            series = self._histograms.setdefault(name, {})
+            # [per bucket counts, sum, count]
+            histogram = series.setdefault(key, [[0] * len(bounds), 0.0, 0])
+
+            for index, bound in enumerate(bounds):
+                if value <= bound:
+                    histogram[0][index] += 1
+
+            histogram[1] += value
+            histogram[2] += 1
+
+            if help:
+                self._help[name] = help
+
+    @contextmanager
+    def time(self, stage: str, **labels: Any) -> Iterator[Dict[str, Any]]:
+        """
+        Measures the block as a stage of the crawl.
+
+        yields:
+            A dict of extra fields that the block may fill in for the json log.
+        """
+        extra: Dict[str, Any] = {}
+        outcome = "ok"
+        started = time.perf_counter()
+
+        try:
+            yield extra
+        except BaseException:
+            outcome = "error"
+            raise
+        finally:
+            duration = time.perf_counter() - started
+
+            self.observe(
+                "stage_duration_seconds",
+                duration,
+                help="Duration of each stage of the crawl pipeline.",
+                stage=stage,
+                **labels,
+            )
+            self.inc(
+                "stage_total",
+                help="Stages run, by outcome.",
+                stage=stage,
+                outcome=outcome,
+            )
+
+            if logger.isEnabledFor(logging.INFO):
+                logger.info(
+                    json.dumps(
+                        {
+                            "ts": round(time.time(), 3),
+                            "stage": stage,
+                            "duration_s": round(duration, 6),
+                            "outcome": outcome,
+                            **labels,
+                            **extra,
+                        },
+                        default=str,
+                    )
+                )
+
+    def render_prometheus(self) -> str:
+        lines: List[str] = []
+
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                if name in self._help:
+                    lines += [f"# HELP {name} {self._help[name]}"]
+                lines += [f"# TYPE {name} counter"]
+                for labels, value in series.items():
+                    lines += [f"{name}{_render_labels(labels)} {value}"]
+
+            for name, series in sorted(self._histograms.items()):
+                if name in self._help:
+                    lines += [f"# HELP {name} {self._help[name]}"]
+                lines += [f"# TYPE {name} histogram"]
+                bounds = self._buckets[name]
+
+                for labels, (counts, total, count) in series.items():
+                    for bound, bucket_count in zip(bounds, counts):
+                        le = ("le", f"{bound:g}")
+                        lines += [
+                            f"{name}_bucket{_render_labels(labels, le)} {bucket_count}"
+                        ]
+                    lines += [
+                        f"{name}_bucket{_render_labels(labels, ('le', '+Inf'))} {count}",
+                        f"{name}_sum{_render_labels(labels)} {total}",
+                        f"{name}_count{_render_labels(labels)} {count}",
+                    ]
+
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: str) -> None:
+        with open(path, "w") as file:
+            file.write(self.render_prometheus())
+
+    def serve(self, port: int, host: str = "0.0.0.0") -> ThreadingHTTPServer:
+        """
+        Serves the metrics at http://host:port/metrics from a daemon thread.
+
+        returns:
+            The server, to be shutdown() by the caller.
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *_) -> None:
+                return
+
+            def do_GET(self) -> None:
+                if self.path != "/metrics":
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+
+                body = metrics.render_prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        return server
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+            self._buckets.clear()
+
+
+# the registry used by the crawlers
+METRICS = Metrics()
+
+
+def timed(stage: str) -> Callable:
+    """
+    Decorator measuring every call of the function as a stage in METRICS.
+    """
+
+    def decorator(function: Callable) -> Callable:
+        @functools.wraps(function)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            with METRICS.time(stage):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def log_to_file(path: str) -> logging.Handler:
+    """
+    Sends the json stage log to path, one object per line.
+    """
+    handler = logging.FileHandler(path)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+    return handler
+
+
+def record_response(route: str, status_code: int, size: int) -> None:
+    """
+    Counts a getRoutes response by status code and records its size.
+    """
+    METRICS.inc(
+        "responses_total", help="getRoutes responses, by status code.", status=status_code
+    )
+    METRICS.observe(
+        "response_bytes",
+        size,
+        buckets=SIZE_BUCKETS,
+        help="Size of the getRoutes response bodies, by route.",
+        route=route,
+    )
@@ -0,0 +1,309 @@
+import re
+import json
+import time
+import random
+import datetime
+import threading
+import itertools
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Tuple
+
+
+class MockApiException(Exception): ...
+
+
+AUTHORIZATION_PATH = "/content/jca/cometa/pt-br/jcr:content.authorization.json"
+
+_DATE = re.compile(r"\d{4}-\d{2}-\d{2}")
+
+
+class MockJcatlmApi:
+    """
+    A local stand-in for both www.viacaocometa.com.br (client id and authorization)
+    and api.jcatlm.com.br (login, searchOrigin and getRoutes), so the crawlers can
+    be exercised and measured offline.
+
+    getRoutes answers with the records of a recorded crawl output (result_api.json
+    by default), shifting their dates to the requested departureDate. Routes that
+    are not in the recording get an empty servicesList, as routes without
+    services do.
+
+    args:
+        latency: seconds added to every getRoutes answer
+        jitter: extra random seconds (uniform between 0 and jitter) on top of latency
+        error_rate: fraction of getRoutes calls answered with a 503 (Retry-After: 0)
+
+    The getRoutes calls of the (origin, destination) routes in dropped_routes get
+    their connection closed without an answer, as a connection reset would.
+
+    Usage:
+        with MockJcatlmApi() as mock:
+            ApiConnector(api_url=mock.url, site_url=mock.url)
+    """
+
+    client_id = "mock-client-id"
+    authorization_id = "mock-authorization-id"
+
+    def __init__(
+        self,
+        recording: str = "./result_api.json",
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        error_rate: float = 0.0,
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ) -> None:
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+
+        self._lock = threading.Lock()
+        self._token_counter = itertools.count(1)
+        self.valid_tokens: set = set()
+        self.calls: Dict[str, int] = {}
+        # tcp connections accepted, to tell keep-alive reuse apart from reconnects
+        self.connections = 0
+        self.dropped_routes: set = set()
+
+        self._templates, self.locales = self._load_recording(recording)
+
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self.server.daemon_threads = True
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    @staticmethod
+    def _load_recording(
+        recording: str,
+    ) -> Tuple[Dict[Tuple[int, int], Tuple[datetime.date, Dict]], List[Dict]]:
+        with open(recording, "r") as file:
+            records = json.loads(file.read())
+
+        templates: Dict[Tuple[int, int], Tuple[datetime.date, Dict]] = {}
+        locales: Dict[int, str] = {}
+
+        for record in records:
+            result = record.get("result") or {}
+            services = result.get("servicesList") or []
+
+            if not services:
+                continue
+
+            for service in services:
+                locales[service["originId"]] = service["originDesc"]
+                locales[service["destinationId"]] = service["destinationDesc"]
+
+            key = (result["origin"]["id"], result["destination"]["id"])
+            if key not in templates:
+                template = {"success": True, "result": result}
+                templates[key] = (
+                    datetime.date.fromisoformat(result["date"][:10]),
+                    template,
+                )
+
+        if not templates:
+            raise MockApiException(f"No services found in the recording {recording}")
+
+        return templates, [
+            {"id": locale_id, "city": city} for locale_id, city in locales.items()
+        ]
+
+    def revoke_tokens(self) -> None:
+        """
+        Invalidates every issued access token (as an expiry would).
+        """
+        with self._lock:
+            self.valid_tokens.clear()
+
+    def _count(self, endpoint: str) -> None:
+        with self._lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+
+    def _issue_token(self) -> str:
+        token = f"mock-token-{next(self._token_counter)}"
+
+        with self._lock:
+            self.valid_tokens.add(token)
+
+        return token
+
+    def _is_authorized(self, headers: Any) -> bool:
+        with self._lock:
+            return (
+                headers.get("Client_id") == self.client_id
+                and headers.get("Access_token") in self.valid_tokens
+            )
+
+    def _routes_body(self, body: Dict[str, Any]) -> str:
+        origin = body.get("origin")
+        destination = body.get("destination")
+        requested = datetime.date.fromisoformat(body.get("departureDate"))
+
+        if (origin, destination) not in self._templates:
+            return json.dumps(
+                {
+                    "success": True,
+                    "result": {
+                        "origin": {"id": origin},
+                        "destination": {"id": destination},
+                        "date": f"{requested.isoformat()}T00:00:00",
+                        "servicesList": [],
+                    },
+                }
+            )
+
+        recorded, template = self._templates[(origin, destination)]
+        shift = requested - recorded
+
+        def shift_date(match: re.Match) -> str:
+            date = datetime.date.fromisoformat(match.group(0)) + shift
+            return date.isoformat()
+
+        return _DATE.sub(shift_date, json.dumps(template))
+
+    def _handler_class(self) -> type:
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self) -> None:
+                super().setup()
+                with mock._lock:
+                    mock.connections += 1
+
+            def log_message(self, *_) -> None:
+                return
+
+            def _answer(
+                self, status: int, body: str, content_type: str = "application/json"
+            ) -> None:
+                payload = body.encode()
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(payload)))
+                if status == 503:
+                    self.send_header("Retry-After", "0")
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self) -> None:
+                path = self.path.split("?")[0]
+
+                if path == "/":
+                    mock._count("home")
+                    return self._answer(
+                        200,
+                        f'<html><body><input id="clientId" value="{mock.client_id}">'
+                        "</body></html>",
+                        content_type="text/html",
+                    )
+
+                if path == AUTHORIZATION_PATH:
+                    mock._count("authorization")
+                    return self._answer(
+                        200,
+                        json.dumps(
+                            {
+                                "isSuccess": True,
+                                "result": {"authorizationId": mock.authorization_id},
+                            }
+                        ),
+                    )
+
+                if path == "/place/v1/searchOrigin":
+                    mock._count("searchOrigin")
+                    if not mock._is_authorized(self.headers):
+                        return self._answer(401, '{"message": "Unauthorized"}')
+                    return self._answer(
+                        200, json.dumps({"success": True, "result": mock.locales})
+                    )
+
+                self._answer(404, '{"message": "Not found"}')
+
+            def do_POST(self) -> None:
+                length = int(self.headers.get("Content-Length") or 0)
+                raw_body = self.rfile.read(length)
+
+                if self.path == "/oauth/v3/login":
+                    mock._count("login")
+                    if self.headers.get("Authorization") != mock.authorization_id:
+                        return self._answer(401, '{"message": "Unauthorized"}')
+                    return self._answer(
+                        200, json.dumps({"access_token": mock._issue_token()})
+                    )
+
+                if self.path == "/route/v1/getRoutes":
+                    mock._count("getRoutes")
+                    if not mock._is_authorized(self.headers):
+                        return self._answer(401, '{"message": "Unauthorized"}')
+
+                    delay = mock.latency + random.uniform(0, mock.jitter)
+                    if delay > 0:
+                        time.sleep(delay)
+
+                    if random.random() < mock.error_rate:
+                        return self._answer(503, '{"message": "Service Unavailable"}')
+
+                    try:
+                        request = json.loads(raw_body)
+                        route = (request.get("origin"), request.get("destination"))
+                    except (ValueError, AttributeError):
+                        return self._answer(400, '{"success": false}')
+
+                    if route in mock.dropped_routes:
+                        self.close_connection = True
+                        return
+
+                    try:
+                        body = mock._routes_body(request)
+                    except (ValueError, TypeError):
+                        return self._answer(400, '{"success": false}')
+
+                    return self._answer(200, body)
+
+                self._answer(404, '{"message": "Not found"}')
+
+        return Handler
+
+    def start(self) -> "MockJcatlmApi":
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self) -> "MockJcatlmApi":
+        return self.start()
+
+    def __exit__(self, *_) -> None:
+        self.stop()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serves a local mock jcatlm api.")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    with MockJcatlmApi(
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        port=args.port,
+    ) as mock:
+        print(f"Serving the mock api at {mock.url} (ctrl+c to stop)")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,507 @@
+import time
+import signal
+import argparse
+import threading
+from typing import Any, Callable, Dict, List, Set, Tuple
+import requests
+from api_connector import ApiConnectorException
+from request_generator import ApiRoutesRequestGenerator
+from route_fetcher import RouteFetcher
+from file_cache import FileCache
+from retry import RetryBudget, RetryPolicy
+from crawl_planner import CrawlPlanner, all_routes
+from crawl_journal import CrawlJournal
+from service_store import ServiceStore
+from fare_timeseries import FareTimeSeries
+from rate_limit import TokenBucket, limit_session
+from metrics import METRICS, log_to_file
+from crawl_output import NdjsonWriter, open_writer
+from crawl_from_api import (
+    Observer,
+    challenge_routes,
+    fetch_trips,
+    write_error,
+    write_response,
+)
+
+
+class PollingDaemonException(Exception): ...
+
+
+class PollingDaemon:
+    """
+    Keeps polling the getRoutes of a set of routes, over a horizon of days, in a
+    single long-running process: the credentials, the locales and the connection
+    pool of req_gen are set up once and reused by every cycle.
+
+    Every cycle polls the (route, day) units the planner reports as due, at most
+    cycle_budget of them, most overdue first. Each unit is due again after its own
+    refresh interval, shorter for the routes whose services (prices, free seats)
+    changed on recent polls and longer for the static ones (see CrawlPlanner).
+    Between cycles the daemon sleeps until the next unit is due. The units whose
+    call failed are backed off by the planner, and a cycle where nothing succeeded
+    (the api down, the credentials rejected...) is followed by failure_sleep
+    seconds of sleep, whatever is due. So is a cycle stopped by a network or login
+    error (e.g. the api unreachable when logging in again), whose units not polled
+    yet are reported to the planner as failed.
+
+    The planner state is saved after every cycle, so a restarted daemon picks up
+    where it stopped.
+
+    args:
+        handle_response: takes every (trip, response) of a cycle, returning
+        whether the response was valid (as crawl_from_api.write_response does)
+
+        handle_error: takes every (trip, error) of the calls that failed without
+        a response (as crawl_from_api.write_error does)
+
+    ALERT: the request rate is not capped here; see rate_limit.limit_session,
+    which main mounts on the connector session.
+    """
+
+    def __init__(
+        self,
+        req_gen: ApiRoutesRequestGenerator,
+        fetcher: RouteFetcher,
+        planner: CrawlPlanner,
+        handle_response: Callable[[Dict[str, Any], requests.Response], Any],
+        handle_error: Callable[[Dict[str, Any], requests.RequestException], Any],
+        cycle_budget: int | None = None,
+        credentials_refresh: float | None = None,
+        idle_sleep: float = 60,
+        failure_sleep: float = 30,
+        on_cycle_end: Callable[[], Any] | None = None,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.req_gen = req_gen
+        self.fetcher = fetcher
+        self.planner = planner
+        self.handle_response = handle_response
+        self.handle_error = handle_error
+        self.cycle_budget = cycle_budget
+        self.credentials_refresh = credentials_refresh
+        self.idle_sleep = idle_sleep
+        self.failure_sleep = failure_sleep
+        self.on_cycle_end = on_cycle_end
+        self.clock = clock
+
+        self.cycles = 0
+        self.polled = 0
+        # units of the last cycle whose response handle_response took as valid
+        self.last_valid = 0
+        self._stop = threading.Event()
+        self._authenticated_at = clock()
+
+    def keep_credentials_warm(self) -> None:
+        """
+        Logs in again once the credentials are credentials_refresh seconds old,
+        before the api starts rejecting them mid cycle.
+        """
+        if self.credentials_refresh == None:
+            return
+
+        if self.clock() - self._authenticated_at >= self.credentials_refresh:
+            print("Refreshing credentials.")
+            self.req_gen.api.refresh_credentials()
+            self._authenticated_at = self.clock()
+
+    def run_cycle(self) -> int:
+        """
+        Polls the units due now.
+
+        returns:
+            How many units were polled.
+
+        raises:
+            The requests.RequestException or ApiConnectorException that stopped
+            the cycle, once its units not polled yet are reported to the planner
+            through observe_failure.
+        """
+        trips: List[Dict[str, Any]] = []
+        # the units handled, valid or not, before the cycle (possibly) stopped
+        handled: Set[Tuple[str, str, str]] = set()
+        self.last_valid = 0
+
+        def handled_key(trip: Dict[str, Any]) -> Tuple[str, str, str]:
+            return CrawlJournal.key(
+                trip.get("from"), trip.get("to"), trip.get("departureDate")
+            )
+
+        def handle_response(trip: Dict[str, Any], response: requests.Response) -> None:
+            handled.add(handled_key(trip))
+
+            if self.handle_response(trip, response):
+                self.last_valid += 1
+
+        def handle_error(trip: Dict[str, Any], error: requests.RequestException) -> None:
+            handled.add(handled_key(trip))
+            self.handle_error(trip, error)
+
+        try:
+            self.keep_credentials_warm()
+
+            trips = self.planner.plan(budget=self.cycle_budget)
+
+            if trips:
+                with METRICS.time("polling_cycle"):
+                    fetch_trips(
+                        self.req_gen, self.fetcher, trips, handle_response, handle_error
+                    )
+
+        except (requests.RequestException, ApiConnectorException):
+            for trip in trips:
+                if handled_key(trip) not in handled:
+                    self.planner.observe_failure(trip)
+            raise
+
+        finally:
+            if trips:
+                self.planner.save()
+
+            if self.on_cycle_end != None:
+                self.on_cycle_end()
+
+            self.cycles += 1
+            self.polled += len(trips)
+            METRICS.inc(
+                "polled_units_total", len(trips), help="Units polled by the daemon."
+            )
+
+        return len(trips)
+
+    def run(self, max_cycles: int | None = None) -> None:
+        """
+        Runs cycles until stop() is called (or max_cycles of them ran).
+        """
+        cycles = 0
+
+        while not self._stop.is_set() and (max_cycles == None or cycles < max_cycles):
+            try:
+                polled = self.run_cycle()
+                failed = polled > 0 and self.last_valid == 0
+            except (requests.RequestException, ApiConnectorException) as error:
+                print(f"The cycle stopped -> {error!r}")
+                polled, failed = 0, True
+
+            cycles += 1
+
+            if failed:
+                # nothing succeeded: give the api some rest before trying again
+                wait = self.failure_sleep
+            elif polled > 0 and polled == self.cycle_budget:
+                # the budget ran out, there may be due units left
+                continue
+            else:
+                wait = min(self.idle_sleep, self.planner.next_due_in())
+
+            if wait > 0 and (max_cycles == None or cycles < max_cycles):
+                print(f"Polled {polled} units. Next poll in {wait:.0f}s.")
+                self._stop.wait(wait)
+
+    def stop(self, *_: Any) -> None:
+        """
+        Makes run() return once the current cycle is done (also usable as a
+        signal handler).
+        """
+        self._stop.set()
+
+
+def parse_args(argv: List[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Keeps polling the getRoutes of the jcatlm api, each (route, "
+        "day) on its own refresh interval, until interrupted."
+    )
+    parser.add_argument(
+        "--days",
+        type=int,
+        default=8,
+        help="number of departure dates polled, starting today (default: 8)",
+    )
+    parser.add_argument(
+        "--routes",
+        choices=["challenge", "all"],
+        default="challenge",
+        help="challenge polls challenge_list_of_trips; all polls every pair of "
+        "searchOrigin locales (default: challenge)",
+    )
+    parser.add_argument(
+        "--max-rate",
+        type=float,
+        default=2,
+        help="hard cap on the requests per second sent to the api, retries and "
+        "logins included (default: 2)",
+    )
+    parser.add_argument(
+        "--burst",
+        type=int,
+        default=None,
+        help="requests that may go out at once under --max-rate "
+        "(default: --concurrency)",
+    )
+    parser.add_argument(
+        "--cycle-budget",
+        type=int,
+        default=None,
+        help="maximum number of units polled by a cycle (default: every due unit)",
+    )
+    parser.add_argument(
+        "--max-cycles",
+        type=int,
+        default=None,
+        help="stops after this many cycles (default: runs until interrupted)",
+    )
+    parser.add_argument(
+        "--idle-sleep",
+        type=float,
+        default=60,
+        help="maximum seconds slept between cycles (default: 60)",
+    )
+    parser.add_argument(
+        "--failure-sleep",
+        type=float,
+        default=30,
+        help="seconds slept after a cycle where every call failed (default: 30)",
+    )
+    parser.add_argument(
+        "--planner-state",
+        default="./.crawl_planner_state.json",
+        help="when each unit was last polled and how volatile each route is "
+        "(default: ./.crawl_planner_state.json)",
+    )
+    parser.add_argument(
+        "--min-refresh",
+        type=float,
+        default=3600,
+        help="seconds a poll of today's departures stays fresh (default: 3600)",
+    )
+    parser.add_argument(
+        "--max-refresh",
+        type=float,
+        default=86400,
+        help="seconds after which any unit is due again (default: 86400)",
+    )
+    parser.add_argument(
+        "--credentials-refresh",
+        type=float,
+        default=25 * 60,
+        help="seconds after which the daemon logs in again (default: 1500)",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=4,
+        help="maximum number of getRoutes requests in flight at once (default: 4)",
+    )
+    parser.add_argument(
+        "--connect-timeout",
+        type=float,
+        default=5,
+        help="seconds to wait for a connection to the api (default: 5)",
+    )
+    parser.add_argument(
+        "--read-timeout",
+        type=float,
+        default=30,
+        help="seconds to wait for an api response (default: 30)",
+    )
+    parser.add_argument(
+        "--max-attempts",
+        type=int,
+        default=4,
+        help="attempts per request on transient failures (default: 4)",
+    )
+    parser.add_argument(
+        "--retry-budget",
+        type=int,
+        default=200,
+        help="maximum number of retries per cycle (default: 200)",
+    )
+    parser.add_argument(
+        "--api-url",
+        default="https://api.jcatlm.com.br/",
+        help="base url of the jcatlm api (default: https://api.jcatlm.com.br/)",
+    )
+    parser.add_argument(
+        "--site-url",
+        default="https://www.viacaocometa.com.br/",
+        help="base url of the website used to authenticate "
+        "(default: https://www.viacaocometa.com.br/)",
+    )
+    parser.add_argument(
+        "--credentials-cache",
+        default="./.api_credentials.json",
+        help="file where the api credentials are kept between runs "
+        "(default: ./.api_credentials.json)",
+    )
+    parser.add_argument(
+        "--locales-cache",
+        default="./.api_locales.json",
+        help="file where the searchOrigin locales are kept between runs "
+        "(default: ./.api_locales.json)",
+    )
+    parser.add_argument(
+        "--output",
+        default="./result_api.ndjson",
+        help="ndjson file the valid responses are appended to "
+        "(default: ./result_api.ndjson)",
+    )
+    parser.add_argument(
+        "--invalid-output",
+        default="./result_api_invalid.ndjson",
+        help="ndjson file the failed calls are appended to "
+        "(default: ./result_api_invalid.ndjson)",
+    )
+    parser.add_argument(
+        "--sqlite",
+        default=None,
+        help="also ingests the valid responses into this SQLite database",
+    )
+    parser.add_argument(
+        "--timeseries",
+        default=None,
+        help="also appends the fares of the valid responses to the fare history "
+        "kept in this directory (see fare_timeseries.py)",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=None,
+        help="serves the metrics at http://0.0.0.0:<port>/metrics while polling",
+    )
+    parser.add_argument(
+        "--metrics-log",
+        default=None,
+        help="writes a json line per timed stage to this file",
+    )
+
+    return parser.parse_args(argv)
+
+
+def main(argv: List[str] | None = None) -> None:
+    args = parse_args(argv)
+
+    metrics_server = None
+    if args.metrics_port != None:
+        metrics_server = METRICS.serve(args.metrics_port)
+
+    if args.metrics_log != None:
+        log_to_file(args.metrics_log)
+
+    retry_budget = RetryBudget(args.retry_budget)
+    retry_policy = RetryPolicy(max_attempts=args.max_attempts, budget=retry_budget)
+
+    req_gen = ApiRoutesRequestGenerator(
+        credential_cache=FileCache(args.credentials_cache),
+        locales_cache=FileCache(args.locales_cache),
+        retry_policy=retry_policy,
+        pool_size=args.concurrency,
+        timeout=(args.connect_timeout, args.read_timeout),
+        api_url=args.api_url,
+        site_url=args.site_url,
+    )
+
+    # every request of the session from now on (getRoutes, retries and logins)
+    # takes a token first, whatever the concurrency
+    bucket = TokenBucket(args.max_rate, burst=args.burst or args.concurrency)
+    limit_session(req_gen.api.session, bucket, pool_size=args.concurrency)
+
+    if args.routes == "all":
+        routes = all_routes(req_gen.api.locales_info)
+    else:
+        routes = challenge_routes(req_gen)
+
+    planner = CrawlPlanner(
+        routes,
+        horizon_days=args.days,
+        min_interval=args.min_refresh,
+        max_interval=args.max_refresh,
+        state_path=args.planner_state,
+    )
+
+    fetcher = RouteFetcher(
+        max_in_flight=args.concurrency,
+        session=req_gen.api.session,
+        retry_policy=retry_policy,
+        timeout=req_gen.api.timeout,
+    )
+
+    valid_writer: NdjsonWriter = open_writer(args.output, "ndjson", append=True)
+    invalid_writer: NdjsonWriter = open_writer(
+        args.invalid_output, "ndjson", append=True
+    )
+
+    observers: List[Observer] = [planner]
+
+    store = None
+    if args.sqlite != None:
+        store = ServiceStore(args.sqlite)
+        observers += [store]
+
+    timeseries = None
+    if args.timeseries != None:
+        timeseries = FareTimeSeries(args.timeseries)
+        observers += [timeseries]
+
+    def handle_response(trip: Dict[str, Any], response: requests.Response) -> bool:
+        return write_response(
+            trip, response, valid_writer, invalid_writer, None, observers
+        )
+
+    def handle_error(trip: Dict[str, Any], error: requests.RequestException) -> bool:
+        return write_error(trip, error, valid_writer, invalid_writer, None, observers)
+
+    def on_cycle_end() -> None:
+        # every cycle gets the whole retry budget, and leaves its data readable
+        retry_budget.reset()
+
+        if store != None:
+            store.flush()
+
+        if timeseries != None:
+            timeseries.flush()
+
+    daemon = PollingDaemon(
+        req_gen,
+        fetcher,
+        planner,
+        handle_response,
+        handle_error,
+        cycle_budget=args.cycle_budget,
+        credentials_refresh=args.credentials_refresh,
+        idle_sleep=args.idle_sleep,
+        failure_sleep=args.failure_sleep,
+        on_cycle_end=on_cycle_end,
+    )
+
+    previous_handlers = {
+        signum: signal.signal(signum, daemon.stop)
+        for signum in (signal.SIGINT, signal.SIGTERM)
+    }
+
+    print(f"Polling {len(routes)} routes over {args.days} days.")
+
+    try:
+        daemon.run(max_cycles=args.max_cycles)
+    finally:
+        fetcher.close()
+        valid_writer.close()
+        invalid_writer.close()
+        planner.save()
+
+        if store != None:
+            store.close()
+
+        if timeseries != None:
+            timeseries.close()
+
+        if metrics_server != None:
+            metrics_server.shutdown()
+
+        for signum, handler in previous_handlers.items():
+            signal.signal(signum, handler)
+
+    print(f"Stopped after {daemon.cycles} cycles and {daemon.polled} polled units.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+import time
+import threading
+from typing import Any, Callable
+import requests
+from requests.adapters import HTTPAdapter
+from metrics import METRICS
+
+
+class RateLimitException(Exception): ...
+
+
+class TokenBucket:
+    """
+    A thread-safe token bucket: rate tokens a second, up to burst of them saved.
+
+    acquire() blocks until a token is available, so no more than
+    burst + rate * seconds calls get through in any window of seconds.
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        burst: float = 1,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], Any] = time.sleep,
+    ) -> None:
+        if rate <= 0 or burst < 1:
+            raise RateLimitException(
+                f"rate should be positive and burst at least 1 -> {rate}, {burst} <-"
+            )
+
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.sleep = sleep
+
+        self._lock = threading.Lock()
+        self._tokens = float(burst)
+        self._updated_at = clock()
+
+    def acquire(self) -> float:
+        """
+        returns:
+            The seconds waited for the token.
+        """
+        waited = 0.0
+
+        while True:
+            with self._lock:
+                now = self.clock()
+                self._tokens = min(
+                    self.burst, self._tokens + (now - self._updated_at) * self.rate
+                )
+                self._updated_at = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+
+                delay = (1 - self._tokens) / self.rate
+
+            self.sleep(delay)
+            waited += delay
+
+
+class RateLimitedAdapter(HTTPAdapter):
+    """
+    An HTTPAdapter taking a token from the bucket before every request it sends,
+    retries included, so whatever goes through the session respects the rate.
+    """
+
+    def __init__(self, bucket: TokenBucket, **adapter_kwargs: Any) -> None:
+        self.bucket = bucket
+        super().__init__(**adapter_kwargs)
+
+    def send(self, request: requests.PreparedRequest, **kwargs: Any) -> requests.Response:
+        waited = self.bucket.acquire()
+
+        if waited > 0:
+            METRICS.observe(
+                "rate_limit_wait_seconds",
+                waited,
+                help="Time requests waited for the global rate limit.",
+            )
+
+        return super().send(request, **kwargs)
+
+
+def limit_session(
+    session: requests.Session, bucket: TokenBucket, pool_size: int = 10
+) -> None:
+    """
+    Mounts a RateLimitedAdapter (with a pool of pool_size connections per host)
+    for both http and https on session.
+    """
+    adapter = RateLimitedAdapter(bucket, pool_connections=2, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
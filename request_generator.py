@@ -1,6 +1,9 @@
 import requests
 from api_connector import ApiConnector
-from typing import Dict, List, Any
+from file_cache import FileCache
+from retry import RetryPolicy
+from metrics import METRICS, timed
+from typing import Any, Deque, Dict, Iterable, Iterator, List, Tuple
 
 
 class RequestGenerator:
@@ -19,8 +22,25 @@ class ApiRoutesRequestGenerator(RequestGenerator):
     using viacaocometa.com.br credentials
     """
 
-    def __init__(self) -> None:
-        self.api = ApiConnector()
+    def __init__(
+        self,
+        credential_cache: FileCache | None = None,
+        locales_cache: FileCache | None = None,
+        retry_policy: RetryPolicy | None = None,
+        pool_size: int = 10,
+        timeout: float | Tuple[float, float] = (5, 30),
+        api_url: str = "https://api.jcatlm.com.br/",
+        site_url: str = "https://www.viacaocometa.com.br/",
+    ) -> None:
+        self.api = ApiConnector(
+            credential_cache=credential_cache,
+            locales_cache=locales_cache,
+            retry_policy=retry_policy,
+            pool_size=pool_size,
+            timeout=timeout,
+            api_url=api_url,
+            site_url=site_url,
+        )
         self.api.set_locales_info()
         self.requests = []
         self.trips = []
@@ -81,6 +101,7 @@ class ApiRoutesRequestGenerator(RequestGenerator):
         self.trips = []
         self.add_trips(trips=trips, departure_date=departure_date)
 
+    @timed("generate_requests")
     def generate_requests(self) -> None:
         """
         Populates the requests property with proper api authentication according to the
@@ -90,10 +111,47 @@ class ApiRoutesRequestGenerator(RequestGenerator):
 
         """
         for trip in self.trips:
-            self.requests += [
-                self.api.prepare_route_request(
-                    origin_id=trip.get("from"),
-                    destination_id=trip.get("to"),
-                    departure_date=trip.get("departureDate"),
-                )
-            ]
+            self.requests += [self.prepare_trip_request(trip)]
+
+    def prepare_trip_request(self, trip: Dict[str, Any]) -> requests.PreparedRequest:
+        """
+        returns:
+            The getRoutes request of a single trip, authenticated with the credentials
+            the ApiConnector holds right now.
+        """
+        with METRICS.time("prepare_request"):
+            return self.api.prepare_route_request(
+                origin_id=trip.get("from"),
+                destination_id=trip.get("to"),
+                departure_date=trip.get("departureDate"),
+            )
+
+    def iter_requests(
+        self,
+        trips: Iterable[Dict[str, Any]] | None = None,
+        retry_queue: Deque[Dict[str, Any]] | None = None,
+    ) -> Iterator[Tuple[Dict[str, Any], requests.PreparedRequest]]:
+        """
+        Lazy counterpart of generate_requests: yields (trip, prepared_request) tuples
+        one at a time, preparing each request only when the consumer asks for the
+        next one. Consumed by RouteFetcher.fetch_all, that happens when a slot frees
+        up, so only about max_in_flight requests exist at once and each of them
+        carries the credentials current at send time (a refresh_credentials() in the
+        middle of the crawl applies to every request prepared after it).
+
+        Args:
+            trips: the trips to prepare, self.trips by default.
+
+            retry_queue: trips appended to it while iterating (e.g. after a 401) are
+            yielded before the next planned trip.
+        """
+        for trip in self.trips if trips == None else trips:
+            while retry_queue:
+                retry_trip = retry_queue.popleft()
+                yield retry_trip, self.prepare_trip_request(retry_trip)
+
+            yield trip, self.prepare_trip_request(trip)
+
+        while retry_queue:
+            retry_trip = retry_queue.popleft()
+            yield retry_trip, self.prepare_trip_request(retry_trip)
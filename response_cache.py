@@ -0,0 +1,340 @@
+import os
+import glob
+import json
+import time
+import hashlib
+import datetime
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Tuple
+import requests
+from requests.structures import CaseInsensitiveDict
+from metrics import METRICS
+
+
+class ResponseCacheException(Exception): ...
+
+
+# (stored_at, status_code, headers, content)
+Entry = Tuple[float, int, Dict[str, str], bytes]
+
+
+class _InFlight:
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.entry: Entry | None = None
+
+
+class ResponseCache:
+    """
+    Caches the getRoutes responses by their normalized request (method, url and
+    json body, but not the credentials headers), so duplicate trips in a plan
+    and reruns during development do not download the same payload again.
+
+    Entries expire after ttl seconds. At most max_entries are kept in memory,
+    evicting the least recently used; with a directory, the entries are also kept
+    on disk (one file per entry), where the memory misses are looked up. At most
+    max_disk_entries files are kept there: the expired ones are removed when
+    found, and the oldest ones once there are too many.
+
+    Identical requests in flight at the same time (from different threads) are
+    coalesced: only the first one is sent, the others wait for its response.
+
+    Only 200 responses are cached.
+
+    ALERT: a cached response carries the prices and seats of when it was fetched,
+    so the ttl should stay short for anything but development.
+    """
+
+    def __init__(
+        self,
+        ttl: float = 300,
+        max_entries: int = 1024,
+        directory: str | None = None,
+        max_disk_entries: int = 16384,
+    ) -> None:
+        if max_entries < 1 or max_disk_entries < 1:
+            raise ResponseCacheException(
+                f"max_entries and max_disk_entries should be at least 1 "
+                f"-> {max_entries}, {max_disk_entries} <-"
+            )
+
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.directory = directory
+        self.max_disk_entries = max_disk_entries
+
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, Entry] = OrderedDict()
+        self._in_flight: Dict[str, _InFlight] = {}
+        # files in directory, as far as this cache knows (others may share it)
+        self._disk_entries = 0
+
+        if directory != None:
+            os.makedirs(directory, exist_ok=True)
+            self._disk_entries = len(self._disk_paths())
+
+    @staticmethod
+    def key(request: requests.PreparedRequest) -> str:
+        """
+        returns:
+            A hash of the request method, url and (normalized) json body.
+        """
+        body = request.body or b""
+
+        if isinstance(body, str):
+            body = body.encode()
+
+        try:
+            body = json.dumps(json.loads(body), sort_keys=True, separators=(",", ":"))
+        except ValueError:
+            body = body.decode(errors="replace")
+
+        return hashlib.blake2b(
+            f"{request.method} {request.url} {body}".encode(), digest_size=16
+        ).hexdigest()
+
+    def fetch(
+        self,
+        request: requests.PreparedRequest,
+        send: Callable[[], requests.Response],
+    ) -> requests.Response:
+        """
+        returns:
+            The cached response to request, or else the one returned by send(),
+            which is only called if no identical request is already in flight.
+        """
+        key = self.key(request)
+        entry = self._get(key)
+
+        if entry == None:
+            with self._lock:
+                # it may have been stored while the disk was read
+                entry = self._get_remembered(key)
+
+                if entry == None:
+                    in_flight = self._in_flight.get(key)
+                    leader = in_flight == None
+                    if leader:
+                        in_flight = self._in_flight[key] = _InFlight()
+
+        if entry != None:
+            METRICS.inc("response_cache_total", help="getRoutes cache lookups.", result="hit")
+            return _build_response(request, entry)
+
+        if not leader:
+            METRICS.inc(
+                "response_cache_total", help="getRoutes cache lookups.", result="coalesced"
+            )
+            in_flight.done.wait()
+            if in_flight.entry == None:
+                # the leader failed before getting any response, try on our own
+                return send()
+            return _build_response(request, in_flight.entry)
+
+        METRICS.inc("response_cache_total", help="getRoutes cache lookups.", result="miss")
+
+        try:
+            response = send()
+            entry = (
+                time.time(),
+                response.status_code,
+                dict(response.headers),
+                response.content,
+            )
+            in_flight.entry = entry
+
+            if response.status_code == 200:
+                self._set(key, entry)
+
+            return response
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+            in_flight.done.set()
+
+    def _get(self, key: str) -> Entry | None:
+        """
+        returns:
+            The fresh entry of key, from memory or else from the disk (read
+            without holding the lock), None if there is none.
+        """
+        with self._lock:
+            entry = self._get_remembered(key)
+
+        if entry != None or self.directory == None:
+            return entry
+
+        entry = self._read(key)
+
+        if entry == None:
+            return None
+
+        if self._expired(entry):
+            self._unlink(key)
+            return None
+
+        with self._lock:
+            self._remember(key, entry)
+
+        return entry
+
+    def _get_remembered(self, key: str) -> Entry | None:
+        # with the lock held
+        entry = self._entries.get(key)
+
+        if entry == None:
+            return None
+
+        if self._expired(entry):
+            self._entries.pop(key, None)
+            return None
+
+        self._entries.move_to_end(key)
+        return entry
+
+    def _expired(self, entry: Entry) -> bool:
+        return entry[0] + self.ttl <= time.time()
+
+    def _set(self, key: str, entry: Entry) -> None:
+        with self._lock:
+            self._remember(key, entry)
+
+        if self.directory != None:
+            self._write(key, entry)
+
+    def _remember(self, key: str, entry: Entry) -> None:
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _disk_paths(self) -> List[str]:
+        return glob.glob(os.path.join(self.directory, "*.json"))
+
+    def _unlink(self, key: str) -> None:
+        try:
+            os.unlink(self._path(key))
+        except OSError:
+            # already gone, e.g. removed by another process sharing directory
+            return
+
+        with self._lock:
+            self._disk_entries -= 1
+
+    def _read(self, key: str) -> Entry | None:
+        try:
+            with open(self._path(key), "r") as file:
+                stored = json.loads(file.read())
+            return (
+                stored["stored_at"],
+                stored["status_code"],
+                stored["headers"],
+                stored["content"].encode(),
+            )
+        except (OSError, ValueError, KeyError, TypeError):
+            # a missing or corrupted entry is just a miss
+            return None
+
+    def _write(self, key: str, entry: Entry) -> None:
+        stored_at, status_code, headers, content = entry
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=".entry-")
+        with os.fdopen(fd, "w") as file:
+            file.write(
+                json.dumps(
+                    {
+                        "stored_at": stored_at,
+                        "status_code": status_code,
+                        "headers": headers,
+                        "content": content.decode(errors="replace"),
+                    }
+                )
+            )
+
+        replaced = os.path.exists(self._path(key))
+        os.replace(tmp_path, self._path(key))
+
+        with self._lock:
+            self._disk_entries += 0 if replaced else 1
+            full = self._disk_entries > self.max_disk_entries
+
+        if full:
+            self._evict_disk()
+
+    def _evict_disk(self) -> None:
+        """
+        Removes the expired files of directory, and then the oldest ones down to
+        90% of max_disk_entries, so the eviction is not run on every write.
+        """
+        paths = []
+
+        for path in self._disk_paths():
+            try:
+                paths += [(os.path.getmtime(path), path)]
+            except OSError:
+                continue
+
+        paths.sort()
+        now = time.time()
+        keep = int(self.max_disk_entries * 0.9)
+        removed = 0
+
+        for index, (modified_at, path) in enumerate(paths):
+            if modified_at + self.ttl > now and len(paths) - index <= keep:
+                break
+
+            try:
+                os.unlink(path)
+                removed += 1
+            except OSError:
+                continue
+
+        with self._lock:
+            self._disk_entries = len(paths) - removed
+
+        METRICS.inc(
+            "response_cache_evicted_total",
+            removed,
+            help="Response cache files removed from the disk.",
+        )
+
+    def clear(self) -> None:
+        """
+        Drops every entry, from memory and from directory.
+        """
+        with self._lock:
+            self._entries.clear()
+
+        if self.directory == None:
+            return
+
+        for path in self._disk_paths():
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+
+        with self._lock:
+            self._disk_entries = 0
+
+
+def _build_response(request: requests.PreparedRequest, entry: Entry) -> requests.Response:
+    _, status_code, headers, content = entry
+
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers = CaseInsensitiveDict(headers)
+    response._content = content
+    response._content_consumed = True
+    response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+    response.url = request.url
+    response.request = request
+    response.elapsed = datetime.timedelta(0)
+
+    return response
@@ -0,0 +1,163 @@
+import time
+import random
+import datetime
+import threading
+import requests
+from email.utils import parsedate_to_datetime
+from typing import Any, Callable
+
+
+class RetryException(Exception): ...
+
+
+# gateway and throttling errors are worth a second attempt, the others are not
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# statuses whose Retry-After header is honored
+RETRY_AFTER_STATUS_CODES = {429, 503}
+
+
+class RetryBudget:
+    """
+    Limits how many retries a whole run may spend, shared by every caller (and
+    thread) using it, so that an api outage fails fast instead of retrying each
+    request to exhaustion.
+    """
+
+    def __init__(self, max_retries: int) -> None:
+        self.max_retries = max_retries
+        self.spent = 0
+        self._lock = threading.Lock()
+
+    def try_spend(self) -> bool:
+        """
+        returns:
+            True if a retry could be taken from the budget.
+        """
+        with self._lock:
+            if self.spent >= self.max_retries:
+                return False
+            self.spent += 1
+            return True
+
+    @property
+    def remaining(self) -> int:
+        with self._lock:
+            return self.max_retries - self.spent
+
+    def reset(self) -> None:
+        """
+        Gives the whole budget back (e.g. at every cycle of a long-running crawl).
+        """
+        with self._lock:
+            self.spent = 0
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """
+    returns:
+        The seconds to wait as stated by a Retry-After header (either delta-seconds
+        or an http-date), or None if it is missing or malformed.
+    """
+    if value == None:
+        return None
+
+    value = value.strip()
+
+    if value.isdigit():
+        return float(value)
+
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+
+    if retry_at.tzinfo == None:
+        retry_at = retry_at.replace(tzinfo=datetime.timezone.utc)
+
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+
+    return max(0.0, (retry_at - now).total_seconds())
+
+
+class RetryPolicy:
+    """
+    Sends requests retrying transient failures (connection errors, timeouts and
+    RETRYABLE_STATUS_CODES) with exponential backoff and full jitter.
+
+    Retry-After is honored on 429/503 (up to max_retry_after seconds). Every retry
+    is taken from the budget, when one is given; once it runs out, the last
+    response is returned (or the last error raised) as if no retry layer existed.
+    """
+
+    def __init__(
+        self,
+        max_attempts: int = 4,
+        base_delay: float = 0.5,
+        max_delay: float = 30.0,
+        max_retry_after: float = 120.0,
+        budget: RetryBudget | None = None,
+        sleep: Callable[[float], Any] = time.sleep,
+    ) -> None:
+        if max_attempts < 1:
+            raise RetryException(f"max_attempts should be at least 1 -> {max_attempts} <-")
+
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after
+        self.budget = budget
+        self.sleep = sleep
+
+    def delay_for(self, attempt: int, response: requests.Response | None) -> float:
+        """
+        returns:
+            The seconds to wait before the retry that follows the attempt-th
+            (0 based) attempt.
+        """
+        if response != None and response.status_code in RETRY_AFTER_STATUS_CODES:
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            if retry_after != None:
+                return min(retry_after, self.max_retry_after)
+
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+    def send(
+        self,
+        session: requests.Session,
+        request: requests.PreparedRequest,
+        **send_kwargs: Any,
+    ) -> requests.Response:
+        """
+        returns:
+            The first non retryable response, or the last one once the attempts
+            (or the budget) run out.
+
+        args:
+            send_kwargs: passed along to session.send (e.g. timeout)
+        """
+        for attempt in range(self.max_attempts):
+            is_last_attempt = attempt == self.max_attempts - 1
+
+            try:
+                response = session.send(request, **send_kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if is_last_attempt or not self._can_retry():
+                    raise
+                self.sleep(self.delay_for(attempt, None))
+                continue
+
+            if response.status_code not in RETRYABLE_STATUS_CODES:
+                return response
+
+            if is_last_attempt or not self._can_retry():
+                return response
+
+            delay = self.delay_for(attempt, response)
+            response.close()
+            self.sleep(delay)
+
+        raise RetryException("Unreachable: the last attempt always returns or raises.")
+
+    def _can_retry(self) -> bool:
+        return self.budget == None or self.budget.try_spend()
@@ -0,0 +1,149 @@
+import requests
+from requests.adapters import HTTPAdapter
+from retry import RetryPolicy
+from response_cache import ResponseCache
+from metrics import METRICS, record_response
+from concurrent.futures import ThreadPoolExecutor, Future, FIRST_COMPLETED, wait
+from typing import Dict, Iterable, Iterator, Tuple, Any
+
+
+class RouteFetcherException(Exception): ...
+
+
+# the response of a request, or the transport error it failed with
+FetchResult = requests.Response | requests.RequestException
+
+
+class RouteFetcher:
+    """
+    Sends the getRoutes requests (as prepared by the ApiRoutesRequestGenerator)
+    concurrently, keeping at most max_in_flight requests on the wire at once.
+
+    Every response is yielded as soon as it completes, paired with the trip it was
+    generated from, so callers never rely on the completion order to know which
+    (origin, destination, date) a response belongs to. A request that still fails
+    at the transport level (timeout, connection reset...) once its retries are
+    spent is yielded the same way, with its requests.RequestException in place of
+    the response, and the other requests carry on.
+
+    max_in_flight=1 reproduces the old one-by-one behaviour. Transient failures are
+    retried through the retry_policy, when one is given.
+
+    The session should be the ApiConnector one, so the same warm connections serve
+    every call; its pool should then hold at least max_in_flight connections.
+
+    With a response_cache, repeated requests are answered from it and identical
+    requests in flight at once are sent only once.
+    """
+
+    def __init__(
+        self,
+        max_in_flight: int = 8,
+        session: requests.Session | None = None,
+        retry_policy: RetryPolicy | None = None,
+        timeout: float | Tuple[float, float] | None = None,
+        response_cache: ResponseCache | None = None,
+    ) -> None:
+        if max_in_flight < 1:
+            raise RouteFetcherException(
+                f"max_in_flight should be at least 1 -> {max_in_flight} <-"
+            )
+
+        self.max_in_flight = max_in_flight
+
+        if session == None:
+            # one connection per worker, otherwise urllib3 discards the extra
+            # connections and every request pays a new handshake.
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_maxsize=max_in_flight)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+
+        self.session = session
+        self.retry_policy = retry_policy
+        self.timeout = timeout
+        self.response_cache = response_cache
+
+    def _send(
+        self, trip: Dict[str, Any], request: requests.PreparedRequest
+    ) -> requests.Response:
+        if self.response_cache != None:
+            return self.response_cache.fetch(
+                request, lambda: self._send_uncached(trip, request)
+            )
+
+        return self._send_uncached(trip, request)
+
+    def _send_uncached(
+        self, trip: Dict[str, Any], request: requests.PreparedRequest
+    ) -> requests.Response:
+        route = f"{trip.get('from')}-{trip.get('to')}"
+        # session.send skips the environment (proxies, CA bundle) that session.get
+        # applies, and a different verify would even open a pool of its own.
+        settings = self.session.merge_environment_settings(
+            request.url, {}, None, None, None
+        )
+
+        with METRICS.time("get_routes", route=route) as extra:
+            if self.retry_policy != None:
+                response = self.retry_policy.send(
+                    self.session, request, timeout=self.timeout, **settings
+                )
+            else:
+                response = self.session.send(request, timeout=self.timeout, **settings)
+
+            # reads the body here, in the worker thread, rather than in the
+            # consumer of fetch_all.
+            extra["status"] = response.status_code
+            extra["bytes"] = len(response.content)
+
+        record_response(route, response.status_code, len(response.content))
+
+        return response
+
+    def fetch_all(
+        self, jobs: Iterable[Tuple[Dict[str, Any], requests.PreparedRequest]]
+    ) -> Iterator[Tuple[Dict[str, Any], FetchResult]]:
+        """
+        returns:
+            An iterator of (trip, response) tuples in completion order, where
+            response is the requests.RequestException of the failed requests.
+
+        args:
+            jobs: an iterable of (trip, prepared_request) tuples. It is consumed
+            lazily: a new job is only pulled once a slot is free.
+        """
+        jobs_iter = iter(jobs)
+
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as executor:
+            pending: Dict[Future, Dict[str, Any]] = {}
+
+            def submit_next() -> bool:
+                try:
+                    trip, request = next(jobs_iter)
+                except StopIteration:
+                    return False
+
+                pending[executor.submit(self._send, trip, request)] = trip
+                return True
+
+            for _ in range(self.max_in_flight):
+                if not submit_next():
+                    break
+
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    trip = pending.pop(future)
+
+                    try:
+                        result: FetchResult = future.result()
+                    except requests.RequestException as error:
+                        result = error
+
+                    yield trip, result
+                    submit_next()
+
+    def close(self) -> None:
+        self.session.close()
@@ -1,35 +1,323 @@
 from urllib.parse import urlparse, parse_qs
 from datetime import datetime, timedelta, timezone
-from time import sleep
+import os
+import json
+import uuid
+import base64
+import time
+import itertools
+import threading
+from typing import Any, Callable, Dict, List, Tuple
 from selenium import webdriver
 from selenium.webdriver.common.by import By
-from selenium.common.exceptions import NoSuchElementException
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.webdriver.support.ui import WebDriverWait
+from selenium.common.exceptions import (
+    NoSuchElementException,
+    StaleElementReferenceException,
+    TimeoutException,
+)
+from metrics import METRICS
 
 
 class CrawlerException(Exception): ...
 
 
+# sensible to ui changes.
+RESULTS_LOCATOR = (By.CLASS_NAME, "list-companies-item")
+SPINNER_LOCATOR = (By.CSS_SELECTOR, ".loading, .spinner, [data-js='loading']")
+# shown instead of the list when the trip has no departures on the date
+EMPTY_RESULTS_LOCATOR = (
+    By.CSS_SELECTOR,
+    "[data-js='no-results'], .no-results, .empty-results, .list-companies-empty",
+)
+
+# dom: one WebDriver command per element of the page
+# script: the whole page in a single execute_script round trip
+# network: the getRoutes json the page is rendered from (chrome only)
+EXTRACTION_MODES = ("dom", "script", "network")
+
+ROUTES_API_PATH = "route/v1/getRoutes"
+
+# numbers the saved pages in the order they were crawled, across the crawlers of
+# a process, and after the pages of earlier runs (it starts at the current time)
+_page_sequence = itertools.count(time.time_ns())
+_page_sequence_lock = threading.Lock()
+
+
+def _has_class(name: str) -> str:
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+
+# sensible to ui changes. The service and offer xpaths are relative to them.
+PAGE_XPATHS = {
+    "origin": "//*[@data-js='summary-label-origin']",
+    "destination": "//*[@data-js='summary-label-destination']",
+    "service": f"//*[{_has_class('list-companies-item')}]",
+    "departureTime": f".//*[{_has_class('header')}]"
+    "//span[@class='edit-text-departure-label']/following-sibling::span",
+    "travelTime": ".//div[@class='duration']/p/*[@data-js='durationLabel']",
+    "offer": ".//li[starts-with(@data-js, 'offer-element-')]",
+    "category": ".//span[@class='classtypeLabel']/*[1]/*[1]",
+    "priceTruncated": f".//*[{_has_class('price')}]//*[{_has_class('price-label')}]",
+    "priceDecimals": f".//*[{_has_class('price')}]//*[{_has_class('decimal-label')}]",
+}
+
+# returns the same structure as extract_page, in a single round trip
+EXTRACT_PAGE_SCRIPT = """
+const xpaths = arguments[0];
+const first = (root, xpath) => document.evaluate(
+    xpath, root, null, XPathResult.FIRST_ORDERED_NODE_TYPE, null
+).singleNodeValue;
+const all = (root, xpath) => {
+    const found = document.evaluate(
+        xpath, root, null, XPathResult.ORDERED_NODE_SNAPSHOT_TYPE, null
+    );
+    const nodes = [];
+    for (let i = 0; i < found.snapshotLength; i++) nodes.push(found.snapshotItem(i));
+    return nodes;
+};
+const text = (root, xpath) => {
+    const node = first(root, xpath);
+    return node === null ? null : node.innerText.trim();
+};
+
+return {
+    origin: text(document, xpaths.origin),
+    destination: text(document, xpaths.destination),
+    services: all(document, xpaths.service).map((service) => ({
+        departureTime: text(service, xpaths.departureTime),
+        travelTime: text(service, xpaths.travelTime),
+        offers: all(service, xpaths.offer).map((offer) => ({
+            category: text(offer, xpaths.category),
+            priceTruncated: text(offer, xpaths.priceTruncated),
+            priceDecimals: text(offer, xpaths.priceDecimals),
+        })),
+    })),
+};
+"""
+
+
+def _text(root: Any, xpath: str) -> str | None:
+    elements = root.find_elements(By.XPATH, xpath)
+
+    return elements[0].text if elements else None
+
+
+def extract_page(driver: webdriver.Remote) -> Dict[str, Any]:
+    """
+    returns:
+        The services page as {origin, destination, services: [{departureTime,
+        travelTime, offers: [{category, priceTruncated, priceDecimals}]}]},
+        with None for the texts not found.
+
+    ALERT: takes a WebDriver command per element; EXTRACT_PAGE_SCRIPT returns the
+    same in one.
+    """
+    return {
+        "origin": _text(driver, PAGE_XPATHS["origin"]),
+        "destination": _text(driver, PAGE_XPATHS["destination"]),
+        "services": [
+            {
+                "departureTime": _text(service, PAGE_XPATHS["departureTime"]),
+                "travelTime": _text(service, PAGE_XPATHS["travelTime"]),
+                "offers": [
+                    {
+                        "category": _text(offer, PAGE_XPATHS["category"]),
+                        "priceTruncated": _text(offer, PAGE_XPATHS["priceTruncated"]),
+                        "priceDecimals": _text(offer, PAGE_XPATHS["priceDecimals"]),
+                    }
+                    for offer in service.find_elements(By.XPATH, PAGE_XPATHS["offer"])
+                ],
+            }
+            for service in driver.find_elements(By.XPATH, PAGE_XPATHS["service"])
+        ],
+    }
+
+
+def build_results(
+    page: Dict[str, Any], departure_date: datetime, collected_at: str | None = None
+) -> List[Dict]:
+    """
+    returns:
+        A record per offer of the page extracted (by extract_page,
+        EXTRACT_PAGE_SCRIPT or html_parser.parse_page) from the services of
+        departure_date.
+
+    args:
+        collected_at: when the page was read (default: now, in utc)
+    """
+    result_json = []
+    if collected_at == None:
+        collected_at = datetime.now(tz=timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+    for service in page["services"]:
+        departure_time = service["departureTime"]
+        travel_time = service["travelTime"]
+
+        if departure_time == None or travel_time == None:
+            raise CrawlerException(
+                f"Could not find the departure or travel time of a service -> {service} <-"
+            )
+
+        departure_datetime = datetime.strptime(
+            f"{departure_date.strftime('%Y-%m-%d')} {departure_time}",
+            "%Y-%m-%d %H:%M",
+        )
+
+        if travel_time.find("h") == -1:
+            raise CrawlerException(
+                "Cannot calculate the travel time. The code needs refactorization "
+                f"-> {travel_time} <-"
+            )
+
+        try:
+            assert len(travel_time.split("h")) >= 2
+        except Exception as e:
+            raise NotImplementedError(
+                "Cannot handle html formmated that way. The travel time "
+                f"{travel_time} is not formatted as expected (%Hh%Mmin)"
+            )
+
+        mins = travel_time.split("h")[1]
+
+        mins = mins[:2] if len(mins) == 5 else mins
+
+        arrival_datetime = departure_datetime + timedelta(
+            hours=int(travel_time.split("h")[0]),
+            minutes=int(0 if mins == "" else mins),
+        )
+
+        for offer in service["offers"]:
+            if None in (
+                offer["category"],
+                offer["priceTruncated"],
+                offer["priceDecimals"],
+                page["origin"],
+                page["destination"],
+            ):
+                raise CrawlerException(
+                    f"Could not find every field of an offer -> {offer} <-"
+                )
+
+            price = f"{offer['priceTruncated']}{offer['priceDecimals']}"
+
+            result_json += [
+                {
+                    "collected_at": collected_at,
+                    "isAvailable": price != "",
+                    "price": price,
+                    "category": offer["category"],
+                    "originDesc": page["origin"],
+                    "destinationDesc": page["destination"],
+                    "departureDate": f"{departure_date.strftime('%Y-%m-%d')}T{departure_time}",
+                    "arrivalDate": f"{arrival_datetime.strftime('%Y-%m-%dT%H%M')}",
+                }
+            ]
+
+    return result_json
+
+
 class Crawler:
     """
     Handles the crawling process given a driver (context)
     Does not manage context to allow for parrallelization in case its necessary
     """
 
-    def __init__(self, base_url: str, trips=[]) -> None:
+    def __init__(
+        self,
+        base_url: str,
+        trips=[],
+        wait_timeout: float = 30,
+        mode: str = "dom",
+        pages_dir: str | None = None,
+    ) -> None:
+        if mode not in EXTRACTION_MODES:
+            raise CrawlerException(
+                f"Unknown extraction mode -> {mode} <- expected one of {EXTRACTION_MODES}"
+            )
+
         self.base_url = base_url
+        self.mode = mode
+        # when set, the source of every results page crawled is saved there
+        self.pages_dir = pages_dir
+
+        if pages_dir != None:
+            os.makedirs(pages_dir, exist_ok=True)
         self.is_on_base_url = True
         self.results = []
         self.trips = trips
+        self.wait_timeout = wait_timeout
+        # (name of the wait, seconds it actually took)
+        self.wait_timings: List[Tuple[str, float]] = []
+
+    def wait_for(
+        self,
+        driver: webdriver.Remote,
+        name: str,
+        condition: Callable[[webdriver.Remote], Any],
+        timeout: float | None = None,
+    ) -> Any:
+        """
+        Waits until the condition holds (polling the page), recording how long it
+        took in self.wait_timings and as the wait stage in METRICS.
+
+        returns:
+            Whatever the condition returned (usually the element waited for).
 
-    def get_driver(self) -> webdriver.Remote:
+        ALERT: raises CrawlerException if the condition does not hold within
+        timeout (default: self.wait_timeout) seconds.
+        """
+        timeout = self.wait_timeout if timeout == None else timeout
+        started = time.perf_counter()
+
+        try:
+            with METRICS.time("wait", condition=name):
+                return WebDriverWait(
+                    driver,
+                    timeout,
+                    poll_frequency=0.1,
+                    ignored_exceptions=(
+                        NoSuchElementException,
+                        StaleElementReferenceException,
+                    ),
+                ).until(condition)
+        except TimeoutException:
+            raise CrawlerException(
+                f"The page was not ready after {timeout}s -> waiting for {name} <-"
+            )
+        finally:
+            self.wait_timings += [(name, time.perf_counter() - started)]
+
+    def get_driver(self, headless: bool = False) -> webdriver.Remote:
         """
         Safely returns a webdriver
+
+        args:
+            headless: starts the browser without a window (as the pool workers do)
+
+        ALERT: the network mode reads chrome's performance log, so it does not fall
+        back to firefox.
         """
+        chrome_options = webdriver.ChromeOptions()
+        firefox_options = webdriver.FirefoxOptions()
+
+        if headless:
+            chrome_options.add_argument("--headless=new")
+            firefox_options.add_argument("-headless")
+
+        if self.mode == "network":
+            chrome_options.set_capability("goog:loggingPrefs", {"performance": "ALL"})
+
         try:
-            driver = webdriver.Chrome()
+            driver = webdriver.Chrome(options=chrome_options)
         except Exception:
+            if self.mode == "network":
+                raise CrawlerException(
+                    "Could not initialize chrome, which the network mode requires."
+                )
             try:
-                driver = webdriver.Firefox()
+                driver = webdriver.Firefox(options=firefox_options)
             except:
                 raise CrawlerException(
                     "Could not initialize webdriver. Please, ensure at"
@@ -46,98 +334,100 @@ class Crawler:
             driver: the driver in which the page has already loaded;
             departure_date: the date of the current ticket beign crawled
         """
+        if self.mode == "network":
+            # services already come in the servicesList schema of the api
+            (services,) = self.wait_for(
+                driver, "routes_response", RoutesResponseListener()
+            )
+            self.results += [services]
+            return
 
-        services = driver.find_elements(By.CLASS_NAME, "list-companies-item")
+        if self.pages_dir != None:
+            self.save_page(driver, departure_date)
 
-        result_json = []
+        with METRICS.time("extract", mode=self.mode):
+            if self.mode == "script":
+                page = driver.execute_script(EXTRACT_PAGE_SCRIPT, PAGE_XPATHS)
+            else:
+                page = extract_page(driver)
 
-        for service in services:
-            headers_info = service.find_element(By.CLASS_NAME, "header")
+        self.results += [build_results(page, departure_date)]
 
-            departure_time = headers_info.find_element(
-                By.XPATH,
-                ".//span[@class='edit-text-departure-label']/following-sibling::span",
-            ).text
+    def save_page(self, driver: webdriver.Remote, departure_date: datetime) -> str:
+        """
+        Saves the page source to self.pages_dir as <name>.html, along with a
+        <name>.json of the metadata html_parser needs to parse it offline
+        (departure_date, url, collected_at and sequence).
 
-            travel_time = service.find_element(
-                By.XPATH, ".//div[@class='duration']/p/*[@data-js='durationLabel']"
-            ).text
+        name starts with a zero padded sequence number, so sorting the names
+        gives the pages in the order they were crawled (as in self.results).
 
-            departure_datetime = datetime.strptime(
-                f"{departure_date.strftime('%Y-%m-%d')} {departure_time}",
-                "%Y-%m-%d %H:%M",
-            )
+        returns:
+            The path of the html saved.
+        """
+        with _page_sequence_lock:
+            sequence = next(_page_sequence)
 
-            if travel_time.find("h") == -1:
-                raise CrawlerException(
-                    "Cannot calculate the travel time. The code needs refactorization "
-                    f"-> {travel_time} <-"
+        # the uuid keeps apart the pages of crawls running in other processes
+        name = (
+            f"{sequence:020d}-{departure_date.strftime('%Y-%m-%d')}-"
+            f"{uuid.uuid4().hex[:12]}"
+        )
+        path = os.path.join(self.pages_dir, f"{name}.html")
+
+        with open(path, "w") as file:
+            file.write(driver.page_source)
+
+        with open(os.path.join(self.pages_dir, f"{name}.json"), "w") as file:
+            file.write(
+                json.dumps(
+                    {
+                        "departure_date": departure_date.strftime("%Y-%m-%d"),
+                        "url": driver.current_url,
+                        "collected_at": datetime.now(tz=timezone.utc).strftime(
+                            "%Y-%m-%d %H:%M:%S"
+                        ),
+                        "sequence": sequence,
+                    }
                 )
+            )
 
-            try:
-                assert len(travel_time.split("h")) >= 2
-            except Exception as e:
-                raise NotImplementedError(
-                    "Cannot handle html formmated that way. The travel time "
-                    f"{travel_time} is not formatted as expected (%Hh%Mmin)"
-                )
+        return path
 
-            mins = travel_time.split("h")[1]
+    def crawl_trip(
+        self,
+        driver: webdriver.Remote,
+        departure: str,
+        arrival: str,
+        departure_date: datetime,
+    ) -> None:
+        """
+        Loads the base url, searches for the trip and crawls its services into
+        self.results.
+        """
+        driver.get(self.base_url)  # ensure we are at the beggining of the page
 
-            mins = mins[:2] if len(mins) == 5 else mins
+        if self.mode == "network":
+            # reading the log empties it, so only this search's responses remain
+            driver.get_log("performance")
 
-            arrival_datetime = departure_datetime + timedelta(
-                hours=int(travel_time.split("h")[0]),
-                minutes=int(0 if mins == "" else mins),
-            )
+        self.search_for_trip(
+            driver=driver,
+            departure=departure,
+            arrival=arrival,
+            departure_date=departure_date,
+        )
 
-            offers = service.find_elements(
-                By.XPATH, ".//li[starts-with(@data-js, 'offer-element-')]"
-            )
+        if self.mode != "network":
+            if self.wait_for(driver, "results", _results_loaded) == "empty":
+                # no departures for the trip on that date: an empty page
+                if self.pages_dir != None:
+                    self.save_page(driver, departure_date)
 
-            for offer in offers:
-                try:
-                    category = offer.find_element(
-                        By.XPATH, ".//span[@class='classtypeLabel']/*[1]/*[1]"
-                    ).text
-
-                    price_label = offer.find_element(By.CLASS_NAME, "price")
-
-                    price_trucated = price_label.find_element(
-                        By.CLASS_NAME, "price-label"
-                    ).text
-
-                    price_decimals = price_label.find_element(
-                        By.CLASS_NAME, "decimal-label"
-                    ).text
-
-                    price = f"{price_trucated}{price_decimals}"
-
-                    departure_location = driver.find_element(
-                        By.XPATH, "//*[@data-js='summary-label-origin']"
-                    )
-                    arrival_location = driver.find_element(
-                        By.XPATH, "//*[@data-js='summary-label-destination']"
-                    )
-
-                    result_json += [
-                        {
-                            "collected_at": datetime.now(tz=timezone.utc).strftime(
-                                "%Y-%m-%d %H:%M:%s"
-                            ),
-                            "isAvailable": price != "",
-                            "price": price,
-                            "category": category,
-                            "originDesc": departure_location.text,
-                            "destinationDesc": arrival_location.text,
-                            "departureDate": f"{departure_date.strftime('%Y-%m-%d')}T{departure_time}",
-                            "arrivalDate": f"{arrival_datetime.strftime('%Y-%m-%dT%H%M')}",
-                        }
-                    ]
-                except NoSuchElementException as e:
-                    raise Exception(repr(e))
-
-            self.results += [result_json]
+                self.results += [[]]
+                return
+
+        self.crawl_trips(driver=driver, departure_date=departure_date)
 
     def search_for_trip(
         self,
@@ -155,19 +445,23 @@ class Crawler:
         assert trial <= 5  # tries at most 5 times
 
         # sensible to ui changes.
-        input_element = driver.find_element(By.ID, "input-departure")
+        input_element = self.wait_for(
+            driver,
+            "departure_input",
+            EC.element_to_be_clickable((By.ID, "input-departure")),
+        )
 
         input_element.click()
-        sleep(10)
         input_element.send_keys(departure)
-        sleep(10)
-
-        autocomplete = driver.find_element(
-            By.XPATH, f"//*[contains(text(), '{departure}')]"
-        )
 
         try:
-            autocomplete.click()
+            self.wait_for(
+                driver,
+                "departure_autocomplete",
+                EC.element_to_be_clickable(
+                    (By.XPATH, f"//*[contains(text(), '{departure}')]")
+                ),
+            ).click()
         except Exception:
             self.search_for_trip(
                 driver=driver,
@@ -178,21 +472,25 @@ class Crawler:
             )
             return
 
-        sleep(10)
-
         # now we're automatically at the arrival input field
 
-        input_element = driver.find_element(By.ID, "input-destination")
+        input_element = self.wait_for(
+            driver,
+            "destination_input",
+            EC.element_to_be_clickable((By.ID, "input-destination")),
+        )
         input_element.click()
 
         input_element.send_keys(arrival)
-        sleep(10)
-        autocomplete = driver.find_element(
-            By.XPATH, f"//*[contains(text(), '{arrival}')]"
-        )
 
         try:
-            autocomplete.click()
+            self.wait_for(
+                driver,
+                "destination_autocomplete",
+                EC.element_to_be_clickable(
+                    (By.XPATH, f"//*[contains(text(), '{arrival}')]")
+                ),
+            ).click()
         except Exception:
             self.search_for_trip(
                 driver=driver,
@@ -203,13 +501,13 @@ class Crawler:
             )
             return
 
-        sleep(10)
-
         # now we should have both departure and arrival/destination fields
 
         # filleds, and, thus, we must fill the departure date
 
-        input_element = driver.find_element(By.ID, "input-date")
+        input_element = self.wait_for(
+            driver, "date_input", EC.element_to_be_clickable((By.ID, "input-date"))
+        )
 
         input_element.click()
 
@@ -220,3 +518,76 @@ class Crawler:
         search_element.click()
 
         return
+
+
+def _results_loaded(driver: webdriver.Remote) -> str | bool:
+    """
+    returns:
+        False while the loading spinner shows, then "results" once the services
+        list is populated, or "empty" if the page tells there are no services.
+    """
+    for spinner in driver.find_elements(*SPINNER_LOCATOR):
+        if spinner.is_displayed():
+            return False
+
+    if len(driver.find_elements(*RESULTS_LOCATOR)) > 0:
+        return "results"
+
+    for marker in driver.find_elements(*EMPTY_RESULTS_LOCATOR):
+        if marker.is_displayed():
+            return "empty"
+
+    return False
+
+
+class RoutesResponseListener:
+    """
+    A wait condition reading chrome's performance log (the devtools Network
+    events) until a getRoutes response has finished loading.
+
+    returns (when called by Crawler.wait_for):
+        False while there is none, then a (servicesList,) tuple of its json body,
+        as got by Network.getResponseBody. The tuple keeps an empty servicesList
+        truthy, which WebDriverWait would otherwise take as not ready yet.
+    """
+
+    def __init__(self) -> None:
+        self.request_ids: List[str] = []
+
+    def __call__(
+        self, driver: webdriver.Remote
+    ) -> Tuple[List[Dict[str, Any]]] | bool:
+        for entry in driver.get_log("performance"):
+            message = json.loads(entry["message"])["message"]
+            method = message.get("method")
+            params = message.get("params", {})
+
+            if method == "Network.responseReceived":
+                if ROUTES_API_PATH in params["response"]["url"]:
+                    self.request_ids += [params["requestId"]]
+
+            elif (
+                method == "Network.loadingFinished"
+                and params.get("requestId") in self.request_ids
+            ):
+                return (self._services(driver, params["requestId"]),)
+
+        return False
+
+    @staticmethod
+    def _services(driver: webdriver.Remote, request_id: str) -> List[Dict[str, Any]]:
+        response = driver.execute_cdp_cmd(
+            "Network.getResponseBody", {"requestId": request_id}
+        )
+        body = response["body"]
+
+        if response.get("base64Encoded"):
+            body = base64.b64decode(body).decode()
+
+        try:
+            result = json.loads(body)["result"]
+            return result["servicesList"] or []
+        except (ValueError, KeyError, TypeError):
+            raise CrawlerException(
+                f"The getRoutes response has no servicesList -> {body[:200]} <-"
+            )
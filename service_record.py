@@ -0,0 +1,199 @@
+import sys
+import json
+from typing import Any, Dict, Tuple
+
+
+class ServiceRecordException(Exception): ...
+
+
+# every key of a getRoutes service, in the order the api sends them
+SERVICE_KEYS = (
+    "serviceId",
+    "routeId",
+    "brandId",
+    "group",
+    "originId",
+    "originDesc",
+    "destinationId",
+    "destinationDesc",
+    "lineDate",
+    "departureDate",
+    "arrivalDate",
+    "freeSeats",
+    "totalSeats",
+    "price",
+    "priceWithDiscount",
+    "discountValue",
+    "class",
+    "classMatch",
+    "company",
+    "companyId",
+    "connection",
+    "sell",
+    "bpe",
+    "km",
+    "offerId",
+    "offerType",
+    "discountTypeId",
+    "discountType",
+    "tokens",
+    "originLatitude",
+    "originLongitude",
+    "destinationLatitude",
+    "destinationLongitude",
+    "selectiveSale",
+    "xTenantId",
+    "originState",
+    "destinationState",
+    "percentagePix",
+    "discountPix",
+    "priceWithDiscountPix",
+    "categories",
+    "cnpj",
+)
+
+# keys the api has always sent as null so far; they take no room in a Service
+# (a value they happen to have is kept in Service.extra)
+NULL_KEYS = frozenset(
+    (
+        "priceWithDiscount",
+        "discountValue",
+        "classMatch",
+        "connection",
+        "offerType",
+        "discountType",
+        "tokens",
+        "originLatitude",
+        "originLongitude",
+        "destinationLatitude",
+        "destinationLongitude",
+        "originState",
+        "destinationState",
+        "categories",
+    )
+)
+
+# strings repeated across services, shared through sys.intern
+INTERNED_KEYS = frozenset(
+    (
+        "group",
+        "originDesc",
+        "destinationDesc",
+        "lineDate",
+        "class",
+        "company",
+        "xTenantId",
+        "cnpj",
+    )
+)
+
+# (api key, slot) of the stored keys; "class" is a python keyword
+_FIELDS: Tuple[Tuple[str, str], ...] = tuple(
+    (key, "class_" if key == "class" else key)
+    for key in SERVICE_KEYS
+    if key not in NULL_KEYS
+)
+_SLOT_OF = dict(_FIELDS)
+
+
+class Service:
+    """
+    A getRoutes service, kept in slots instead of a 42 keys dict: the keys that
+    are always null are not stored, and the repeated strings (company, class,
+    originDesc, group...) are interned, so a crawl holding many services takes
+    a fraction of the memory.
+
+    get() reads it as the api dict would (so the snapshot differ, the sqlite
+    store and the planner take either), and to_dict() gives the api dict back,
+    with every key, in the api order.
+    """
+
+    __slots__ = tuple(slot for _, slot in _FIELDS) + ("extra",)
+
+    @classmethod
+    def from_dict(cls, service: Dict[str, Any]) -> "Service":
+        self = cls.__new__(cls)
+
+        for key, slot in _FIELDS:
+            value = service.get(key)
+            if key in INTERNED_KEYS and isinstance(value, str):
+                value = sys.intern(value)
+            setattr(self, slot, value)
+
+        # unknown keys and the values of the (usually) null ones
+        extra = None
+        for key, value in service.items():
+            if key not in _SLOT_OF and value != None:
+                if extra == None:
+                    extra = {}
+                extra[key] = value
+
+        self.extra = extra
+
+        return self
+
+    def get(self, key: str, default: Any = None) -> Any:
+        slot = _SLOT_OF.get(key)
+
+        if slot != None:
+            value = getattr(self, slot)
+        elif self.extra != None:
+            value = self.extra.get(key)
+        else:
+            value = None
+
+        return default if value == None else value
+
+    def __getitem__(self, key: str) -> Any:
+        return self.get(key)
+
+    def to_dict(self) -> Dict[str, Any]:
+        service = {key: self.get(key) for key in SERVICE_KEYS}
+
+        if self.extra != None:
+            service.update(self.extra)
+
+        return service
+
+    def __eq__(self, other: Any) -> bool:
+        return isinstance(other, Service) and self.to_dict() == other.to_dict()
+
+    def __repr__(self) -> str:
+        return (
+            f"Service({self.serviceId}, {self.originDesc} -> {self.destinationDesc}, "
+            f"{self.departureDate}, {self.price})"
+        )
+
+
+def _as_service(value: Dict[str, Any]) -> Dict[str, Any] | Service:
+    return Service.from_dict(value) if "serviceId" in value else value
+
+
+def parse_routes(body: bytes | str) -> Dict[str, Any] | None:
+    """
+    Parses and validates a getRoutes body in a single pass: the services are
+    turned into Service records by the json decoder itself.
+
+    returns:
+        The body, with result.servicesList as a list of Service, or None if it
+        is not a successful getRoutes answer.
+    """
+    try:
+        record = json.loads(body, object_hook=_as_service)
+    except ValueError:
+        return None
+
+    if not isinstance(record, dict) or record.get("success") != True:
+        return None
+
+    return record
+
+
+def to_json(value: Any) -> Any:
+    """
+    json.dumps default= hook writing a Service as its api dict.
+    """
+    if isinstance(value, Service):
+        return value.to_dict()
+
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
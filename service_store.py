@@ -0,0 +1,300 @@
+import sqlite3
+import argparse
+import datetime
+from typing import Any, Dict, Iterable, List, Tuple
+from api_connector import canonical_locale_key
+from crawl_output import iter_records, parse_collect_at
+
+
+class ServiceStoreException(Exception): ...
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS routes (
+    id INTEGER PRIMARY KEY,
+    origin_id INTEGER NOT NULL,
+    destination_id INTEGER NOT NULL,
+    origin_desc TEXT,
+    destination_desc TEXT,
+    origin_key TEXT,
+    destination_key TEXT,
+    UNIQUE (origin_id, destination_id)
+);
+
+CREATE TABLE IF NOT EXISTS services (
+    id INTEGER PRIMARY KEY,
+    route_pk INTEGER NOT NULL REFERENCES routes (id),
+    service_id TEXT NOT NULL,
+    departure_date TEXT NOT NULL,
+    arrival_date TEXT,
+    class TEXT,
+    company TEXT,
+    km REAL,
+    UNIQUE (route_pk, departure_date, service_id)
+);
+
+CREATE TABLE IF NOT EXISTS fare_observations (
+    service_pk INTEGER NOT NULL REFERENCES services (id),
+    collect_at TEXT NOT NULL,
+    price REAL,
+    free_seats INTEGER,
+    total_seats INTEGER,
+    PRIMARY KEY (service_pk, collect_at)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS routes_by_key ON routes (origin_key, destination_key);
+CREATE INDEX IF NOT EXISTS services_by_departure ON services (departure_date);
+CREATE INDEX IF NOT EXISTS fare_observations_by_collect_at
+    ON fare_observations (collect_at);
+"""
+
+
+class ServiceStore:
+    """
+    Keeps the crawled getRoutes results in a SQLite database, normalized as
+    routes, services and fare observations (price and seats at collect_at).
+
+    Records are buffered and inserted in batches of batch_size within a single
+    transaction, so ingestion keeps up with the crawl. Dates are stored as ISO
+    strings (UTC for collect_at), which sort as dates do.
+    """
+
+    def __init__(self, path: str, batch_size: int = 500) -> None:
+        self.path = path
+        self.batch_size = batch_size
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+
+        self._pending: List[Dict[str, Any]] = []
+        self._route_pks: Dict[Tuple[int, int], int] = {}
+        self._service_pks: Dict[Tuple[int, str, str], int] = {}
+
+    def observe_record(self, record: Dict[str, Any]) -> None:
+        """
+        Buffers a valid getRoutes record (with its collect_at), flushing once
+        batch_size records are pending.
+        """
+        self._pending += [record]
+
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def ingest(self, records: Iterable[Dict[str, Any]]) -> None:
+        for record in records:
+            self.observe_record(record)
+
+        self.flush()
+
+    def flush(self) -> None:
+        if not self._pending:
+            return
+
+        with self.connection:
+            for record in self._pending:
+                self._insert_record(record)
+
+        self._pending = []
+
+    def _insert_record(self, record: Dict[str, Any]) -> None:
+        result = record.get("result")
+
+        if not isinstance(result, dict) or not result.get("servicesList"):
+            return
+
+        collected = parse_collect_at(record.get("collect_at", {}))
+        collected_at = collected.strftime("%Y-%m-%dT%H:%M:%S")
+
+        observations = []
+
+        for service in result["servicesList"]:
+            route_pk = self._route_pk(service)
+            service_pk = self._service_pk(route_pk, service)
+
+            observations += [
+                (
+                    service_pk,
+                    collected_at,
+                    service.get("price"),
+                    service.get("freeSeats"),
+                    service.get("totalSeats"),
+                )
+            ]
+
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO fare_observations "
+            "(service_pk, collect_at, price, free_seats, total_seats) "
+            "VALUES (?, ?, ?, ?, ?)",
+            observations,
+        )
+
+    def _route_pk(self, service: Dict[str, Any]) -> int:
+        key = (service.get("originId"), service.get("destinationId"))
+
+        route_pk = self._route_pks.get(key)
+        if route_pk != None:
+            return route_pk
+
+        origin_desc = service.get("originDesc") or ""
+        destination_desc = service.get("destinationDesc") or ""
+
+        self.connection.execute(
+            "INSERT OR IGNORE INTO routes (origin_id, destination_id, origin_desc, "
+            "destination_desc, origin_key, destination_key) VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                key[0],
+                key[1],
+                origin_desc,
+                destination_desc,
+                canonical_locale_key(origin_desc),
+                canonical_locale_key(destination_desc),
+            ),
+        )
+        route_pk = self.connection.execute(
+            "SELECT id FROM routes WHERE origin_id = ? AND destination_id = ?", key
+        ).fetchone()[0]
+
+        self._route_pks[key] = route_pk
+        return route_pk
+
+    def _service_pk(self, route_pk: int, service: Dict[str, Any]) -> int:
+        key = (route_pk, service.get("departureDate"), str(service.get("serviceId")))
+
+        service_pk = self._service_pks.get(key)
+        if service_pk != None:
+            return service_pk
+
+        self.connection.execute(
+            "INSERT OR IGNORE INTO services (route_pk, departure_date, service_id, "
+            "arrival_date, class, company, km) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                *key,
+                service.get("arrivalDate"),
+                service.get("class"),
+                service.get("company"),
+                service.get("km"),
+            ),
+        )
+        service_pk = self.connection.execute(
+            "SELECT id FROM services WHERE route_pk = ? AND departure_date = ? "
+            "AND service_id = ?",
+            key,
+        ).fetchone()[0]
+
+        self._service_pks[key] = service_pk
+        return service_pk
+
+    def cheapest_fares(
+        self,
+        origin: int | str,
+        destination: int | str,
+        departure_day: datetime.date | str,
+        limit: int = 5,
+    ) -> List[Dict[str, Any]]:
+        """
+        returns:
+            The cheapest services with free seats (according to their latest
+            observation) departing on departure_day, cheapest first.
+
+        args:
+            origin/destination: either the locale ids or their names (in any of the
+            spellings accepted by ApiConnector.get_locale_id)
+        """
+        if not isinstance(departure_day, str):
+            departure_day = departure_day.strftime("%Y-%m-%d")
+
+        next_day = (
+            datetime.date.fromisoformat(departure_day) + datetime.timedelta(days=1)
+        ).strftime("%Y-%m-%d")
+
+        if isinstance(origin, int) and isinstance(destination, int):
+            route_filter = "r.origin_id = ? AND r.destination_id = ?"
+            route_params = (origin, destination)
+        else:
+            route_filter = "r.origin_key = ? AND r.destination_key = ?"
+            route_params = (
+                canonical_locale_key(str(origin)),
+                canonical_locale_key(str(destination)),
+            )
+
+        self.flush()
+
+        rows = self.connection.execute(
+            f"""
+            SELECT s.service_id, s.departure_date, s.arrival_date, s.class,
+                   f.price, f.free_seats, f.total_seats, f.collect_at
+            FROM routes r
+            JOIN services s ON s.route_pk = r.id
+            JOIN fare_observations f ON f.service_pk = s.id
+            WHERE {route_filter}
+              AND s.departure_date >= ? AND s.departure_date < ?
+              AND f.collect_at = (
+                  SELECT MAX(collect_at) FROM fare_observations
+                  WHERE service_pk = s.id
+              )
+              AND f.free_seats > 0
+            ORDER BY f.price
+            LIMIT ?
+            """,
+            (*route_params, departure_day, next_day, limit),
+        ).fetchall()
+
+        columns = [
+            "serviceId",
+            "departureDate",
+            "arrivalDate",
+            "class",
+            "price",
+            "freeSeats",
+            "totalSeats",
+            "collect_at",
+        ]
+
+        return [dict(zip(columns, row)) for row in rows]
+
+    def close(self) -> None:
+        self.flush()
+        self.connection.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="SQLite store for crawled services.")
+    parser.add_argument("--db", default="./services.sqlite3")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    ingest_parser = subparsers.add_parser("ingest", help="ingests crawl outputs")
+    ingest_parser.add_argument("outputs", nargs="+", help="json or ndjson outputs")
+
+    cheapest_parser = subparsers.add_parser(
+        "cheapest", help="cheapest available seats of a route on a given day"
+    )
+    cheapest_parser.add_argument("origin")
+    cheapest_parser.add_argument("destination")
+    cheapest_parser.add_argument("date", help="YYYY-MM-DD")
+    cheapest_parser.add_argument("--limit", type=int, default=5)
+
+    args = parser.parse_args()
+
+    store = ServiceStore(args.db)
+
+    try:
+        if args.command == "ingest":
+            for output in args.outputs:
+                store.ingest(iter_records(output))
+                print(f"ingested {output}")
+        else:
+            origin = int(args.origin) if args.origin.isdigit() else args.origin
+            destination = (
+                int(args.destination) if args.destination.isdigit() else args.destination
+            )
+            for fare in store.cheapest_fares(
+                origin, destination, args.date, limit=args.limit
+            ):
+                print(fare)
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+import queue
+import multiprocessing
+import requests
+from collections import deque
+from typing import Any, Deque, Dict, Iterator, List, Set, Tuple
+from api_connector import ApiConnector
+from route_fetcher import RouteFetcher
+from retry import RetryBudget, RetryPolicy
+from response_cache import ResponseCache
+from crawl_output import collect_at
+from crawl_journal import CrawlJournal
+from crawl_from_api import parse_api_response
+
+
+# (trip, status_code (None without a response), record with collect_at or None,
+# raw body or error of failed calls)
+ShardResult = Tuple[Dict[str, Any], int | None, Dict[str, Any] | None, str | None]
+
+# the worker process state, set by _init_worker
+_worker: Dict[str, Any] = {}
+
+
+def _init_worker(
+    api_url: str,
+    site_url: str,
+    credentials: Dict[str, str],
+    concurrency: int,
+    timeout: Tuple[float, float],
+    max_attempts: int,
+    retry_budget: int,
+    response_cache: Dict[str, Any] | None,
+) -> None:
+    api = ApiConnector(
+        api_url=api_url,
+        site_url=site_url,
+        credentials=credentials,
+        pool_size=concurrency,
+        timeout=timeout,
+    )
+    retry_policy = RetryPolicy(max_attempts=max_attempts, budget=RetryBudget(retry_budget))
+
+    _worker["api"] = api
+    _worker["fetcher"] = RouteFetcher(
+        max_in_flight=concurrency,
+        session=api.session,
+        retry_policy=retry_policy,
+        timeout=timeout,
+        response_cache=(
+            ResponseCache(**response_cache) if response_cache != None else None
+        ),
+    )
+
+
+def _crawl_chunk(task: Tuple[Dict[str, str], List[Dict[str, Any]]]) -> List[ShardResult]:
+    """
+    Fetches, validates and parses a chunk of trips inside a worker process, with the
+    credentials sent along with the chunk.
+    """
+    credentials, trips = task
+    api: ApiConnector = _worker["api"]
+    fetcher: RouteFetcher = _worker["fetcher"]
+
+    api.client_id = credentials["client_id"]
+    api.access_token = credentials["access_token"]
+
+    jobs = (
+        (
+            trip,
+            api.prepare_route_request(
+                origin_id=trip.get("from"),
+                destination_id=trip.get("to"),
+                departure_date=trip.get("departureDate"),
+            ),
+        )
+        for trip in trips
+    )
+
+    results: List[ShardResult] = []
+
+    for trip, response in fetcher.fetch_all(jobs):
+        if isinstance(response, requests.RequestException):
+            # the exception itself may not pickle back to the parent
+            results += [(trip, None, None, f"{type(response).__name__}: {response}")]
+            continue
+
+        _, record = parse_api_response(response)
+
+        if record != None:
+            # its services go back as compact service_record.Service
+            record["collect_at"] = collect_at()
+            results += [(trip, response.status_code, record, None)]
+        else:
+            results += [(trip, response.status_code, None, response.text)]
+
+        response.close()
+
+    return results
+
+
+def crawl_sharded(
+    api: ApiConnector,
+    trips: List[Dict[str, Any]],
+    processes: int,
+    concurrency: int = 8,
+    chunk_size: int = 50,
+    max_attempts: int = 4,
+    retry_budget: int = 200,
+    response_cache: Dict[str, Any] | None = None,
+) -> Iterator[ShardResult]:
+    """
+    Splits the trips (as in ApiRoutesRequestGenerator.trips) in chunks crawled by
+    a pool of processes, each one keeping up to concurrency requests in flight.
+
+    Workers do not authenticate: they use the client_id/access_token api holds
+    when each chunk is dispatched (only about two chunks per process are in
+    flight at once). As soon as a chunk comes back with 401s for the current
+    token, api refreshes it; the rejected trips are then sent again, once each,
+    with the new one (as crawl_from_api.fetch_trips does).
+
+    The json parsing happens in the workers; the results stream back (chunk by
+    chunk, in completion order) to the caller, which should be the only writer.
+
+    The retry budget is split evenly among the processes. Each process keeps its
+    own metrics, which are not merged into the caller's.
+
+    response_cache holds the ResponseCache arguments (ttl, max_entries,
+    directory, max_disk_entries) of the cache each process builds; only its
+    directory is shared.
+    """
+    # spawn, since forking a process that already runs threads is unsafe
+    context = multiprocessing.get_context("spawn")
+
+    initargs = (
+        api.api_url,
+        api.site_url,
+        api.get_credentials(),
+        concurrency,
+        api.timeout,
+        max_attempts,
+        max(1, retry_budget // processes),
+        response_cache,
+    )
+
+    chunks: Deque[List[Dict[str, Any]]] = deque(
+        trips[start : start + chunk_size] for start in range(0, len(trips), chunk_size)
+    )
+    # (credentials the chunk was sent with, its results or the error it raised)
+    done: queue.Queue = queue.Queue()
+    retried: Set[Tuple[str, str, str]] = set()
+    max_chunks_in_flight = 2 * processes
+
+    with context.Pool(processes, initializer=_init_worker, initargs=initargs) as pool:
+        in_flight = 0
+
+        def dispatch() -> None:
+            credentials = api.get_credentials()
+            pool.apply_async(
+                _crawl_chunk,
+                ((credentials, chunks.popleft()),),
+                callback=lambda results: done.put((credentials, results)),
+                error_callback=lambda error: done.put((credentials, error)),
+            )
+
+        while chunks or in_flight:
+            while chunks and in_flight < max_chunks_in_flight:
+                dispatch()
+                in_flight += 1
+
+            credentials, results = done.get()
+            in_flight -= 1
+
+            if isinstance(results, BaseException):
+                raise results
+
+            unauthorized: List[Dict[str, Any]] = []
+
+            for result in results:
+                trip, status_code = result[0], result[1]
+                key = CrawlJournal.key(
+                    trip.get("from"), trip.get("to"), trip.get("departureDate")
+                )
+
+                if status_code == 401 and key not in retried:
+                    retried.add(key)
+                    unauthorized += [trip]
+                else:
+                    yield result
+
+            if unauthorized:
+                # unless the chunk went out before a refresh that already happened
+                if credentials["access_token"] == api.access_token:
+                    print("Access token rejected. Refreshing credentials.")
+                    api.refresh_credentials()
+
+                chunks.appendleft(unauthorized)
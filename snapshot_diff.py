@@ -0,0 +1,186 @@
+import os
+import json
+import hashlib
+import argparse
+import tempfile
+from typing import Any, Dict, List
+from crawl_output import collect_at, iter_records
+
+
+class SnapshotDiffException(Exception): ...
+
+
+# the only fields expected to move between two crawls of the same service
+VOLATILE_FIELDS = ("price", "priceWithDiscount", "freeSeats", "totalSeats", "sell")
+
+KEY_FIELDS = ("serviceId", "departureDate", "originId", "destinationId")
+
+
+def service_key(service: Dict[str, Any]) -> str:
+    """
+    returns:
+        The key identifying a service across snapshots:
+        serviceId|departureDate|originId|destinationId
+    """
+    return "|".join(str(service.get(field)) for field in KEY_FIELDS)
+
+
+def service_fingerprint(service: Dict[str, Any]) -> str:
+    """
+    returns:
+        A short hash of the volatile fields of the service.
+    """
+    values = json.dumps([service.get(field) for field in VOLATILE_FIELDS])
+
+    return hashlib.blake2b(values.encode(), digest_size=8).hexdigest()
+
+
+def unit_key(record: Dict[str, Any]) -> str | None:
+    """
+    returns:
+        The origin|destination|date a getRoutes record answers for, or None if the
+        record is not a valid getRoutes result.
+    """
+    result = record.get("result")
+
+    if not isinstance(result, dict):
+        return None
+
+    try:
+        return "|".join(
+            [
+                str(result["origin"]["id"]),
+                str(result["destination"]["id"]),
+                str(result["date"])[:10],
+            ]
+        )
+    except (KeyError, TypeError):
+        return None
+
+
+class SnapshotDiffer:
+    """
+    Compares a crawl against the fingerprints kept from the previous one and keeps
+    only the deltas: inserted, removed and changed services.
+
+    The state is grouped by unit of work (origin|destination|date), and removals
+    are only reported for units observed in the current crawl, so a route that
+    failed or was skipped this time does not look like all of its services were
+    removed. Units not observed are carried over untouched.
+    """
+
+    def __init__(self, state_path: str) -> None:
+        self.state_path = state_path
+        self.previous: Dict[str, Dict[str, str]] = self._load()
+        self.current: Dict[str, Dict[str, str]] = {}
+        self.inserted: List[Dict[str, Any]] = []
+        self.changed: List[Dict[str, Any]] = []
+
+    def _load(self) -> Dict[str, Dict[str, str]]:
+        if not os.path.exists(self.state_path):
+            return {}
+
+        try:
+            with open(self.state_path, "r") as file:
+                state = json.loads(file.read())
+        except ValueError:
+            raise SnapshotDiffException(
+                f"The snapshot state is corrupted -> {self.state_path} <-"
+            )
+
+        return state.get("units", {})
+
+    def observe_record(self, record: Dict[str, Any]) -> None:
+        """
+        Takes a valid getRoutes record of the current crawl into account.
+        """
+        unit = unit_key(record)
+
+        if unit == None:
+            return
+
+        previous_unit = self.previous.get(unit, {})
+        current_unit = self.current.setdefault(unit, {})
+
+        for service in record["result"].get("servicesList") or []:
+            key = service_key(service)
+            fingerprint = service_fingerprint(service)
+            current_unit[key] = fingerprint
+
+            previous_fingerprint = previous_unit.get(key)
+
+            if previous_fingerprint == None:
+                self.inserted += [service]
+            elif previous_fingerprint != fingerprint:
+                self.changed += [service]
+
+    def finish(self) -> Dict[str, Any]:
+        """
+        Saves the current fingerprints as the new state.
+
+        returns:
+            The delta between the previous and the current crawl.
+        """
+        removed: List[Dict[str, str]] = []
+
+        for unit, current_unit in self.current.items():
+            for key in self.previous.get(unit, {}):
+                if key not in current_unit:
+                    removed += [dict(zip(KEY_FIELDS, key.split("|")))]
+
+        state = dict(self.previous)
+        state.update(self.current)
+        self._dump(state)
+
+        return {
+            "generated_at": collect_at(),
+            "inserted": self.inserted,
+            "changed": self.changed,
+            "removed": removed,
+        }
+
+    def _dump(self, units: Dict[str, Dict[str, str]]) -> None:
+        directory = os.path.dirname(os.path.abspath(self.state_path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".snapshot-")
+
+        with os.fdopen(fd, "w") as file:
+            file.write(json.dumps({"units": units}))
+
+        os.replace(tmp_path, self.state_path)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Emits only what changed in a crawl output since the last call."
+    )
+    parser.add_argument("snapshot", help="crawl output (json or ndjson)")
+    parser.add_argument(
+        "--state",
+        default="./.snapshot_state.json",
+        help="fingerprints of the previous snapshot (default: ./.snapshot_state.json)",
+    )
+    parser.add_argument(
+        "--output",
+        default="./result_api_delta.json",
+        help="where the delta is written (default: ./result_api_delta.json)",
+    )
+    args = parser.parse_args()
+
+    differ = SnapshotDiffer(args.state)
+
+    for record in iter_records(args.snapshot):
+        differ.observe_record(record)
+
+    delta = differ.finish()
+
+    with open(args.output, "w") as file:
+        file.write(json.dumps(delta))
+
+    print(
+        f"inserted: {len(delta['inserted'])} changed: {len(delta['changed'])} "
+        f"removed: {len(delta['removed'])} -> {args.output}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,35 @@
-from datetime import datetime
+from datetime import date, datetime
+import io
+import os
 import json
-from time import sleep
-from crawl_from_website import Crawler
+import pytest
+import threading
+import numpy as np
+import requests
+from time import perf_counter, sleep
+from selenium_crawler import Crawler, CrawlerException, build_results
 from selenium import webdriver
+from api_connector import ApiConnector
+from file_cache import FileCache
+from crawl_output import iter_records, open_writer
+from retry import RetryBudget, RetryPolicy
+from crawl_journal import CrawlJournal
+from snapshot_diff import SnapshotDiffer, unit_key
+from service_store import ServiceStore
+from mock_api import MockJcatlmApi
+from metrics import Metrics
+from request_generator import ApiRoutesRequestGenerator
+from route_fetcher import RouteFetcher
+from browser_pool import BrowserPool
+from html_parser import parse_pages
+from response_cache import ResponseCache
+from crawl_planner import CrawlPlanner
+from service_record import Service, parse_routes, to_json
+from rate_limit import TokenBucket
+import crawl_from_api
+import polling_daemon
+import hybrid_crawl
+import fare_analytics
 
 trips = [
     {"São Paulo (Rod. Tietê) (SP)": "Belo Horizonte (MG)"},
@@ -18,8 +45,12 @@ trips = [
 ]
 
 
+@pytest.mark.skipif(
+    os.environ.get("RUN_BROWSER_TESTS") != "1",
+    reason="needs firefox and the live website (set RUN_BROWSER_TESTS=1)",
+)
 def test_flow_case_predefined() -> None:
-    crawl = Crawler("https://www.viacaocometa.com.br/")
+    crawl = Crawler("https://www.viacaocometa.com.br/", trips=trips)
     driver = webdriver.Firefox()
 
     # ensure we at the proper page
@@ -29,16 +60,1419 @@ def test_flow_case_predefined() -> None:
     departure = list(trip.keys())[0]
     arrival = trip[departure]
 
+    departure_date = datetime.now()
+
     crawl.search_for_trip(
         driver=driver,
         departure=departure,
         arrival=arrival,
-        departure_date=datetime.now(),
+        departure_date=departure_date,
     )
 
     sleep(10)  # waiting loading
 
-    crawl.crawl_trips(driver)
+    crawl.crawl_trips(driver, departure_date=departure_date)
 
     with open("test_results.json", "w") as file:
         file.write(json.dumps(crawl.results))
+
+
+def test_api_connector_reuses_cached_credentials(tmp_path) -> None:
+    cache = FileCache(str(tmp_path / "credentials.json"))
+    cache.set(
+        ApiConnector.credentials_cache_key,
+        {"client_id": "cached-client", "access_token": "cached-token"},
+        ttl=60,
+    )
+
+    # no network calls are made when the cache is warm
+    api = ApiConnector(credential_cache=cache)
+
+    assert api.client_id == "cached-client"
+    assert api.access_token == "cached-token"
+
+
+def test_file_cache_expires_entries(tmp_path) -> None:
+    cache = FileCache(str(tmp_path / "cache.json"))
+    cache.set("fresh", 1, ttl=60)
+    cache.set("stale", 2, ttl=-1)
+
+    assert cache.get("fresh") == 1
+    assert cache.get("stale") == None
+    assert cache.get("missing") == None
+
+
+def test_get_locale_id_matches_normalized_names(tmp_path) -> None:
+    cache = FileCache(str(tmp_path / "cache.json"))
+    cache.set(
+        ApiConnector.credentials_cache_key,
+        {"client_id": "cached-client", "access_token": "cached-token"},
+        ttl=60,
+    )
+    cache.set(
+        ApiConnector.locales_cache_key,
+        [
+            {"id": 18697, "city": "São Paulo (Rod. Tietê)"},
+            {"id": 5410, "city": "Belo Horizonte"},
+        ],
+        ttl=60,
+    )
+
+    api = ApiConnector(credential_cache=cache, locales_cache=cache)
+    api.set_locales_info()
+
+    assert api.get_locale_id("São Paulo (Rod. Tietê)") == 18697
+    assert api.get_locale_id("sao paulo (rod. tiete)") == 18697
+    assert api.get_locale_id("SAO PAULO (TIETE) - SP") == 18697
+    assert api.get_locale_id("São Paulo (Rod. Tietê) (SP)") == 18697
+    assert api.get_locale_id("BELO HORIZONTE (RODOVIARIA) - MG") == 5410
+    assert api.get_locale_id("Curitiba") == None
+
+
+def test_streaming_writers_round_trip(tmp_path) -> None:
+    records = [{"success": True, "n": n} for n in range(3)]
+
+    for output_format, compression in [("json", None), ("ndjson", "gzip")]:
+        path = str(tmp_path / f"out.{output_format}")
+        with open_writer(path, output_format, compression=compression) as writer:
+            for record in records:
+                writer.write(record)
+
+        assert list(iter_records(writer.path)) == records
+
+
+def test_json_array_writer_appends_to_interrupted_output(tmp_path) -> None:
+    path = str(tmp_path / "out.json")
+    with open(path, "w") as file:
+        file.write('[{"n": 0}')  # the run died before closing the array
+
+    with open_writer(path, "json", append=True) as writer:
+        writer.write({"n": 1})
+
+    assert list(iter_records(path)) == [{"n": 0}, {"n": 1}]
+
+
+class _ScriptedSession:
+    """
+    Answers session.send with the given status codes, in order.
+    """
+
+    def __init__(self, statuses, headers={}) -> None:
+        self.statuses = list(statuses)
+        self.headers = headers
+        self.calls = 0
+
+    def send(self, request, **kwargs):
+        self.calls += 1
+        response = requests.Response()
+        response.status_code = self.statuses.pop(0)
+        response.raw = io.BytesIO(b"")
+        response.headers.update(self.headers)
+        return response
+
+
+def test_retry_policy_retries_transient_failures_and_honors_retry_after() -> None:
+    delays = []
+    session = _ScriptedSession([503, 502, 200], headers={"Retry-After": "3"})
+    policy = RetryPolicy(max_attempts=4, sleep=delays.append)
+
+    response = policy.send(session, requests.Request("POST", "http://x/").prepare())
+
+    assert response.status_code == 200
+    assert session.calls == 3
+    assert delays[0] == 3  # from Retry-After, 502 uses the jittered backoff
+    assert 0 <= delays[1] <= policy.base_delay * 2
+
+
+class _DelayedSession(requests.Session):
+    """
+    Answers session.send after the delay in the request body, echoing the body,
+    and counts how many requests are on the wire at once.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def send(self, request, **kwargs):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+        sleep(json.loads(request.body)["delay"])
+
+        with self.lock:
+            self.in_flight -= 1
+
+        response = requests.Response()
+        response.status_code = 200
+        response.raw = io.BytesIO(request.body.encode())
+        return response
+
+
+def test_route_fetcher_pairs_out_of_order_responses_with_their_trips() -> None:
+    session = _DelayedSession()
+    fetcher = RouteFetcher(max_in_flight=3, session=session)
+    delays = [0.3, 0.05, 0.15, 0.05, 0.2, 0.05, 0.1, 0.05]
+    pulled = []
+
+    def jobs():
+        for i, delay in enumerate(delays):
+            pulled.append(i)
+            trip = {"from": i, "to": i + 1, "departureDate": "2024-10-24"}
+            body = json.dumps({"trip": i, "delay": delay})
+            yield trip, requests.Request("POST", "http://x/", data=body).prepare()
+
+    completed = []
+    for trip, response in fetcher.fetch_all(jobs()):
+        if not completed:
+            # only the first max_in_flight jobs were pulled before a slot freed
+            assert pulled == [0, 1, 2]
+        assert response.json()["trip"] == trip["from"]
+        completed.append(trip["from"])
+
+    assert sorted(completed) == list(range(len(delays)))
+    assert completed != sorted(completed)  # completion order, not job order
+    assert session.max_in_flight == 3
+
+
+def test_retry_policy_stops_when_the_budget_is_spent() -> None:
+    session = _ScriptedSession([503, 503, 503])
+    policy = RetryPolicy(max_attempts=3, budget=RetryBudget(1), sleep=lambda _: None)
+
+    response = policy.send(session, requests.Request("POST", "http://x/").prepare())
+
+    assert response.status_code == 503
+    assert session.calls == 2
+
+
+def test_crawl_journal_resumes_completed_units(tmp_path) -> None:
+    path = str(tmp_path / "journal.ndjson")
+
+    journal = CrawlJournal(path)
+    journal.mark_done(18697, 5410, "2024-10-24")
+    journal.close()
+
+    with open(path, "a") as file:
+        file.write('{"origin": "1", "destin')  # crashed while marking
+
+    resumed = CrawlJournal(path, resume=True)
+    assert resumed.is_done("18697", "5410", "2024-10-24")
+    assert not resumed.is_done(18697, 5410, "2024-10-25")
+    assert len(resumed) == 1
+    resumed.mark_done(18697, 5410, "2024-10-25")
+    resumed.close()
+
+    assert len(CrawlJournal(path, resume=True)) == 2
+
+    assert len(CrawlJournal(path)) == 0  # not resuming starts over
+
+
+def _sample_record(services) -> dict:
+    return {
+        "success": True,
+        "result": {
+            "origin": {"id": 18697},
+            "destination": {"id": 5410},
+            "date": "2024-10-24T00:00:00",
+            "servicesList": services,
+        },
+    }
+
+
+def _sample_service(service_id: str, price: float, free_seats: int) -> dict:
+    return {
+        "serviceId": service_id,
+        "departureDate": "2024-10-24T20:45:00",
+        "originId": 18697,
+        "destinationId": 5410,
+        "price": price,
+        "freeSeats": free_seats,
+        "class": "CAMA",
+    }
+
+
+def test_snapshot_differ_emits_only_deltas(tmp_path) -> None:
+    state = str(tmp_path / "state.json")
+
+    first = SnapshotDiffer(state)
+    first.observe_record(
+        _sample_record([_sample_service("1", 204.04, 8), _sample_service("2", 449.99, 0)])
+    )
+    first.finish()
+
+    second = SnapshotDiffer(state)
+    second.observe_record(
+        _sample_record([_sample_service("1", 199.0, 8), _sample_service("3", 99.9, 40)])
+    )
+    delta = second.finish()
+
+    assert [service["serviceId"] for service in delta["changed"]] == ["1"]
+    assert [service["serviceId"] for service in delta["inserted"]] == ["3"]
+    assert [service["serviceId"] for service in delta["removed"]] == ["2"]
+
+    # routes not crawled this time are not reported as removed
+    assert SnapshotDiffer(state).finish()["removed"] == []
+
+
+def test_service_store_finds_cheapest_available_seat(tmp_path) -> None:
+    store = ServiceStore(str(tmp_path / "services.sqlite3"), batch_size=2)
+
+    full = _sample_service("1", 99.0, 0)
+    cheap = _sample_service("2", 149.19, 36)
+    expensive = _sample_service("3", 449.99, 8)
+    for service in (full, cheap, expensive):
+        service["originDesc"] = "São Paulo (Rod. Tietê)"
+        service["destinationDesc"] = "Belo Horizonte"
+
+    record = _sample_record([full, cheap, expensive])
+    record["collect_at"] = {"timezone": "UTC", "datetime": "2024-10-24 20:09:45"}
+    store.ingest([record])
+
+    fares = store.cheapest_fares(
+        "SAO PAULO (TIETE) - SP", "Belo Horizonte", "2024-10-24", limit=1
+    )
+
+    assert [fare["serviceId"] for fare in fares] == ["2"]
+    assert fares[0]["collect_at"] == "2024-10-24T20:09:45"
+    store.close()
+
+
+def _crawl_argv(mock: MockJcatlmApi, tmp_path, *extra: str) -> list:
+    return [
+        "--days",
+        "1",
+        "--api-url",
+        mock.url,
+        "--site-url",
+        mock.url,
+        "--credentials-cache",
+        str(tmp_path / "credentials.json"),
+        "--no-locales-cache",
+        "--output-format",
+        "ndjson",
+        "--output",
+        str(tmp_path / "result.ndjson"),
+        "--invalid-output",
+        str(tmp_path / "invalid.ndjson"),
+        "--journal",
+        str(tmp_path / "journal.ndjson"),
+        *extra,
+    ]
+
+
+def test_crawl_from_api_against_the_mock_api(tmp_path) -> None:
+    with MockJcatlmApi() as mock:
+        crawl_from_api.main(_crawl_argv(mock, tmp_path))
+
+        records = list(iter_records(str(tmp_path / "result.ndjson")))
+        assert len(records) == len(crawl_from_api.challenge_list_of_trips)
+        assert all(record["result"]["servicesList"] for record in records)
+        assert list(iter_records(str(tmp_path / "invalid.ndjson"))) == []
+
+        # the second run reuses the cached credentials, until they are revoked
+        mock.revoke_tokens()
+        crawl_from_api.main(_crawl_argv(mock, tmp_path))
+
+        assert mock.calls["login"] == 2
+        assert mock.calls["home"] == 1
+        assert len(list(iter_records(str(tmp_path / "result.ndjson")))) == len(
+            records
+        )
+
+
+def test_metrics_render_prometheus_histograms() -> None:
+    metrics = Metrics()
+
+    with metrics.time("get_routes", route="18697-5410"):
+        pass
+
+    with pytest.raises(ValueError):
+        with metrics.time("get_routes", route="18697-5410"):
+            raise ValueError()
+
+    text = metrics.render_prometheus()
+
+    assert (
+        'crawler_stage_duration_seconds_count{route="18697-5410",stage="get_routes"} 2'
+        in text
+    )
+    assert 'crawler_stage_total{outcome="error",stage="get_routes"} 1' in text
+    assert "# TYPE crawler_stage_duration_seconds histogram" in text
+
+
+def test_iter_requests_prepares_with_the_current_credentials() -> None:
+    with MockJcatlmApi() as mock:
+        req_gen = ApiRoutesRequestGenerator(api_url=mock.url, site_url=mock.url)
+        req_gen.add_trips(
+            crawl_from_api.challenge_list_of_trips, departure_date="2024-10-24"
+        )
+
+        jobs = req_gen.iter_requests()
+        _, first_request = next(jobs)
+
+        req_gen.api.refresh_credentials()
+        _, second_request = next(jobs)
+
+        assert first_request.headers["Access_token"] == "mock-token-1"
+        assert second_request.headers["Access_token"] == "mock-token-2"
+        assert req_gen.requests == []  # nothing was prepared ahead of time
+
+
+def test_one_session_serves_every_call_and_honours_the_read_timeout() -> None:
+    with MockJcatlmApi() as mock:
+        req_gen = ApiRoutesRequestGenerator(
+            api_url=mock.url, site_url=mock.url, timeout=(1, 0.2)
+        )
+        req_gen.add_trips(
+            crawl_from_api.challenge_list_of_trips[:2], departure_date="2024-10-24"
+        )
+        fetcher = RouteFetcher(
+            max_in_flight=1, session=req_gen.api.session, timeout=req_gen.api.timeout
+        )
+
+        responses = list(fetcher.fetch_all(req_gen.iter_requests()))
+
+        assert [response.status_code for _, response in responses] == [200, 200]
+        assert mock.calls == {
+            "home": 1,
+            "authorization": 1,
+            "login": 1,
+            "searchOrigin": 1,
+            "getRoutes": 2,
+        }
+        # auth, searchOrigin and getRoutes all went over one kept-alive connection
+        assert mock.connections == 1
+
+        mock.latency = 1.0
+        jobs = req_gen.iter_requests([dict(responses[0][0], departureDate="2024-10-25")])
+
+        started = perf_counter()
+        [(_, result)] = list(fetcher.fetch_all(jobs))
+        assert isinstance(result, requests.exceptions.ReadTimeout)
+        assert perf_counter() - started < 0.9
+
+
+@pytest.mark.parametrize("processes", ["1", "2"])
+def test_crawl_from_api_writes_a_dropped_call_as_invalid(tmp_path, processes) -> None:
+    with MockJcatlmApi() as mock:
+        dropped = next(iter(mock._templates))
+        mock.dropped_routes.add(dropped)
+
+        crawl_from_api.main(
+            _crawl_argv(
+                mock, tmp_path, "--max-attempts", "2", "--processes", processes
+            )
+        )
+
+        # the other calls of the run went on
+        records = list(iter_records(str(tmp_path / "result.ndjson")))
+        assert len(records) == len(crawl_from_api.challenge_list_of_trips) - 1
+
+        [invalid] = list(iter_records(str(tmp_path / "invalid.ndjson")))
+        assert (invalid["trip"]["from"], invalid["trip"]["to"]) == dropped
+        assert invalid["response.code"] == None
+        assert invalid["response.body"].startswith("ConnectionError")
+
+
+def test_crawl_from_api_shards_the_plan_across_processes(tmp_path) -> None:
+    with MockJcatlmApi() as mock:
+        crawl_from_api.main(
+            _crawl_argv(mock, tmp_path, "--processes", "2", "--chunk-size", "4")
+        )
+
+        records = list(iter_records(str(tmp_path / "result.ndjson")))
+        assert len(records) == len(crawl_from_api.challenge_list_of_trips)
+        # only the parent process logged in
+        assert mock.calls["login"] == 1
+
+
+def test_crawl_sharded_refreshes_expired_credentials_mid_crawl() -> None:
+    from sharded_crawl import crawl_sharded
+
+    with MockJcatlmApi() as mock:
+        api = ApiConnector(api_url=mock.url, site_url=mock.url)
+        trips = [
+            {"from": 18697, "to": 5410, "departureDate": f"2024-10-{day}"}
+            for day in range(10, 30)
+        ]
+
+        # at most 2 chunks of a trip in flight: the retried trips are done well
+        # before the second expiry
+        results = []
+        for result in crawl_sharded(api, trips, processes=1, chunk_size=1):
+            results += [result]
+            if len(results) in (4, 12):
+                # the token expires twice while chunks are still to be sent
+                mock.revoke_tokens()
+
+        assert sorted(result[0]["departureDate"] for result in results) == sorted(
+            trip["departureDate"] for trip in trips
+        )
+        assert all(result[1] == 200 for result in results)
+        assert mock.calls["login"] == 3
+
+
+class _FakeDriver:
+    def __init__(self) -> None:
+        self.quit_calls = 0
+
+    def quit(self) -> None:
+        self.quit_calls += 1
+
+
+def test_browser_pool_recycles_drivers_and_merges_results(monkeypatch) -> None:
+    def fake_crawl_trip(self, driver, departure, arrival, departure_date) -> None:
+        if departure == "broken":
+            raise RuntimeError("page did not load")
+        self.results += [[{"originDesc": departure, "destinationDesc": arrival}]]
+
+    monkeypatch.setattr(Crawler, "crawl_trip", fake_crawl_trip)
+
+    drivers = []
+
+    def driver_factory() -> _FakeDriver:
+        drivers.append(_FakeDriver())
+        return drivers[-1]
+
+    crawler = Crawler("https://example.com/")
+    done = []
+    pool = BrowserPool(
+        crawler,
+        workers=2,
+        pages_per_driver=2,
+        on_done=lambda job, results: done.append(job),
+        driver_factory=driver_factory,
+    )
+
+    day = datetime(2024, 10, 24)
+    jobs = [(f"origin {i}", "destination", day) for i in range(6)]
+    failed = pool.run(jobs + [("broken", "destination", day)])
+
+    assert len(crawler.results) == 6
+    assert sorted(done) == sorted(jobs)
+    assert [job for job, _ in failed] == [("broken", "destination", day)]
+    # at least 7 pages at 2 per driver, plus one replaced after the failure
+    assert len(drivers) >= 4
+    assert all(driver.quit_calls == 1 for driver in drivers)
+
+
+def test_crawler_waits_until_the_page_is_ready() -> None:
+    crawler = Crawler("https://example.com/", wait_timeout=0.3)
+    polls = []
+
+    def ready_on_third_poll(driver):
+        polls.append(driver)
+        return "element" if len(polls) == 3 else False
+
+    assert crawler.wait_for(_FakeDriver(), "results", ready_on_third_poll) == "element"
+
+    with pytest.raises(CrawlerException):
+        crawler.wait_for(_FakeDriver(), "spinner", lambda driver: False)
+
+    (ready_name, ready_seconds), (timeout_name, timeout_seconds) = crawler.wait_timings
+    assert (ready_name, timeout_name) == ("results", "spinner")
+    assert ready_seconds < 0.3 <= timeout_seconds
+
+
+def test_crawl_trip_records_a_page_without_services_as_empty(monkeypatch) -> None:
+    from selenium_crawler import EMPTY_RESULTS_LOCATOR, SPINNER_LOCATOR
+
+    class Element:
+        def is_displayed(self) -> bool:
+            return True
+
+    class EmptyResultsDriver(_FakeDriver):
+        polls = 0
+
+        def get(self, url) -> None: ...
+
+        def find_elements(self, by, value):
+            self.polls += 1
+            if (by, value) == SPINNER_LOCATOR:
+                # the spinner shows on the first poll only
+                return [Element()] if self.polls == 1 else []
+            if (by, value) == EMPTY_RESULTS_LOCATOR:
+                return [Element()]
+            return []
+
+    monkeypatch.setattr(Crawler, "search_for_trip", lambda self, **kwargs: None)
+
+    crawler = Crawler("https://example.com/", wait_timeout=2, mode="script")
+    crawler.crawl_trip(
+        EmptyResultsDriver(), "Curitiba (PR)", "Campinas (SP)", datetime(2024, 10, 24)
+    )
+
+    assert crawler.results == [[]]
+    assert crawler.wait_timings[0][1] < 2
+
+
+def test_crawl_trips_reads_the_page_in_a_single_script_call() -> None:
+    page = {
+        "origin": "São Paulo (Rod. Tietê) (SP)",
+        "destination": "Curitiba (PR)",
+        "services": [
+            {
+                "departureTime": "23:30",
+                "travelTime": "6h15min",
+                "offers": [
+                    {"category": "Leito", "priceTruncated": "R$ 189", "priceDecimals": ",90"},
+                    {"category": "Executivo", "priceTruncated": "", "priceDecimals": ""},
+                ],
+            },
+            {"departureTime": "08:00", "travelTime": "6h", "offers": []},
+        ],
+    }
+
+    class ScriptDriver:
+        calls = 0
+
+        def execute_script(self, script, xpaths):
+            ScriptDriver.calls += 1
+            return page
+
+    crawler = Crawler("https://example.com/", mode="script")
+    crawler.crawl_trips(ScriptDriver(), departure_date=datetime(2024, 10, 24))
+
+    assert ScriptDriver.calls == 1
+    # one entry per page, no matter how many services it has
+    assert len(crawler.results) == 1
+    first, second = crawler.results[0]
+    assert first["price"] == "R$ 189,90" and first["isAvailable"]
+    assert first["departureDate"] == "2024-10-24T23:30"
+    assert first["arrivalDate"] == "2024-10-25T0545"
+    assert second["category"] == "Executivo" and not second["isAvailable"]
+
+
+def test_network_mode_captures_the_get_routes_json() -> None:
+    with open("./result_api.json", "r") as file:
+        recorded = next(
+            record for record in json.loads(file.read()) if record.get("result")
+        )
+
+    def event(method: str, **params) -> dict:
+        return {"message": json.dumps({"message": {"method": method, "params": params}})}
+
+    def routes_logs() -> list:
+        return [
+            [event("Network.responseReceived", requestId="1", response={"url": "https://x/a.js"})],
+            [
+                event(
+                    "Network.responseReceived",
+                    requestId="2",
+                    response={"url": "https://api.jcatlm.com.br/route/v1/getRoutes"},
+                )
+            ],
+            [event("Network.loadingFinished", requestId="2")],
+        ]
+
+    class NetworkDriver:
+        def __init__(self) -> None:
+            self.logs = routes_logs()
+
+        def get_log(self, log_type):
+            return self.logs.pop(0) if self.logs else []
+
+        def execute_cdp_cmd(self, command, args):
+            assert (command, args) == ("Network.getResponseBody", {"requestId": "2"})
+            return {"body": json.dumps(recorded), "base64Encoded": False}
+
+    crawler = Crawler("https://example.com/", wait_timeout=2, mode="network")
+    crawler.crawl_trips(NetworkDriver(), departure_date=datetime(2024, 10, 24))
+
+    assert crawler.results == [recorded["result"]["servicesList"]]
+
+    # a route without services is an empty page, not a timeout
+    empty = {**recorded, "result": {**recorded["result"], "servicesList": None}}
+
+    class EmptyNetworkDriver(NetworkDriver):
+        def execute_cdp_cmd(self, command, args):
+            return {"body": json.dumps(empty), "base64Encoded": False}
+
+    crawler = Crawler("https://example.com/", wait_timeout=0.5, mode="network")
+    crawler.crawl_trips(EmptyNetworkDriver(), departure_date=datetime(2024, 10, 24))
+
+    assert crawler.results == [[]]
+
+
+RESULTS_PAGE = """
+<html><body>
+  <p data-js="summary-label-origin">São Paulo (Rod. Tietê) (SP)</p>
+  <p data-js="summary-label-destination">Curitiba (PR)</p>
+  <ul>
+    <li class="list-companies-item selected">
+      <div class="header">
+        <span class="edit-text-departure-label">Saída</span> <span>23:30</span>
+      </div>
+      <div class="duration"><p><b data-js="durationLabel">6h15min</b></p></div>
+      <ul>
+        <li data-js="offer-element-0">
+          <span class="classtypeLabel"><span><b>Leito</b></span></span>
+          <div class="price">
+            <span class="price-label">R$ 189</span><span class="decimal-label">,90</span>
+          </div>
+        </li>
+        <li data-js="offer-element-1">
+          <span class="classtypeLabel"><span><b>Executivo</b></span></span>
+          <div class="price">
+            <span class="price-label"></span><span class="decimal-label"></span>
+          </div>
+        </li>
+      </ul>
+    </li>
+  </ul>
+</body></html>
+"""
+
+
+def test_html_parser_reproduces_crawl_trips_from_saved_pages(tmp_path) -> None:
+    class SavedDriver:
+        page_source = RESULTS_PAGE
+        current_url = "https://www.viacaocometa.com.br/content/jca/cometa/pt-br/resultado"
+
+    crawler = Crawler("https://example.com/", pages_dir=str(tmp_path))
+    paths = [
+        crawler.save_page(SavedDriver(), datetime(2024, 10, 24)),
+        crawler.save_page(SavedDriver(), datetime(2024, 10, 25)),
+    ]
+
+    first_page, second_page = parse_pages(paths, processes=2)
+
+    leito, executivo = first_page
+    assert leito["originDesc"] == "São Paulo (Rod. Tietê) (SP)"
+    assert leito["price"] == "R$ 189,90" and leito["isAvailable"]
+    assert leito["category"] == "Leito"
+    assert leito["arrivalDate"] == "2024-10-25T0545"
+    assert executivo["price"] == "" and not executivo["isAvailable"]
+    assert second_page[0]["departureDate"] == "2024-10-25T23:30"
+
+
+def test_saved_pages_of_a_crawl_parse_back_to_its_results(tmp_path, monkeypatch) -> None:
+    import glob
+    from html_parser import parse_page
+    from selenium_crawler import EMPTY_RESULTS_LOCATOR, RESULTS_LOCATOR
+
+    empty_page = '<html><body><p class="no-results">Nenhuma viagem</p></body></html>'
+    pages = [
+        RESULTS_PAGE,
+        empty_page,
+        RESULTS_PAGE.replace("23:30", "07:10"),
+        RESULTS_PAGE.replace("Curitiba (PR)", "Campinas (SP)"),
+    ]
+
+    class Element:
+        def is_displayed(self) -> bool:
+            return True
+
+    class PagesDriver(_FakeDriver):
+        current_url = "https://www.viacaocometa.com.br/content/jca/cometa/pt-br/resultado"
+        page_source = None
+
+        def get(self, url) -> None:
+            # every search lands on the next page
+            self.page_source = pages.pop(0)
+
+        def find_elements(self, by, value):
+            shown = {
+                RESULTS_LOCATOR: "list-companies-item" in self.page_source,
+                EMPTY_RESULTS_LOCATOR: "no-results" in self.page_source,
+            }
+            return [Element()] if shown.get((by, value)) else []
+
+        def execute_script(self, script, xpaths):
+            # what EXTRACT_PAGE_SCRIPT gives in a browser
+            return parse_page(self.page_source)
+
+    monkeypatch.setattr(Crawler, "search_for_trip", lambda self, **kwargs: None)
+
+    crawler = Crawler("https://example.com/", mode="script", pages_dir=str(tmp_path))
+    driver = PagesDriver()
+    for day in (24, 24, 25, 26):
+        crawler.crawl_trip(driver, "São Paulo", "Curitiba", datetime(2024, 10, day))
+
+    parsed = parse_pages(sorted(glob.glob(str(tmp_path / "*.html"))), processes=2)
+
+    def without_collected_at(results):
+        return [
+            [{k: v for k, v in row.items() if k != "collected_at"} for row in page]
+            for page in results
+        ]
+
+    assert len(parsed) == 4 and parsed[1] == []
+    assert without_collected_at(parsed) == without_collected_at(crawler.results)
+
+
+def test_response_cache_coalesces_identical_requests_in_flight(tmp_path) -> None:
+    import threading
+
+    def request(departure_date: str, token: str) -> requests.PreparedRequest:
+        return requests.Request(
+            "POST",
+            "https://api.jcatlm.com.br/route/v1/getRoutes",
+            headers={"Access_token": token},
+            data=json.dumps({"origin": 1, "destination": 2, "departureDate": departure_date}),
+        ).prepare()
+
+    sent = []
+    release = threading.Event()
+
+    def send() -> requests.Response:
+        sent.append(1)
+        release.wait(5)
+        response = requests.Response()
+        response.status_code = 200
+        response._content = b'{"success": true}'
+        return response
+
+    cache = ResponseCache(ttl=60, max_entries=1, directory=str(tmp_path))
+    responses = []
+    threads = [
+        threading.Thread(
+            target=lambda token=token: responses.append(
+                cache.fetch(request("2024-10-24", token), send)
+            )
+        )
+        for token in ("a", "b", "c")
+    ]
+    for thread in threads:
+        thread.start()
+    while not sent:
+        sleep(0.01)
+    sleep(0.05)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert len(sent) == 1
+    assert [response.json() for response in responses] == [{"success": True}] * 3
+
+    # a different date evicts the first entry from memory, the disk still has it
+    cache.fetch(request("2024-10-25", "a"), send)
+    assert len(cache._entries) == 1
+    assert cache.fetch(request("2024-10-24", "d"), send).json() == {"success": True}
+    assert len(sent) == 2
+
+    # a fresh cache over the same directory, but with every entry expired
+    assert ResponseCache(ttl=0, directory=str(tmp_path))._get(
+        ResponseCache.key(request("2024-10-24", "a"))
+    ) == None
+    # ...whose file is then gone
+    assert len(list(tmp_path.glob("*.json"))) == 1
+
+
+def test_response_cache_bounds_its_directory(tmp_path) -> None:
+    def request(departure_date: str) -> requests.PreparedRequest:
+        return requests.Request(
+            "POST",
+            "https://api.jcatlm.com.br/route/v1/getRoutes",
+            data=json.dumps({"origin": 1, "destination": 2, "departureDate": departure_date}),
+        ).prepare()
+
+    def send() -> requests.Response:
+        response = requests.Response()
+        response.status_code = 200
+        response._content = b'{"success": true}'
+        return response
+
+    cache = ResponseCache(ttl=60, directory=str(tmp_path), max_disk_entries=10)
+    for day in range(10, 25):
+        cache.fetch(request(f"2024-10-{day}"), send)
+
+    # evicted down to 90% of the cap once it was passed
+    assert len(list(tmp_path.glob("*.json"))) <= 10
+
+    # the memory misses read the disk without holding the lock
+    reads = []
+    read = cache._read
+
+    def read_unlocked(key):
+        reads.append(cache._lock.locked())
+        return read(key)
+
+    cache._read = read_unlocked
+    cache._entries.clear()
+    cache.fetch(request("2024-10-24"), send)
+    assert reads == [False]
+
+    cache.clear()
+    assert list(tmp_path.glob("*.json")) == []
+    assert len(cache._entries) == 0
+
+
+def test_crawl_from_api_reuses_cached_responses_between_runs(tmp_path) -> None:
+    cache_args = ["--response-cache-ttl", "60", "--response-cache-dir", str(tmp_path / "responses")]
+
+    with MockJcatlmApi() as mock:
+        crawl_from_api.main(_crawl_argv(mock, tmp_path, *cache_args))
+        first_run_calls = mock.calls["getRoutes"]
+
+        crawl_from_api.main(_crawl_argv(mock, tmp_path, *cache_args))
+
+        assert mock.calls["getRoutes"] == first_run_calls
+        assert len(list(iter_records(str(tmp_path / "result.ndjson")))) == len(
+            crawl_from_api.challenge_list_of_trips
+        )
+
+
+def _noon() -> float:
+    # far enough from midnight for the horizon not to move within a test
+    return datetime.combine(date.today(), datetime.min.time()).timestamp() + 43200
+
+
+def test_crawl_planner_polls_near_and_volatile_units_first(tmp_path) -> None:
+    from datetime import timedelta
+
+    now = _noon()
+    days = [
+        (date.fromtimestamp(now) + timedelta(days=i)).strftime("%Y-%m-%d")
+        for i in range(3)
+    ]
+    state_path = str(tmp_path / "planner.json")
+
+    def new_planner() -> CrawlPlanner:
+        return CrawlPlanner(
+            [(1, 2), (3, 4)], horizon_days=3, state_path=state_path, clock=lambda: now
+        )
+
+    def crawled(trip, price):
+        record = _sample_record([_sample_service("1", price, 10)])
+        record["result"]["origin"]["id"] = trip["from"]
+        record["result"]["destination"]["id"] = trip["to"]
+        record["result"]["date"] = trip["departureDate"]
+        return record
+
+    planner = new_planner()
+
+    # nothing crawled yet: every unit is due, nearest departures first
+    plan = planner.plan(budget=4, now=now)
+    assert [(trip["from"], trip["departureDate"]) for trip in plan] == [
+        (1, days[0]),
+        (3, days[0]),
+        (1, days[1]),
+        (3, days[1]),
+    ]
+
+    for trip in planner.plan(now=now):
+        planner.observe_record(crawled(trip, 100.0))
+    planner.save()
+
+    # all crawled just now: nothing is due
+    planner = new_planner()
+    assert planner.plan(now=now) == []
+    assert planner.next_due_in(now=now) == 3600
+
+    # the fare of route 3 changed: it turns volatile
+    planner.observe_record(crawled({"from": 3, "to": 4, "departureDate": days[0]}, 90.0))
+
+    # 1h15 later, today's departures are due again, and so is every day of the
+    # volatile route, whose interval is shortened down to the 1h minimum
+    due = planner.plan(now=now + 4500)
+    assert [(trip["from"], trip["departureDate"]) for trip in due] == [
+        (1, days[0]),
+        (3, days[0]),
+        (3, days[1]),
+        (3, days[2]),
+    ]
+
+
+def test_crawl_from_api_spends_the_budget_on_due_units(tmp_path) -> None:
+    planner_argv = [
+        "--routes",
+        "all",
+        "--plan",
+        "priority",
+        "--budget",
+        "20",
+        "--planner-state",
+        str(tmp_path / "planner.json"),
+        "--output",
+    ]
+
+    with MockJcatlmApi() as mock:
+        crawl_from_api.main(
+            _crawl_argv(mock, tmp_path, *planner_argv, str(tmp_path / "1.ndjson"))
+        )
+        crawl_from_api.main(
+            _crawl_argv(mock, tmp_path, *planner_argv, str(tmp_path / "2.ndjson"))
+        )
+
+        first, second = [
+            [unit_key(record) for record in iter_records(str(tmp_path / name))]
+            for name in ("1.ndjson", "2.ndjson")
+        ]
+
+        assert len(first) == len(second) == 20
+        # the second run only crawls what the first one did not
+        assert not set(first) & set(second)
+        assert mock.calls["getRoutes"] == 40
+
+
+def test_planner_only_looks_at_the_due_units() -> None:
+    from crawl_planner import all_routes
+
+    now = _noon()
+    routes = all_routes([{"id": locale} for locale in range(30)])
+    planner = CrawlPlanner(routes, horizon_days=8, clock=lambda: now)
+
+    for trip in planner.plan():
+        planner.observe_failure(trip)
+
+    intervals = []
+    refresh_interval = planner.refresh_interval
+
+    def counted_refresh_interval(*args):
+        intervals.append(1)
+        return refresh_interval(*args)
+
+    planner.refresh_interval = counted_refresh_interval
+
+    # nothing due: neither call goes over the 870 routes x 8 days
+    assert planner.plan(now=now + 10) == []
+    assert planner.next_due_in(now=now + 10) == 290
+    assert len(planner.plan(now=now + 300, budget=5)) == 5
+    assert intervals == []
+
+
+def test_planner_backs_off_failing_units(tmp_path) -> None:
+    now = _noon()
+    planner = CrawlPlanner(
+        [(1, 2)], horizon_days=1, failure_backoff=60, clock=lambda: now
+    )
+    trip = planner.plan()[0]
+
+    planner.observe_failure(trip)
+    crawled_at = planner.units["1|2|" + trip["departureDate"]]["crawled_at"]
+
+    assert planner.plan(now=crawled_at + 30) == []
+    assert planner.plan(now=crawled_at + 60) == [trip]
+
+    # the backoff doubles with every failure in a row
+    planner.observe_failure(trip)
+    crawled_at = planner.units["1|2|" + trip["departureDate"]]["crawled_at"]
+    assert planner.plan(now=crawled_at + 60) == []
+    assert planner.next_due_in(now=crawled_at) == pytest.approx(120)
+
+    # failing calls of a crawl reach the planner through write_result
+    with MockJcatlmApi(error_rate=1.0) as mock:
+        crawl_from_api.main(
+            _crawl_argv(
+                mock,
+                tmp_path,
+                "--plan",
+                "priority",
+                "--max-attempts",
+                "1",
+                "--planner-state",
+                str(tmp_path / "planner.json"),
+            )
+        )
+
+    with open(tmp_path / "planner.json", "r") as file:
+        units = json.loads(file.read())["units"]
+
+    assert len(units) == len(crawl_from_api.challenge_list_of_trips)
+    assert all(unit["failures"] == 1 for unit in units.values())
+
+
+def test_parse_routes_builds_compact_services_in_one_pass() -> None:
+    import pickle
+
+    with open("./result_api.json", "r") as file:
+        recorded = next(
+            record for record in json.loads(file.read()) if record.get("result")
+        )
+    body = json.dumps({"success": True, "result": recorded["result"]})
+
+    record = parse_routes(body.encode())
+    first, second = record["result"]["servicesList"][:2]
+
+    assert isinstance(first, Service) and not hasattr(first, "__dict__")
+    # the same strings are shared among services
+    assert first.get("company") is second.get("company")
+    assert first.get("class") == recorded["result"]["servicesList"][0]["class"]
+    assert first.get("priceWithDiscount") == None
+    # written back exactly as the api sent it
+    assert json.dumps(record, default=to_json) == body
+    assert pickle.loads(pickle.dumps(first)) == first
+
+    assert parse_routes(b'{"success": false}') == None
+    assert parse_routes(b"<html>") == None
+
+
+def test_fare_timeseries_answers_from_the_rollups(tmp_path) -> None:
+    from fare_timeseries import FareTimeSeries
+
+    root = str(tmp_path / "fares")
+    series = FareTimeSeries(root)
+
+    for collected, price, free_seats in [
+        ("2024-10-20 08:10:00", 100.0, 30),
+        ("2024-10-20 08:40:00", 120.0, 20),
+        ("2024-10-21 09:00:00", 90.0, 10),
+        ("2024-11-02 09:00:00", 150.0, 0),
+    ]:
+        record = _sample_record([_sample_service("1", price, free_seats)])
+        record["result"]["servicesList"][0]["totalSeats"] = 40
+        record["result"]["servicesList"][0]["originDesc"] = "SAO PAULO (TIETE) - SP"
+        record["result"]["servicesList"][0]["destinationDesc"] = "CURITIBA - PR"
+        record["collect_at"] = {"timezone": "UTC", "datetime": collected}
+        series.observe_record(record)
+    series.close()
+
+    # same size, garbage content: only the rollups can answer
+    chunk = tmp_path / "fares" / "18697-5410" / "2024-10.ndjson"
+    chunk.write_text("x" * len(chunk.read_text()))
+
+    history = FareTimeSeries(root).fare_history(
+        "São Paulo (Rod. Tietê) (SP)",
+        "Curitiba (PR)",
+        days=30,
+        until=date(2024, 11, 2),
+    )
+
+    assert [
+        (day["day"], day["fare_min"], day["fare_avg"], day["fare_max"])
+        for day in history
+    ] == [
+        ("2024-10-20", 100.0, 110.0, 120.0),
+        ("2024-10-21", 90.0, 90.0, 90.0),
+        ("2024-11-02", 150.0, 150.0, 150.0),
+    ]
+    assert history[0]["occupancy_min"] == 0.25 and history[2]["occupancy_max"] == 1.0
+
+    # the rollups of a chunk are rebuilt when they fall behind it
+    (tmp_path / "fares" / "18697-5410" / "2024-11.rollup.json").unlink()
+    by_hour = FareTimeSeries(root).fare_history(
+        18697, 5410, days=1, until=date(2024, 11, 2), by_hour=True
+    )
+    assert [(row["day"], row["hour"], row["observations"]) for row in by_hour] == [
+        ("2024-11-02", 9, 1)
+    ]
+
+
+def test_fare_timeseries_writes_every_record_before_close(tmp_path) -> None:
+    from fare_timeseries import FareTimeSeries
+
+    root = str(tmp_path / "fares")
+    series = FareTimeSeries(root)
+
+    for collected, price in [
+        ("2024-10-20 08:10:00", 100.0),
+        ("2024-10-21 09:00:00", 90.0),
+    ]:
+        record = _sample_record([_sample_service("1", price, 10)])
+        record["collect_at"] = {"timezone": "UTC", "datetime": collected}
+        series.observe_record(record)
+
+    # never closed, as in an interrupted crawl: another reader sees both records
+    chunk = tmp_path / "fares" / "18697-5410" / "2024-10.ndjson"
+    assert len(chunk.read_text().splitlines()) == 2
+
+    history = FareTimeSeries(root).fare_history(
+        18697, 5410, days=30, until=date(2024, 10, 31)
+    )
+    assert [(day["day"], day["fare_min"]) for day in history] == [
+        ("2024-10-20", 100.0),
+        ("2024-10-21", 90.0),
+    ]
+
+
+def test_token_bucket_caps_the_rate() -> None:
+    now = [0.0]
+
+    def sleep(seconds: float) -> None:
+        now[0] += seconds
+
+    bucket = TokenBucket(2, burst=3, clock=lambda: now[0], sleep=sleep)
+
+    # the burst goes out at once, then a token every half second
+    for _ in range(9):
+        bucket.acquire()
+
+    assert now[0] == pytest.approx(3.0)
+
+
+def test_polling_daemon_only_polls_the_due_units(tmp_path) -> None:
+    with MockJcatlmApi() as mock:
+        argv = [
+            "--days",
+            "1",
+            "--api-url",
+            mock.url,
+            "--site-url",
+            mock.url,
+            "--credentials-cache",
+            str(tmp_path / "credentials.json"),
+            "--locales-cache",
+            str(tmp_path / "locales.json"),
+            "--planner-state",
+            str(tmp_path / "planner.json"),
+            "--output",
+            str(tmp_path / "result.ndjson"),
+            "--invalid-output",
+            str(tmp_path / "invalid.ndjson"),
+            "--max-rate",
+            "40",
+            "--burst",
+            "1",
+            "--idle-sleep",
+            "0",
+        ]
+
+        started = datetime.now()
+        polling_daemon.main(argv + ["--max-cycles", "2"])
+        elapsed = (datetime.now() - started).total_seconds()
+
+        routes = len(crawl_from_api.challenge_list_of_trips)
+        assert mock.calls["getRoutes"] == routes
+        assert elapsed >= (routes - 1) / 40
+        assert len(list(iter_records(str(tmp_path / "result.ndjson")))) == routes
+
+        # a restarted daemon finds every unit still fresh, and logs in only once
+        polling_daemon.main(argv + ["--max-cycles", "1"])
+        assert mock.calls["getRoutes"] == routes
+        assert mock.calls["login"] == 1
+
+
+def test_polling_daemon_backs_off_when_every_call_fails(tmp_path) -> None:
+    with MockJcatlmApi(error_rate=1.0) as mock:
+        started = datetime.now()
+        polling_daemon.main(
+            [
+                "--days",
+                "1",
+                "--api-url",
+                mock.url,
+                "--site-url",
+                mock.url,
+                "--credentials-cache",
+                str(tmp_path / "credentials.json"),
+                "--locales-cache",
+                str(tmp_path / "locales.json"),
+                "--planner-state",
+                str(tmp_path / "planner.json"),
+                "--output",
+                str(tmp_path / "result.ndjson"),
+                "--invalid-output",
+                str(tmp_path / "invalid.ndjson"),
+                "--max-attempts",
+                "1",
+                "--max-rate",
+                "100",
+                "--idle-sleep",
+                "0.1",
+                "--failure-sleep",
+                "0.5",
+                "--max-cycles",
+                "4",
+            ]
+        )
+        elapsed = (datetime.now() - started).total_seconds()
+
+        # the failed units are backed off instead of polled every cycle
+        assert mock.calls["getRoutes"] == len(crawl_from_api.challenge_list_of_trips)
+        assert elapsed >= 0.5
+
+
+def test_polling_daemon_survives_the_api_going_down(monkeypatch) -> None:
+    with MockJcatlmApi() as mock:
+        req_gen = ApiRoutesRequestGenerator(api_url=mock.url, site_url=mock.url)
+        fetcher = RouteFetcher(session=req_gen.api.session)
+        route = next(iter(mock._templates))
+        # every unit is due again right away, failed or not
+        planner = CrawlPlanner(
+            [route], horizon_days=2, min_interval=0.01, failure_backoff=0.01
+        )
+        errors = []
+
+        refresh = req_gen.api.refresh_credentials
+
+        def refresh_while_down() -> None:
+            mock.stop()
+            req_gen.api.session.close()  # drops the kept-alive connections
+            refresh()
+
+        def on_cycle_end() -> None:
+            if daemon.cycles == 0:
+                # the token expires, and the api is gone when logging in again
+                mock.revoke_tokens()
+                monkeypatch.setattr(
+                    req_gen.api, "refresh_credentials", refresh_while_down
+                )
+
+        daemon = polling_daemon.PollingDaemon(
+            req_gen,
+            fetcher,
+            planner,
+            lambda trip, response: response.status_code == 200,
+            lambda trip, error: errors.append(trip),
+            failure_sleep=0.3,
+            on_cycle_end=on_cycle_end,
+        )
+
+        started = perf_counter()
+        daemon.run(max_cycles=3)
+
+        assert daemon.cycles == 3
+        # the second cycle stopped on the login: its units were backed off...
+        assert [unit.get("failures") for unit in planner.units.values()] == [1, 1]
+        assert perf_counter() - started >= 0.3
+        # ...and the third one got a connection error for each of them
+        assert len(errors) == 2
+
+
+def test_hybrid_crawl_sends_only_the_empty_and_failed_units_to_the_browser(
+    tmp_path, monkeypatch
+) -> None:
+    browsed = []
+
+    def fake_crawl_trip(self, driver, departure, arrival, departure_date) -> None:
+        browsed.append((departure, arrival))
+        page = {
+            "origin": departure,
+            "destination": arrival,
+            "services": [
+                {
+                    "departureTime": "23:30",
+                    "travelTime": "6h15min",
+                    "offers": [
+                        {
+                            "category": "Leito",
+                            "priceTruncated": "R$ 1.189",
+                            "priceDecimals": ",90",
+                        }
+                    ],
+                }
+            ],
+        }
+        self.results += [build_results(page, departure_date)]
+
+    monkeypatch.setattr(Crawler, "crawl_trip", fake_crawl_trip)
+
+    with MockJcatlmApi() as mock:
+        req_gen = ApiRoutesRequestGenerator(api_url=mock.url, site_url=mock.url)
+        units = hybrid_crawl.build_units(req_gen, 1, today=date(2024, 10, 24))
+        # not in the recording: the api answers it without services
+        units += [
+            {
+                "from": 5410,
+                "to": 14199,
+                "departureDate": "2024-10-24",
+                "departure": "Belo Horizonte (MG)",
+                "arrival": "Rio de Janeiro (Novo Rio) (RJ)",
+            }
+        ]
+
+        # and the connection of this one is dropped without an answer
+        mock.dropped_routes.add((units[0]["from"], units[0]["to"]))
+
+        fetcher = RouteFetcher(session=req_gen.api.session)
+        writer = open_writer(str(tmp_path / "hybrid.ndjson"), "ndjson")
+        summary = hybrid_crawl.crawl_hybrid(
+            req_gen,
+            fetcher,
+            Crawler(mock.url),
+            units,
+            writer,
+            driver_factory=_FakeDriver,
+        )
+        fetcher.close()
+        writer.close()
+
+    assert summary == {"api": len(units) - 2, "website": 2, "failed": 0}
+    assert sorted(browsed) == sorted(
+        [
+            ("Belo Horizonte (MG)", "Rio de Janeiro (Novo Rio) (RJ)"),
+            (units[0]["departure"], units[0]["arrival"]),
+        ]
+    )
+
+    records = list(iter_records(str(tmp_path / "hybrid.ndjson")))
+    api_record = next(record for record in records if record["source"] == "api")
+    website_record = next(
+        record
+        for record in records
+        if record["source"] == "website" and record["originId"] == 5410
+    )
+
+    # the same schema, whichever the source
+    assert set(api_record) == set(website_record)
+    assert isinstance(api_record["price"], float)
+    assert website_record["price"] == 1189.9
+    assert website_record["departureDate"] == "2024-10-24T23:30:00"
+    assert website_record["arrivalDate"] == "2024-10-25T05:45:00"
+    assert datetime.fromisoformat(api_record["departureDate"])
+
+    # the stations are named after the api locales, not the website labels
+    stations = {locale["id"]: locale["city"] for locale in req_gen.api.locales_info}
+    assert website_record["originDesc"] == stations[5410]
+    assert api_record["originDesc"] == stations[api_record["originId"]]
+
+
+def test_normalized_services_are_available_only_with_free_seats() -> None:
+    unit = {"from": 18697, "to": 5410}
+
+    def available(free_seats):
+        service = _sample_service("1", 100.0, free_seats)
+        if free_seats == None:
+            del service["freeSeats"]
+        return hybrid_crawl.normalize_service(
+            service, unit, {}, "api", "2024-10-24T00:00:00+00:00"
+        )["isAvailable"]
+
+    assert (available(3), available(0), available(None)) == (True, False, None)
+
+
+def test_fare_analytics_groups_by_route_and_day(tmp_path) -> None:
+    def service(departure: str, price: float | None, free_seats: int) -> dict:
+        return {
+            **_sample_service("1", price, free_seats),
+            "departureDate": departure,
+            "arrivalDate": departure.replace("T20", "T23"),
+            "totalSeats": 40,
+            "km": 100.0,
+        }
+
+    records = [
+        _sample_record(
+            [
+                service("2024-10-24T20:00:00", 100.0, 30),
+                service("2024-10-24T20:30:00", 200.0, 10),
+                service("2024-10-25T20:00:00", None, 0),
+            ]
+        ),
+        _sample_record([service("2024-10-25T20:00:00", 90.0, 40)]),
+    ]
+    records[1]["result"]["servicesList"][0]["destinationId"] = 12722
+
+    path = str(tmp_path / "result.ndjson")
+    with open_writer(path, "ndjson") as writer:
+        for record in records:
+            record["collect_at"] = {"timezone": "UTC", "datetime": "2024-10-23 10:00:00"}
+            writer.write(record)
+
+    columns = fare_analytics.load_columns([path])
+
+    assert len(columns) == 4
+    assert columns.occupancy.tolist() == [0.25, 0.75, 1.0, 0.0]
+    assert columns.duration_hours.tolist() == [3.0, 3.0, 3.0, 3.0]
+    assert columns.collected_at[0] == np.datetime64("2024-10-23T10:00:00")
+
+    rows = fare_analytics.report(columns, by="route_day")
+    assert [
+        (row["destination_id"], row["day"], row["services"], row["fare_p50"])
+        for row in rows
+    ] == [
+        (5410, "2024-10-24", 2, 150.0),
+        (5410, "2024-10-25", 1, None),
+        (12722, "2024-10-25", 1, 90.0),
+    ]
+    assert rows[0]["occupancy_mean"] == 0.5 and rows[0]["price_per_km_mean"] == 1.5
+
+    (by_route,) = [
+        row for row in fare_analytics.report(columns) if row["destination_id"] == 5410
+    ]
+    assert (by_route["fare_min"], by_route["fare_max"]) == (100.0, 200.0)
+    assert fare_analytics.percentiles(columns.price, (50,)) == {"p50": 100.0}